@@ -0,0 +1,513 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+End-to-end benchmark of the query service, run against a fake etcd v2 (see
+fake_etcd.py) holding a synthetic NMOS topology of nodes, devices, sources,
+flows, senders and receivers. For each scale, a server process is started
+running the real QueryServiceAPI, and this process measures
+
+ - the latency of GET requests, by resource type and filter
+ - the time taken to receive a websocket subscription's initial sync
+ - the latency from a change being written to etcd to its delivery, for
+   different numbers of websocket subscribers
+ - the rate at which a burst of changes written to etcd is taken in, and the
+   requests made to etcd to watch for them, with the service's etcd_watch_mode
+   given by --watch-mode
+
+Results are printed, and written as JSON with --output so that they can be
+compared between commits. Websocket measurements need websocket-client.
+
+    python benchmarks/end_to_end.py [--scales 1000,10000,100000] [--output results.json]
+"""
+
+from __future__ import print_function
+
+from gevent import monkey
+monkey.patch_all()
+
+import argparse # noqa E402
+import datetime # noqa E402
+import json # noqa E402
+import logging # noqa E402
+import os # noqa E402
+import platform # noqa E402
+import random # noqa E402
+import socket # noqa E402
+import subprocess # noqa E402
+import sys # noqa E402
+import time # noqa E402
+import uuid # noqa E402
+
+import gevent # noqa E402
+import gevent.pool # noqa E402
+import requests # noqa E402
+from six.moves.urllib.parse import urlparse # noqa E402
+
+try:
+    import websocket
+except ImportError:
+    websocket = None
+
+API_VERSION = "v1.3"
+RESOURCE_TYPES = ["nodes", "devices", "sources", "flows", "senders", "receivers"]
+BASE_VERSION = 1500000000
+
+# Resources of each type created for every node in the topology
+PER_NODE = {"nodes": 1, "devices": 1, "sources": 2, "flows": 2, "senders": 2, "receivers": 2}
+
+
+def make_topology(scale):
+    """
+    Return a list of (type, resource) making up roughly `scale' resources. Each
+    node has a device with a video and an audio source, flow and sender, and
+    two receivers, each subscribed to a sender of the previous node. The same
+    scale always gives the same topology, so the server and client agree.
+    """
+    rand = random.Random(scale)
+    resources = []
+    count = max(scale // sum(PER_NODE.values()), 1)
+    senders = []
+    seq = [0]
+
+    def new_id():
+        return str(uuid.UUID(int=rand.getrandbits(128), version=4))
+
+    def add(rtype, obj):
+        seq[0] += 1
+        obj.update({
+            "version": "{}:0".format(BASE_VERSION + seq[0]),
+            "description": "",
+            "tags": {},
+            "@_apiversion": API_VERSION,
+        })
+        resources.append((rtype, obj))
+        return obj
+
+    for i in range(count):
+        node = add("nodes", {
+            "id": new_id(), "label": "node {}".format(i), "hostname": "node{}.example.com".format(i),
+            "href": "http://node{}.example.com/".format(i), "caps": {}, "services": [], "clocks": [],
+            "interfaces": [], "api": {"versions": [API_VERSION], "endpoints": []}
+        })
+        device = add("devices", {
+            "id": new_id(), "label": "device {}".format(i), "type": "urn:x-nmos:device:generic",
+            "node_id": node["id"], "senders": [], "receivers": [], "controls": []
+        })
+        previous = senders
+        senders = []
+        for kind, media_type in (("video", "video/raw"), ("audio", "audio/L24")):
+            source = add("sources", {
+                "id": new_id(), "label": "{} source {}".format(kind, i), "caps": {},
+                "device_id": device["id"], "parents": [], "clock_name": None,
+                "format": "urn:x-nmos:format:" + kind
+            })
+            flow = add("flows", {
+                "id": new_id(), "label": "{} flow {}".format(kind, i), "source_id": source["id"],
+                "device_id": device["id"], "parents": [], "format": "urn:x-nmos:format:" + kind,
+                "media_type": media_type, "grain_rate": {"numerator": 25, "denominator": 1}
+            })
+            senders.append(add("senders", {
+                "id": new_id(), "label": "{} sender {}".format(kind, i), "flow_id": flow["id"],
+                "device_id": device["id"], "transport": "urn:x-nmos:transport:rtp.mcast",
+                "manifest_href": "http://node{}.example.com/{}.sdp".format(i, kind), "interface_bindings": [],
+                "subscription": {"receiver_id": None, "active": False}
+            }))
+            add("receivers", {
+                "id": new_id(), "label": "{} receiver {}".format(kind, i), "device_id": device["id"],
+                "transport": "urn:x-nmos:transport:rtp", "interface_bindings": [],
+                "format": "urn:x-nmos:format:" + kind, "caps": {"media_types": [media_type]},
+                "subscription": {"sender_id": previous[len(senders) - 1]["id"] if previous else None,
+                                 "active": bool(previous)}
+            })
+    return resources
+
+
+def get_cases(topology):
+    """The (name, path, params) of each GET request to time, given the topology served"""
+    first = {}
+    counts = {}
+    for rtype, obj in topology:
+        first.setdefault(rtype, obj)
+        counts[rtype] = counts.get(rtype, 0) + 1
+    cases = []
+    for rtype in RESOURCE_TYPES:
+        cases.append(("{} (first page)".format(rtype), "/{}/".format(rtype), {}))
+        cases.append(("{} (all)".format(rtype), "/{}/".format(rtype), {"paging.limit": str(counts[rtype])}))
+    cases += [
+        ("flow by id", "/flows/{}/".format(first["flows"]["id"]), {}),
+        ("flows by format", "/flows/", {"format": "urn:x-nmos:format:video"}),
+        ("senders by device_id", "/senders/", {"device_id": first["devices"]["id"]}),
+        ("receivers by subscription.sender_id", "/receivers/",
+         {"subscription.sender_id": first["senders"]["id"]}),
+        ("flows by label (no match)", "/flows/", {"label": "potato"}),
+        ("flows by rql", "/flows/", {"query.rql": "and(eq(media_type,video/raw),ne(label,potato))"}),
+        ("sources by ancestry", "/sources/",
+         {"query.ancestry_id": first["flows"]["id"], "query.ancestry_type": "parents"}),
+    ]
+    return cases
+
+
+def summarise(samples):
+    """Percentiles, in milliseconds, of a list of durations in seconds"""
+    samples = sorted(samples)
+    if not samples:
+        return {"count": 0}
+
+    def percentile(p):
+        return round(samples[min(int(len(samples) * p / 100.0), len(samples) - 1)] * 1000, 3)
+
+    return {
+        "count": len(samples),
+        "mean_ms": round(sum(samples) * 1000 / len(samples), 3),
+        "p50_ms": percentile(50),
+        "p90_ms": percentile(90),
+        "p99_ms": percentile(99),
+        "max_ms": round(samples[-1] * 1000, 3),
+    }
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def serve(args):
+    """Run a fake etcd holding the topology, and the query service reading it, reporting when it is ready"""
+    from fake_etcd import FakeEtcd, serve as serve_app
+    from nmosquery.common.query import reg
+    from nmosquery.config import config
+    from nmosquery.api import QueryServiceAPI
+    from nmoscommon.logger import Logger
+    from geventwebsocket.handler import WebSocketHandler
+
+    if not args.verbose:
+        logging.disable(logging.WARNING)
+
+    start = time.time()
+    etcd = FakeEtcd()
+    for rtype, obj in make_topology(args.scale):
+        etcd.backend.put("/resource/{}/{}".format(rtype, obj["id"]), json.dumps(obj))
+    # There's no need to replay the creation of the topology to the service
+    etcd.backend.compact()
+    serve_app(etcd, args.etcd_port, nodelay=True)
+    populated = time.time()
+
+    reg['host'] = '127.0.0.1'
+    reg['port'] = args.etcd_port
+    config.update({"enable_mdns": False, "paging_max_limit": max(args.scale, config["paging_max_limit"]),
+                   "etcd_watch_mode": args.watch_mode})
+    api = QueryServiceAPI(Logger("regquery"), config)
+    while not api.registry.seeded:
+        gevent.sleep(0.01)
+    seeded = time.time()
+
+    # Served as by nmoscommon's HttpServer
+    server = serve_app(api.app, args.port, handler_class=WebSocketHandler)
+    print("READY " + json.dumps({"populate_seconds": populated - start, "seed_seconds": seeded - populated}))
+    sys.stdout.flush()
+    server.serve_forever()
+
+
+class Client(object):
+    """Drives a query service started by serve() in a subprocess"""
+
+    def __init__(self, args, scale):
+        self.args = args
+        self.scale = scale
+        self.port = free_port()
+        self.etcd_port = free_port()
+        self.base = "http://127.0.0.1:{}/x-nmos/query/{}".format(self.port, API_VERSION)
+        self.etcd_base = "http://127.0.0.1:{}/v2/keys".format(self.etcd_port)
+        self.session = requests.Session()
+        self.session.trust_env = False
+        self.process = None
+        self.startup = None
+
+    def start(self):
+        env = dict(os.environ)
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join([root] + ([env["PYTHONPATH"]] if env.get("PYTHONPATH") else []))
+        command = [sys.executable, os.path.abspath(__file__), "--serve", "--scale", str(self.scale),
+                   "--port", str(self.port), "--etcd-port", str(self.etcd_port), "--watch-mode", self.args.watch_mode]
+        if self.args.verbose:
+            command.append("--verbose")
+        started = time.time()
+        self.process = subprocess.Popen(command, env=env, stdout=subprocess.PIPE)
+        for line in iter(self.process.stdout.readline, b''):
+            line = line.decode('utf-8')
+            if line.startswith("READY "):
+                self.startup = json.loads(line[len("READY "):])
+                self.startup["total_seconds"] = time.time() - started
+                break
+            elif self.args.verbose:
+                sys.stderr.write(line)
+        else:
+            raise RuntimeError("Query service exited with {}".format(self.process.wait()))
+        gevent.spawn(self._drain)
+
+    def _drain(self):
+        for line in iter(self.process.stdout.readline, b''):
+            if self.args.verbose:
+                sys.stderr.write(line.decode('utf-8'))
+
+    def stop(self):
+        if self.process is not None:
+            self.process.terminate()
+            self.process.wait()
+
+    def time_gets(self, topology):
+        results = []
+        for name, path, params in get_cases(topology):
+            response = self.session.get(self.base + path, params=params)
+            response.raise_for_status()
+            samples = []
+            for i in range(self.args.requests):
+                before = time.time()
+                response = self.session.get(self.base + path, params=params)
+                samples.append(time.time() - before)
+            result = {"case": name, "path": path, "params": params, "resources": len(response.json()),
+                      "bytes": len(response.content)}
+            result.update(summarise(samples))
+            results.append(result)
+        return results
+
+    def subscribe(self, rtype, rate):
+        """Create a persistent subscription, returning its id and the URL of its websocket on this server"""
+        response = self.session.post(self.base + "/subscriptions", json={
+            "max_update_rate_ms": rate, "resource_path": "/" + rtype, "params": {}, "persist": True
+        })
+        response.raise_for_status()
+        href = urlparse(response.json()["ws_href"])
+        return response.json()["id"], "ws://127.0.0.1:{}{}?{}".format(self.port, href.path, href.query)
+
+    def unsubscribe(self, subscription_id):
+        self.session.delete("{}/subscriptions/{}".format(self.base, subscription_id))
+
+    def connect(self, url, expected):
+        """Open a websocket, returning it once `expected' resources have been received in its sync"""
+        ws = websocket.create_connection(url, timeout=self.args.timeout)
+        received = 0
+        while received < expected:
+            received += len(json.loads(ws.recv())["grain"]["data"])
+        return ws
+
+    def time_syncs(self, counts):
+        results = []
+        for rtype in RESOURCE_TYPES:
+            subscription_id, url = self.subscribe(rtype, 100)
+            samples = []
+            for i in range(self.args.syncs):
+                before = time.time()
+                ws = self.connect(url, counts[rtype])
+                samples.append(time.time() - before)
+                ws.close()
+            self.unsubscribe(subscription_id)
+            result = {"type": rtype, "resources": counts[rtype]}
+            result.update(summarise(samples))
+            results.append(result)
+        return results
+
+    def time_events(self, topology, counts):
+        flows = [obj for rtype, obj in topology if rtype == "flows"]
+        results = []
+        for subscribers in self.args.subscribers:
+            subscription_id, url = self.subscribe("flows", self.args.rate)
+            sockets = [self.connect(url, counts["flows"]) for i in range(subscribers)]
+            samples = []
+            delivered = [0]
+
+            def receive(ws):
+                while True:
+                    try:
+                        message = json.loads(ws.recv())
+                    except Exception:
+                        return
+                    now = time.time()
+                    for grain in message.get("grain", {}).get("data", []):
+                        sent = (grain.get("post") or {}).get("tags", {}).get("benchmark_sent")
+                        if sent:
+                            samples.append(now - float(sent[0]))
+                            delivered[0] += 1
+
+            receivers = [gevent.spawn(receive, ws) for ws in sockets]
+            for i in range(self.args.events):
+                flow = dict(flows[i % len(flows)])
+                expected = delivered[0] + subscribers
+                sent = time.time()
+                flow["tags"] = {"benchmark_sent": [repr(sent)]}
+                flow["version"] = "{}:{}".format(int(sent), int((sent % 1) * 1e9))
+                # A new connection for each change, as otherwise the body of a PUT is held back
+                # until its headers are acknowledged, which would dwarf what's being measured
+                self.session.put("{}/resource/flows/{}".format(self.etcd_base, flow["id"]),
+                                 data={"value": json.dumps(flow)}, headers={"Connection": "close"})
+                deadline = time.time() + self.args.timeout
+                while delivered[0] < expected and time.time() < deadline:
+                    gevent.sleep(0.001)
+                # Keep each change in a separate update
+                gevent.sleep(self.args.rate / 1000.0)
+            for ws in sockets:
+                ws.close()
+            gevent.joinall(receivers, timeout=self.args.timeout)
+            self.unsubscribe(subscription_id)
+
+            result = {"subscribers": subscribers, "events": self.args.events, "delivered": delivered[0],
+                      "max_update_rate_ms": self.args.rate}
+            result.update(summarise(samples))
+            results.append(result)
+        return results
+
+    def metric(self, name):
+        """The total of the samples of the metric `name' on the server's /metrics"""
+        response = self.session.get("http://127.0.0.1:{}/metrics".format(self.port))
+        response.raise_for_status()
+        total = 0
+        for line in response.text.splitlines():
+            if line.split("{")[0].split(" ")[0] == name:
+                total += float(line.rsplit(" ", 1)[1])
+        return total
+
+    def time_burst(self, topology):
+        """Write a burst of changes to etcd as fast as possible, timing how long the service takes to see them all"""
+        flows = [obj for rtype, obj in topology if rtype == "flows"]
+        requests_before = self.metric("nmosquery_etcd_watch_requests_total")
+        revisions = []
+        writers = gevent.pool.Pool(self.args.burst_writers)
+
+        def write(i):
+            flow = dict(flows[i % len(flows)])
+            flow["label"] = "burst {}".format(i)
+            # Sessions aren't safe to share between concurrent writers
+            session = requests.Session()
+            session.trust_env = False
+            response = session.put("{}/resource/flows/{}".format(self.etcd_base, flow["id"]),
+                                   data={"value": json.dumps(flow)}, headers={"Connection": "close"})
+            revisions.append(response.json()["node"]["modifiedIndex"])
+
+        started = time.time()
+        writers.map(write, range(self.args.burst))
+        written = time.time()
+        deadline = written + self.args.timeout
+        while self.metric("nmosquery_registry_index") < max(revisions) and time.time() < deadline:
+            gevent.sleep(0.01)
+        seen = time.time()
+        return {
+            "watch_mode": self.args.watch_mode,
+            "changes": self.args.burst,
+            "write_seconds": round(written - started, 3),
+            "seen_seconds": round(seen - started, 3),
+            "lag_ms": round((seen - written) * 1000, 3),
+            "changes_per_second": round(self.args.burst / (seen - started), 1),
+            "watch_requests": int(self.metric("nmosquery_etcd_watch_requests_total") - requests_before),
+        }
+
+    def run(self):
+        topology = make_topology(self.scale)
+        counts = {}
+        for rtype, obj in topology:
+            counts[rtype] = counts.get(rtype, 0) + 1
+        self.start()
+        try:
+            result = {"scale": self.scale, "resources": counts, "startup": self.startup,
+                      "get": self.time_gets(topology)}
+            if websocket is not None:
+                result["sync"] = self.time_syncs(counts)
+                result["events"] = self.time_events(topology, counts)
+            if self.args.burst:
+                result["burst"] = self.time_burst(topology)
+            return result
+        finally:
+            self.stop()
+
+
+def report(results, out):
+    for result in results:
+        total = sum(result["resources"].values())
+        print("\n{} resources (started in {:.1f}s)".format(total, result["startup"]["total_seconds"]), file=out)
+        columns = "{:<45} {:>10} {:>10} {:>10} {:>10}"
+        print(columns.format("GET", "p50 ms", "p90 ms", "p99 ms", "max ms"), file=out)
+        for row in result["get"]:
+            print(columns.format(row["case"], row["p50_ms"], row["p90_ms"], row["p99_ms"], row["max_ms"]), file=out)
+        for row in result.get("sync", []):
+            print(columns.format("websocket sync of {} {}".format(row["resources"], row["type"]),
+                                 row["p50_ms"], row["p90_ms"], row["p99_ms"], row["max_ms"]), file=out)
+        for row in result.get("events", []):
+            name = "event delivery to {} subscribers".format(row["subscribers"])
+            print(columns.format(name, row.get("p50_ms"), row.get("p90_ms"), row.get("p99_ms"), row.get("max_ms")),
+                  file=out)
+        burst = result.get("burst")
+        if burst:
+            print("burst of {changes} changes ({watch_mode} watch): {changes_per_second} changes/s, seen {lag_ms} ms "
+                  "after the last was written, using {watch_requests} watch requests".format(**burst), file=out)
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except Exception:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scales", default="1000,10000", help="comma separated numbers of resources to serve")
+    parser.add_argument("--requests", type=int, default=50, help="timed GET requests for each case")
+    parser.add_argument("--syncs", type=int, default=5, help="timed websocket syncs for each resource type")
+    parser.add_argument("--subscribers", default="1,10,100",
+                        help="comma separated numbers of websocket subscribers to deliver events to")
+    parser.add_argument("--events", type=int, default=50, help="changes made for each number of subscribers")
+    parser.add_argument("--burst", type=int, default=2000, help="changes written in a burst, or 0 for none")
+    parser.add_argument("--burst-writers", type=int, default=10, help="concurrent writers of the burst of changes")
+    parser.add_argument("--watch-mode", default="long_poll", choices=["long_poll", "stream"],
+                        help="etcd_watch_mode of the query service")
+    parser.add_argument("--rate", type=int, default=0, help="max_update_rate_ms of the subscriptions receiving events")
+    parser.add_argument("--timeout", type=float, default=60, help="seconds to wait for any response")
+    parser.add_argument("--output", help="file to write JSON results to, or - for stdout")
+    parser.add_argument("--verbose", action="store_true", help="show the query service's log")
+    parser.add_argument("--serve", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--scale", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--port", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--etcd-port", type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args)
+
+    args.subscribers = [int(count) for count in args.subscribers.split(",")]
+    if websocket is None:
+        sys.stderr.write("websocket-client is not installed, so only GET requests will be timed\n")
+    results = [Client(args, int(scale)).run() for scale in args.scales.split(",")]
+
+    document = {
+        "commit": git_commit(),
+        "date": datetime.datetime.utcnow().isoformat() + "Z",
+        "python": platform.python_version(),
+        "parameters": {name: value for name, value in vars(args).items()
+                       if name not in ("serve", "scale", "port", "etcd_port", "output", "verbose")},
+        "results": results,
+    }
+    report(results, sys.stderr if args.output == "-" else sys.stdout)
+    if args.output == "-":
+        json.dump(document, sys.stdout, indent=2)
+    elif args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
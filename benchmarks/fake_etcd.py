@@ -0,0 +1,197 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+A stand-in for the etcd v2 keys API, serving the store of a FakeBackend over
+HTTP: GETs (recursive or not, long-polling with wait=true&waitIndex=N, and
+streaming with stream=true as well), PUTs and DELETEs under /v2/keys/. Only what the query service and the
+benchmarks use is implemented.
+
+    python benchmarks/fake_etcd.py [port]
+"""
+
+from __future__ import print_function
+
+from gevent import monkey
+monkey.patch_all()
+
+import json # noqa E402
+import socket # noqa E402
+import sys # noqa E402
+import gevent # noqa E402
+import gevent.queue # noqa E402
+from gevent.pywsgi import WSGIServer # noqa E402
+from six.moves.urllib.parse import parse_qs # noqa E402
+
+from nmosquery.backends.fake import FakeBackend # noqa E402
+
+KEYS_PREFIX = "/v2/keys"
+
+# Seconds a long-poll is held open without a change, well beyond the query service's read timeout
+WAIT_TIMEOUT = 60
+
+
+class FakeEtcd(object):
+    """A WSGI application presenting `backend' as etcd v2 would"""
+
+    def __init__(self, backend=None, wait_timeout=WAIT_TIMEOUT):
+        self.backend = backend or FakeBackend()
+        self.wait_timeout = wait_timeout
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(KEYS_PREFIX):
+            return self._respond(start_response, 404, {"errorCode": 100, "message": "Key not found", "cause": path})
+        key = path[len(KEYS_PREFIX):].rstrip('/') or '/'
+        args = dict((name, values[-1]) for name, values in parse_qs(environ.get('QUERY_STRING', '')).items())
+        method = environ.get('REQUEST_METHOD', 'GET')
+
+        if method == 'GET' and args.get('wait') == 'true':
+            since = int(args.get('waitIndex', self.backend.revision + 1)) - 1
+            if args.get('stream') == 'true':
+                return self._stream(start_response, key, since)
+            return self._wait(start_response, key, since)
+        elif method == 'GET':
+            return self._get(start_response, key, args.get('recursive') == 'true')
+        elif method == 'PUT':
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+            form = parse_qs(environ['wsgi.input'].read(length).decode('utf-8'))
+            value = form.get('value', [''])[-1]
+            revision = self.backend.put(key, value)
+            return self._respond(start_response, 200, {"action": "set", "node": {
+                "key": key, "value": value, "modifiedIndex": revision
+            }})
+        elif method == 'DELETE':
+            revision = self.backend.delete(key)
+            if revision is None:
+                return self._not_found(start_response, key)
+            return self._respond(start_response, 200, {"action": "delete", "node": {
+                "key": key, "modifiedIndex": revision
+            }})
+        return self._respond(start_response, 405, {"errorCode": 0, "message": "Method not allowed"})
+
+    def _get(self, start_response, key, recursive):
+        tree, _ = self.backend.snapshot()
+        leaves = [node for node in tree.get("node", {}).get("nodes", [])
+                  if node["key"] == key or node["key"].startswith(key.rstrip('/') + '/')]
+        if not leaves:
+            return self._not_found(start_response, key)
+        if len(leaves) == 1 and leaves[0]["key"] == key:
+            return self._respond(start_response, 200, {"action": "get", "node": leaves[0]})
+        return self._respond(start_response, 200, {"action": "get", "node": _directory(key, leaves, recursive)})
+
+    def _wait(self, start_response, key, since):
+        prefix = key.rstrip('/') + '/'
+        stream = self.backend.watch(since)
+        try:
+            with gevent.Timeout(self.wait_timeout, False):
+                for event in stream.queue:
+                    if event["action"] == "index_skip":
+                        return self._outdated(start_response)
+                    if event["node"]["key"] == key or event["node"]["key"].startswith(prefix):
+                        return self._respond(start_response, 200, event)
+        finally:
+            stream.stop()
+        return self._respond(start_response, 408, {"errorCode": 0, "message": "Timed out waiting for a change"})
+
+    def _stream(self, start_response, key, since):
+        stream = self.backend.watch(since)
+        if not stream.queue.empty() and stream.queue.peek()["action"] == "index_skip":
+            stream.stop()
+            return self._outdated(start_response)
+        # As etcd does, send each change on a line of its own, in a chunk of its own
+        start_response("200 OK", [("Content-Type", "application/json"), ("X-Etcd-Index", str(self.backend.revision))])
+        return self._events(stream, key.rstrip('/') + '/')
+
+    def _events(self, stream, prefix):
+        try:
+            while True:
+                event = stream.queue.get(timeout=self.wait_timeout)
+                if event["node"]["key"].startswith(prefix):
+                    yield (json.dumps(event) + "\n").encode('utf-8')
+        except gevent.queue.Empty:
+            pass
+        finally:
+            stream.stop()
+
+    def _outdated(self, start_response):
+        return self._respond(start_response, 400, {
+            "errorCode": 401, "message": "The event in requested index is outdated and cleared",
+            "cause": "the requested history has been cleared", "index": self.backend.revision
+        })
+
+    def _not_found(self, start_response, key):
+        return self._respond(start_response, 404, {
+            "errorCode": 100, "message": "Key not found", "cause": key, "index": self.backend.revision
+        })
+
+    def _respond(self, start_response, status, obj):
+        body = json.dumps(obj).encode('utf-8')
+        start_response("{} {}".format(status, _REASONS.get(status, "")), [
+            ("Content-Type", "application/json"),
+            ("Content-Length", str(len(body))),
+            ("X-Etcd-Index", str(self.backend.revision)),
+        ])
+        return [body]
+
+
+_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 408: "Request Timeout"}
+
+
+def _directory(key, leaves, recursive):
+    """Nest the leaf nodes below `key' into etcd v2 directory nodes"""
+    depth = len([part for part in key.split('/') if part])
+    children = {}
+    for leaf in leaves:
+        parts = [part for part in leaf["key"].split('/') if part]
+        if len(parts) == depth + 1:
+            children[leaf["key"]] = leaf
+        else:
+            child_key = '/' + '/'.join(parts[:depth + 1])
+            children.setdefault(child_key, []).append(leaf)
+
+    nodes = []
+    for child_key in sorted(children):
+        child = children[child_key]
+        if isinstance(child, dict):
+            nodes.append(child)
+        elif recursive:
+            nodes.append(_directory(child_key, child, recursive))
+        else:
+            nodes.append({"key": child_key, "dir": True})
+    return {"key": key, "dir": True, "nodes": nodes}
+
+
+def serve(app, port, host='127.0.0.1', nodelay=False, **kwargs):
+    """
+    Start serving `app' in the background, returning the started WSGIServer.
+    With `nodelay', Nagle's algorithm is disabled on its connections, as etcd
+    does, since pywsgi writes the headers and body of a response separately.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if nodelay:
+        # Inherited by accepted connections
+        listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    listener.bind((host, port))
+    listener.listen(1024)
+    server = WSGIServer(listener, app, log=None, **kwargs)
+    server.start()
+    return server
+
+
+if __name__ == '__main__':
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 2379
+    print("Fake etcd v2 listening on port {}".format(port))
+    serve(FakeEtcd(), port, nodelay=True).serve_forever()
@@ -0,0 +1,74 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Microbenchmark comparing the per-object cost of interpreting query filters
+(QueryFilterCommon.check_args) with running a precompiled predicate
+(QueryFilterCommon.compile), over a scan of synthetic flows.
+
+    python benchmarks/filter_scan.py [count]
+"""
+
+from __future__ import print_function
+
+import sys
+import timeit
+import uuid
+
+from nmosquery.common.querysockets import QueryFilterCommon
+
+FILTERS = [
+    {"format": "urn:x-nmos:format:video"},
+    {"source_id": "potato", "query.downgrade": "v1.0"},
+    {"device_id": "potato", "format": "urn:x-nmos:format:video", "label": "flow 0"},
+    {"tags.studio": "studio3"},
+]
+
+
+def make_flows(count):
+    flows = []
+    for i in range(count):
+        flows.append({
+            "id": str(uuid.uuid4()),
+            "label": "flow {}".format(i),
+            "device_id": str(uuid.uuid4()),
+            "source_id": str(uuid.uuid4()),
+            "format": ["urn:x-nmos:format:video", "urn:x-nmos:format:audio"][i % 2],
+            "tags": {"studio": ["studio{}".format(i % 10)]},
+            "parents": [],
+        })
+    return flows
+
+
+def main(count):
+    flows = make_flows(count)
+    print("Scanning {} flows, best of 5 runs".format(count))
+    print("{:<80} {:>12} {:>12} {:>8}".format("filter", "interpreted", "compiled", "speedup"))
+    for args in FILTERS:
+        def interpreted():
+            return [flow for flow in flows if QueryFilterCommon().check_args(args, flow)]
+
+        def compiled():
+            predicate = QueryFilterCommon().compile(args)
+            return [flow for flow in flows if predicate(flow)]
+
+        assert interpreted() == compiled()
+        before = min(timeit.repeat(interpreted, number=1, repeat=5))
+        after = min(timeit.repeat(compiled, number=1, repeat=5))
+        print("{:<80} {:>9.0f} ns {:>9.0f} ns {:>7.1f}x".format(
+            str(args), before * 1e9 / count, after * 1e9 / count, before / after))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50000)
@@ -0,0 +1,93 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Microbenchmark of the CPU cost of answering a list query over synthetic flows:
+decoding each etcd value per request (as the etcd fallback path still does)
+against matching the decoded resources held by the registry mirror, with the
+translation cache both cold and warm.
+
+    python benchmarks/query_decode.py [count]
+"""
+
+from __future__ import print_function
+
+import json
+import sys
+import timeit
+import uuid
+
+from nmosquery.registry import Registry
+from nmosquery.common.query import QueryCommon
+
+QUERIES = [
+    {},
+    {"format": "urn:x-nmos:format:video"},
+    {"format": "urn:x-nmos:format:video", "query.downgrade": "v1.0"},
+]
+
+
+def make_snapshot(count):
+    nodes = []
+    for i in range(count):
+        flow = {
+            "id": str(uuid.uuid4()),
+            "version": "1500000000:{}".format(i),
+            "label": "flow {}".format(i),
+            "description": "",
+            "device_id": str(uuid.uuid4()),
+            "source_id": str(uuid.uuid4()),
+            "format": ["urn:x-nmos:format:video", "urn:x-nmos:format:audio"][i % 2],
+            "tags": {"studio": ["studio{}".format(i % 10)]},
+            "parents": [],
+            "@_apiversion": "v1.2",
+        }
+        key = "/resource/flows/{}".format(flow["id"])
+        nodes.append({"key": key, "value": json.dumps(flow), "modifiedIndex": i + 1, "createdIndex": i + 1})
+    return {"node": {"key": "/resource", "dir": True, "nodes": [
+        {"key": "/resource/flows", "dir": True, "nodes": nodes}
+    ]}}
+
+
+def main(count):
+    snapshot = make_snapshot(count)
+    raw = {"resource": {"flows": {node["key"]: node["value"] for node in snapshot["node"]["nodes"][0]["nodes"]}}}
+
+    registry = Registry("localhost", 4001)
+    registry.load(snapshot, count)
+    query = QueryCommon(api_version="v1.2", registry=registry)
+    resources = registry.get_resources("/flows")
+
+    print("Listing {} flows, best of 5 runs".format(count))
+    print("{:<70} {:>12} {:>12} {:>12}".format("query", "decode", "cold cache", "warm cache"))
+    for args in QUERIES:
+        def decode():
+            return query._match_nodes(raw, "flows", args, True)
+
+        def cold():
+            registry.translations.clear()
+            return query._match_objects(resources, args, True)
+
+        def warm():
+            return query._match_objects(resources, args, True)
+
+        assert sorted(node["id"] for node in decode()) == sorted(node["id"] for node in cold())
+        results = [min(timeit.repeat(run, number=1, repeat=5)) for run in (decode, cold, warm)]
+        print("{:<70} {:>9.0f} us {:>9.0f} us {:>9.0f} us".format(
+            str(args), *[result * 1e6 / count * 1000 for result in results]))
+    print("(times per 1000 flows)")
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 20000)
@@ -0,0 +1,159 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from six import string_types
+
+# Fields which refer to other resources by id, by resource type. Dotted fields are nested.
+REFERENCE_FIELDS = {
+    "nodes": [],
+    "devices": ["node_id"],
+    "sources": ["device_id", "parents"],
+    "flows": ["source_id", "device_id", "parents"],
+    "senders": ["flow_id", "device_id"],
+    "receivers": ["device_id", "subscription.sender_id"],
+}
+
+ANCESTRY_TYPES = ["children", "parents"]
+
+
+def parse_ancestry_args(args):
+    """
+    Extract (ancestry_id, ancestry_type, generations) from query arguments,
+    where generations is None for "all". Returns None if no ancestry query is
+    made, and raises ValueError if the arguments are invalid.
+    """
+    if not args or "query.ancestry_id" not in args:
+        for key in (args or {}):
+            if key.startswith("query.ancestry_"):
+                raise ValueError("query.ancestry_id is required for ancestry queries")
+        return None
+
+    ancestry_type = args.get("query.ancestry_type")
+    if ancestry_type not in ANCESTRY_TYPES:
+        raise ValueError("query.ancestry_type must be one of {}".format(", ".join(ANCESTRY_TYPES)))
+
+    generations = args.get("query.ancestry_generations", "all")
+    if generations == "all":
+        generations = None
+    else:
+        try:
+            generations = int(generations)
+        except ValueError:
+            generations = 0
+        if generations < 1:
+            raise ValueError("query.ancestry_generations must be a positive integer or 'all'")
+
+    return (args["query.ancestry_id"], ancestry_type, generations)
+
+
+class RelationGraph(object):
+    """
+    An adjacency graph of the references between resources, such as a flow's
+    source_id or a receiver's subscription.sender_id, kept in both directions
+    so that ancestry queries are answered by walking only related resources.
+
+    Graph nodes are resource ids. References to resources which don't exist
+    (yet) are kept, so the graph is complete whatever order resources arrive.
+    """
+
+    def __init__(self, fields=None):
+        if fields is None:
+            fields = REFERENCE_FIELDS
+        self._fields = {rtype: [field.split(".") for field in rfields] for rtype, rfields in fields.items()}
+        self._parents = {}
+        self._children = {}
+        self._keys = {}
+        self._ids = {}
+
+    def clear(self):
+        self._parents = {}
+        self._children = {}
+        self._keys = {}
+        self._ids = {}
+
+    def add(self, key, rtype, obj):
+        """Record the references made by the resource `obj' stored at `key', replacing any previous ones"""
+        self.remove(key)
+        if not isinstance(obj, dict):
+            return
+        uid = obj.get("id") or key.rstrip("/").split("/")[-1]
+        if not isinstance(uid, string_types):
+            return
+        parents = set()
+        for parts in self._fields.get(rtype, []):
+            parents.update(self._references(obj, parts))
+        parents.discard(uid)
+
+        self._ids[key] = uid
+        self._keys.setdefault(uid, set()).add(key)
+        self._parents[uid] = parents
+        for parent in parents:
+            self._children.setdefault(parent, set()).add(uid)
+
+    def remove(self, key):
+        uid = self._ids.pop(key, None)
+        if uid is None:
+            return
+        keys = self._keys.get(uid, set())
+        keys.discard(key)
+        if keys:
+            # Still present under another key, so its references remain
+            return
+        del self._keys[uid]
+        for parent in self._parents.pop(uid, set()):
+            children = self._children.get(parent)
+            if children is not None:
+                children.discard(uid)
+                if not children:
+                    del self._children[parent]
+
+    def _references(self, obj, parts):
+        value = obj
+        for part in parts:
+            if not isinstance(value, dict):
+                return []
+            value = value.get(part)
+        if isinstance(value, list):
+            return [v for v in value if v and isinstance(v, string_types)]
+        if value and isinstance(value, string_types):
+            return [value]
+        return []
+
+    def related(self, uid, ancestry_type, generations=None):
+        """
+        Return the set of ids of the ancestors ("parents") or descendants
+        ("children") of `uid', up to `generations' away, or without limit if
+        None. The resource itself is not included.
+        """
+        edges = self._parents if ancestry_type == "parents" else self._children
+        found = set()
+        frontier = [uid]
+        generation = 0
+        while frontier and (generations is None or generation < generations):
+            generation += 1
+            next_frontier = []
+            for current in frontier:
+                for related in edges.get(current, ()):
+                    if related not in found and related != uid:
+                        found.add(related)
+                        next_frontier.append(related)
+            frontier = next_frontier
+        return found
+
+    def related_keys(self, uid, ancestry_type, generations=None):
+        """As related, but returning the keys of those resources which exist"""
+        keys = set()
+        for related in self.related(uid, ancestry_type, generations):
+            keys.update(self._keys.get(related, ()))
+        return keys
@@ -12,6 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import re
+import gevent
+import gevent.lock
+from timeit import default_timer
+
+from flask import request, g, Response
 from nmoscommon.webapi import WebAPI, route
 from nmoscommon.auth.auth_middleware import AuthMiddleware
 from nmoscommon.nmoscommonconfig import config as _config
@@ -20,6 +26,16 @@ from .v1_0 import routes as v1_0
 from .v1_1 import routes as v1_1
 from .v1_2 import routes as v1_2
 from .v1_3 import routes as v1_3
+from .registry import Registry
+from .backends import create_backend, DEFAULT_BACKEND
+from .httppool import configure_shared_pool, DEFAULT_POOL_SIZE
+from .etcd_watch import WATCH_LONG_POLL
+from .snapshot import read_snapshot, write_snapshot, SnapshotError, DEFAULT_SNAPSHOT_INTERVAL
+from .translationcache import DEFAULT_TRANSLATION_CACHE_SIZE
+from . import VALID_TYPES
+from .common.query import reg
+from .common.querysockets import FANOUT_COUNTERS
+from .metrics import REGISTRY, Counter, Gauge, Histogram, CONTENT_TYPE as METRICS_CONTENT_TYPE
 
 QUERY_APINAMESPACE = "x-nmos"
 QUERY_APINAME = "query"
@@ -27,10 +43,21 @@ QUERY_APIVERSIONS = ["v1.0", "v1.1", "v1.2", "v1.3"]
 if _config.get("https_mode", "disabled") == "enabled":
     QUERY_APIVERSIONS.remove("v1.0")
 
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    "nmosquery_request_duration_seconds", "Time taken to answer HTTP requests, until the body is started",
+    ["api_version", "route", "resource_type"]))
+REQUESTS = REGISTRY.register(Counter(
+    "nmosquery_requests_total", "HTTP requests answered", ["api_version", "route", "method", "code"]))
+
+# Seconds between checks for subscriptions deleted through other worker processes
+RECONCILE_INTERVAL = 1
+
+_VERSIONED_RULE = re.compile(r'^/{}/{}/(v[0-9]+\.[0-9]+)(/.*)$'.format(QUERY_APINAMESPACE, QUERY_APINAME))
+
 
 class QueryServiceAPI(WebAPI):
 
-    def __init__(self, logger, config):
+    def __init__(self, logger, config, subscriptions=None, write_snapshots=True):
         super(QueryServiceAPI, self).__init__()
         self.logger = logger
         self.config = config
@@ -39,18 +66,110 @@ class QueryServiceAPI(WebAPI):
         oauth_mode = config.get('oauth_mode', False)
         self.app.wsgi_app = AuthMiddleware(self.app.wsgi_app, auth_mode=oauth_mode, api_name=QUERY_APINAME)
 
-        self.api_v1_0 = v1_0.Routes(logger, config)
+        # Time every request for /metrics
+        self._route_labels = {}
+        self.app.before_request(self._start_request)
+        self.app.after_request(self._finish_request)
+
+        # A single etcd watcher and registry mirror, shared by every API version, with
+        # every call to etcd made over one pool of persistent connections
+        self.pool = configure_shared_pool(config.get('etcd_pool_size', DEFAULT_POOL_SIZE))
+        backend_name = config.get('registry_backend', DEFAULT_BACKEND)
+        backend_options = {}
+        if backend_name == "etcd2":
+            backend_options["watch_mode"] = config.get('etcd_watch_mode', WATCH_LONG_POLL)
+        backend = create_backend(backend_name, reg['host'], reg['port'], logger=logger, pool=self.pool,
+                                 **backend_options)
+        self.registry = Registry(reg['host'], reg['port'], logger=logger,
+                                 translation_cache_size=config.get('translation_cache_size',
+                                                                   DEFAULT_TRANSLATION_CACHE_SIZE),
+                                 backend=backend)
+
+        # Start warm from a snapshot of the registry mirror and subscriptions, if there is one
+        self.snapshot_path = config.get('snapshot_path')
+        self.write_snapshots = bool(self.snapshot_path) and write_snapshots
+        snapshot = None
+        if self.snapshot_path:
+            try:
+                snapshot, resources = read_snapshot(self.snapshot_path)
+            except SnapshotError as ex:
+                self.logger.writeInfo("Not starting from a snapshot: {}".format(ex))
+            else:
+                self.registry.warm_start = (snapshot["index"], resources)
+
+        self.api_v1_0 = v1_0.Routes(logger, config, registry=self.registry)
         self.add_routes(self.api_v1_0, basepath="/{}/{}/v1.0".format(QUERY_APINAMESPACE, QUERY_APINAME))
 
-        self.api_v1_1 = v1_1.Routes(logger, config)
+        self.api_v1_1 = v1_1.Routes(logger, config, registry=self.registry)
         self.add_routes(self.api_v1_1, basepath="/{}/{}/v1.1".format(QUERY_APINAMESPACE, QUERY_APINAME))
 
-        self.api_v1_2 = v1_2.Routes(logger, config)
+        self.api_v1_2 = v1_2.Routes(logger, config, registry=self.registry)
         self.add_routes(self.api_v1_2, basepath="/{}/{}/v1.2".format(QUERY_APINAMESPACE, QUERY_APINAME))
 
-        self.api_v1_3 = v1_3.Routes(logger, config)
+        self.api_v1_3 = v1_3.Routes(logger, config, registry=self.registry)
         self.add_routes(self.api_v1_3, basepath="/{}/{}/v1.3".format(QUERY_APINAMESPACE, QUERY_APINAME))
 
+        # When running as one of several worker processes, websocket subscriptions are
+        # shared with the others through a SubscriptionStore
+        self.subscriptions = subscriptions
+        if subscriptions is not None:
+            for api in self.apis():
+                api.query.query_sockets.store = subscriptions.for_version(api.api_version)
+
+        if snapshot is not None:
+            for api in self.apis():
+                api.query.query_sockets.restore(snapshot["subscriptions"].get(api.api_version, []))
+
+        # Subscriptions shared or restored are removed should no subscriber come for them (see reconcile)
+        if subscriptions is not None or snapshot is not None:
+            gevent.spawn(self._reconcile)
+        self._snapshot_state = None
+        self._snapshot_lock = gevent.lock.Semaphore()
+        if self.write_snapshots:
+            gevent.spawn(self._write_snapshots, config.get('snapshot_interval', DEFAULT_SNAPSHOT_INTERVAL))
+
+        self.registry.start()
+
+    def apis(self):
+        return [self.api_v1_0, self.api_v1_1, self.api_v1_2, self.api_v1_3]
+
+    def _reconcile(self):
+        while True:
+            gevent.sleep(RECONCILE_INTERVAL)
+            for api in self.apis():
+                try:
+                    api.query.query_sockets.reconcile()
+                except Exception as ex:
+                    self.logger.writeWarning("Failed to reconcile subscriptions: {}".format(ex))
+
+    def _write_snapshots(self, interval):
+        while True:
+            gevent.sleep(interval)
+            self.write_snapshot()
+
+    def write_snapshot(self):
+        """Write a snapshot of the registry mirror and subscriptions, if either has changed since the last"""
+        if not self.registry.seeded:
+            return
+        with self._snapshot_lock:
+            subscriptions = {api.api_version: api.query.query_sockets.records() for api in self.apis()}
+            state = (self.registry.index, subscriptions)
+            if state == self._snapshot_state:
+                return
+            index, resources = self.registry.dump()
+            try:
+                write_snapshot(self.snapshot_path, index, resources, subscriptions)
+            except (IOError, OSError) as ex:
+                self.logger.writeWarning("Could not write snapshot {}: {}".format(self.snapshot_path, ex))
+                return
+            self._snapshot_state = state
+            self.logger.writeDebug("Wrote snapshot at index {} with {} resources".format(index, len(resources)))
+
+    def stop(self):
+        if self.write_snapshots:
+            self.write_snapshot()
+        super(QueryServiceAPI, self).stop()
+
     @route('/')
     def __index(self):
         return (200, [QUERY_APINAMESPACE + "/"])
@@ -62,3 +181,82 @@ class QueryServiceAPI(WebAPI):
     @route('/' + QUERY_APINAMESPACE + '/' + QUERY_APINAME + '/')
     def __nameindex(self):
         return (200, [api_version + "/" for api_version in QUERY_APIVERSIONS])
+
+    @route('/metrics', auto_json=False)
+    def __metrics(self):
+        return Response(REGISTRY.render(self.scrape_metrics()), content_type=METRICS_CONTENT_TYPE)
+
+    def _start_request(self):
+        g.request_start = default_timer()
+
+    def _finish_request(self, response):
+        start = getattr(g, "request_start", None)
+        if start is not None:
+            rule = request.url_rule.rule if request.url_rule is not None else None
+            try:
+                api_version, route_label = self._route_labels[rule]
+            except KeyError:
+                match = _VERSIONED_RULE.match(rule or '')
+                if match is not None and match.group(1) in QUERY_APIVERSIONS:
+                    api_version, route_label = match.groups()
+                else:
+                    api_version, route_label = '', rule or 'unmatched'
+                self._route_labels[rule] = (api_version, route_label)
+            # Labels come only from fixed sets, never from the URL, so that clients can't add to the metrics
+            resource_type = (request.view_args or {}).get('ips_type', '')
+            if resource_type not in VALID_TYPES:
+                resource_type = 'other' if resource_type else ''
+            REQUEST_DURATION.labels(api_version, route_label, resource_type).observe(default_timer() - start)
+            REQUESTS.labels(api_version, route_label, request.method, str(response.status_code)).inc()
+        return response
+
+    def scrape_metrics(self):
+        """Return the metrics which are read from the state of the service as they are scraped"""
+        apis = self.apis()
+        subscriptions = Gauge("nmosquery_subscriptions", "Websocket subscriptions", ["api_version"])
+        subscribers = Gauge("nmosquery_subscribers", "Clients connected to websocket subscriptions",
+                            ["api_version"])
+        queued = Gauge("nmosquery_websocket_queued_messages", "Messages waiting to be sent to websocket subscribers",
+                       ["api_version"])
+        for api in apis:
+            sockets = list(api.query.query_sockets.sockets)
+            subscriptions.labels(api.api_version).set(len(sockets))
+            subscribers.labels(api.api_version).set(sum(len(sock.subscribers) for sock in sockets))
+            queued.labels(api.api_version).set(sum(sock.queued() for sock in sockets))
+
+        events = self.registry.watcher.events
+        queue_depth = Gauge("nmosquery_watch_queue_depth", "Events received from the store and not yet processed")
+        registry_index = Gauge("nmosquery_registry_index", "Index (revision) of the store the mirror reflects")
+        watch_lag = Gauge("nmosquery_watch_lag", "Changes to the store, in index units, not yet reflected in the "
+                          "mirror. With etcd v2 these include changes to keys other than resources.")
+        registry_index.set(self.registry.index)
+        if events is not None:
+            queue_depth.set(events.queue.qsize())
+            watch_lag.set(max(events.last_index - self.registry.index, 0) if self.registry.seeded else 0)
+
+        translations = self.registry.translations.stats()
+        translation_entries = Gauge("nmosquery_translation_cache_entries", "Resource translations cached")
+        translation_entries.set(translations["size"])
+        translation_lookups = Counter("nmosquery_translation_cache_lookups_total", "Lookups of the translation "
+                                      "cache", ["result"])
+        translation_lookups.labels("hit").inc(translations["hits"])
+        translation_lookups.labels("miss").inc(translations["misses"])
+
+        pool = self.pool.stats()
+        etcd_requests = Counter("nmosquery_etcd_requests_total", "Requests made to etcd, including watches")
+        etcd_requests.inc(pool["requests"])
+        etcd_errors = Counter("nmosquery_etcd_request_errors_total", "Requests to etcd which failed to complete")
+        etcd_errors.inc(pool["errors"])
+        etcd_connections = Gauge("nmosquery_etcd_connections", "Connections to etcd held by the pool", ["state"])
+        etcd_connections.labels("idle").set(pool["connections_idle"])
+        etcd_connections.labels("in_use").set(pool["in_flight"])
+        etcd_opened = Counter("nmosquery_etcd_connections_opened_total", "Connections to etcd opened")
+        etcd_opened.inc(pool["connections_opened"])
+
+        messages = Counter("nmosquery_websocket_messages_total", "Messages sent to websocket subscribers")
+        messages.inc(FANOUT_COUNTERS["messages"])
+        encodes = Counter("nmosquery_websocket_encodes_total", "Messages encoded for websocket subscribers")
+        encodes.inc(FANOUT_COUNTERS["encodes"])
+
+        return [subscriptions, subscribers, queued, queue_depth, registry_index, watch_lag, translation_entries,
+                translation_lookups, etcd_requests, etcd_errors, etcd_connections, etcd_opened, messages, encodes]
@@ -0,0 +1,49 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Stores of registered resources, from which the registry mirror is seeded and
+kept current. Each backend presents its contents as an etcd v2 style recursive
+GET response, and its changes as a stream of etcd v2 style watch events, so the
+rest of the service is independent of the store actually in use.
+"""
+
+from .base import RegistryBackend, ChangeStream, BackendError
+from .etcd2 import Etcd2Backend
+from .etcd3 import Etcd3Backend
+from .fake import FakeBackend
+
+BACKENDS = {
+    "etcd2": Etcd2Backend,
+    "etcd3": Etcd3Backend,
+}
+
+DEFAULT_BACKEND = "etcd2"
+
+__all__ = ["RegistryBackend", "ChangeStream", "BackendError", "Etcd2Backend", "Etcd3Backend", "FakeBackend",
+           "BACKENDS", "DEFAULT_BACKEND", "create_backend"]
+
+
+def create_backend(name, host, port, logger=None, pool=None, **options):
+    """
+    Return the backend called `name' (see BACKENDS), connecting to a store at
+    host:port through the httppool.HTTPPool `pool', or the shared pool if None.
+    Any further `options' are particular to the backend, such as Etcd2Backend's
+    watch_mode.
+    """
+    try:
+        backend = BACKENDS[name]
+    except KeyError:
+        raise ValueError("Unknown registry backend '{}', must be one of {}".format(name, ", ".join(sorted(BACKENDS))))
+    return backend(host, port, logger=logger, pool=pool, **options)
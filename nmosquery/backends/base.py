@@ -0,0 +1,68 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import gevent.queue
+
+
+class BackendError(Exception):
+    """The backend's store could not be read"""
+    pass
+
+
+class RegistryBackend(object):
+    """
+    A store holding resources under keys of the form /resource/{type}/{uid},
+    with a revision (etcd's index) which increases with every change.
+
+    Contents are given in the form of an etcd v2 recursive GET of /resource:
+
+        {"node": {"key": "/resource", "dir": True, "nodes": [
+            {"key": "/resource/flows/{uid}", "value": "{...}", "modifiedIndex": 10, "createdIndex": 9}, ...
+        ]}}
+
+    and changes as etcd v2 watch events, eg.
+
+        {"action": "set", "node": {"key": ..., "value": ..., "modifiedIndex": 11}, "prevNode": {...}}
+        {"action": "delete", "node": {"key": ..., "modifiedIndex": 12}, "prevNode": {...}}
+
+    Where a stream can't deliver every change, it sends the sentinel event
+    {"action": "index_skip", "from": ..., "to": ...} and carries on from "to".
+    """
+
+    def snapshot(self):
+        """
+        Return (tree, index): the contents of the store, as above, and the
+        revision they reflect. An empty store gives an empty dict as tree.
+        Raises BackendError if the store can't be read.
+        """
+        raise NotImplementedError()
+
+    def watch(self, since=0):
+        """Return a ChangeStream of every change made after the revision `since'"""
+        raise NotImplementedError()
+
+
+class ChangeStream(object):
+    """
+    An ordered stream of change events. `queue' is a gevent Queue, which may be
+    iterated over to receive each event in turn until the stream is stopped.
+    `last_index' is the latest revision the stream has seen the store reach.
+    """
+
+    def __init__(self):
+        self.queue = gevent.queue.Queue()
+        self.last_index = 0
+
+    def stop(self):
+        self.queue.put(StopIteration)
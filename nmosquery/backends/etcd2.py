@@ -0,0 +1,54 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from gevent import monkey
+monkey.patch_all()
+
+from nmoscommon.logger import Logger # noqa E402
+
+from .base import RegistryBackend, BackendError # noqa E402
+from ..etcd_watch import EtcdEventQueue, WATCH_LONG_POLL, _get_etcd_index # noqa E402
+from ..httppool import shared_pool # noqa E402
+
+
+class Etcd2Backend(RegistryBackend):
+    """
+    Resources held in etcd, read through its v2 keys API and watched with
+    long-polls, or a streaming watch if `watch_mode' is etcd_watch.WATCH_STREAM
+    """
+
+    def __init__(self, host, port, logger=None, pool=None, watch_mode=WATCH_LONG_POLL):
+        self.host = host
+        self.port = port
+        self.pool = pool or shared_pool()
+        self.watch_mode = watch_mode
+        self.logger = Logger("etcd2", _parent=logger)
+        self._base_url = "http://{}:{}/v2/keys/resource/".format(host, port)
+
+    def snapshot(self):
+        try:
+            response = self.pool.request('GET', self._base_url + '?recursive=true')
+        except Exception as ex:
+            raise BackendError("Could not read etcd: {}".format(ex))
+
+        if response.status_code == 404:
+            # '/resource' does not exist yet, which is a valid empty registry
+            return ({}, _get_etcd_index(response, self.logger))
+        elif response.status_code == 200:
+            return (response.json(), _get_etcd_index(response, self.logger))
+        raise BackendError("Could not read etcd: bad status_code {}".format(response.status_code))
+
+    def watch(self, since=0):
+        return EtcdEventQueue(self.host, self.port, self.logger, since=since, pool=self.pool,
+                              mode=self.watch_mode)
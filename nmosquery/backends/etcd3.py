@@ -0,0 +1,221 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from gevent import monkey
+monkey.patch_all()
+
+import base64 # noqa E402
+import json # noqa E402
+import gevent # noqa E402
+
+from nmoscommon.logger import Logger # noqa E402
+
+from .base import RegistryBackend, ChangeStream, BackendError # noqa E402
+from ..etcd_watch import _timed_out # noqa E402
+from ..httppool import shared_pool # noqa E402
+
+RESOURCE_PREFIX = "/resource/"
+
+# Number of keys read by each request making up a snapshot
+RANGE_PAGE_SIZE = 1000
+
+# Seconds without any response after which a watch is re-established. etcd sends
+# progress notifications to idle watches every 10 minutes by default, so this is
+# only reached where a watch has been lost without its connection failing.
+WATCH_TIMEOUT = 660
+
+
+def _encode(value):
+    return base64.b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def _decode(value):
+    return base64.b64decode(value).decode('utf-8')
+
+
+def _prefix_end(prefix):
+    """Return the first key after every key starting with `prefix', as used for etcd v3 range_end"""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _node(kv):
+    """Convert an etcd v3 KeyValue, from the JSON gateway, to an etcd v2 style node"""
+    node = {
+        "key": _decode(kv["key"]),
+        "modifiedIndex": int(kv.get("mod_revision", 0)),
+        "createdIndex": int(kv.get("create_revision", 0))
+    }
+    if "value" in kv:
+        node["value"] = _decode(kv["value"])
+    return node
+
+
+def translate_event(event, revision):
+    """
+    Convert an etcd v3 watch event to an etcd v2 style event. `revision' is
+    that of the watch response holding it, used where the event gives none.
+    """
+    node = _node(event["kv"])
+    node["modifiedIndex"] = node["modifiedIndex"] or revision
+    if event.get("type", "PUT") == "DELETE":
+        retval = {"action": "delete", "node": {"key": node["key"], "modifiedIndex": node["modifiedIndex"]}}
+    else:
+        retval = {"action": "set", "node": node}
+    if "prev_kv" in event:
+        retval["prevNode"] = _node(event["prev_kv"])
+    return retval
+
+
+class Etcd3Backend(RegistryBackend):
+    """
+    Resources held in etcd, read and watched through the JSON gateway to its v3
+    gRPC API. Snapshots are made up of several range reads at a single
+    revision, and watches resume from the last revision they delivered, so
+    neither depends on the store's history of past changes beyond its
+    compaction, unlike etcd v2's 1000 event limit.
+    """
+
+    def __init__(self, host, port, logger=None, pool=None, api_prefix="/v3"):
+        self.host = host
+        self.port = port
+        self.pool = pool or shared_pool()
+        self.logger = Logger("etcd3", _parent=logger)
+        self._base_url = "http://{}:{}{}".format(host, port, api_prefix)
+
+    def _post(self, path, body, **kwargs):
+        return self.pool.post(self._base_url + path, data=json.dumps(body), **kwargs)
+
+    def snapshot(self):
+        nodes = []
+        request = {
+            "key": _encode(RESOURCE_PREFIX),
+            "range_end": _encode(_prefix_end(RESOURCE_PREFIX)),
+            "limit": RANGE_PAGE_SIZE
+        }
+        revision = None
+        while True:
+            try:
+                response = self._post("/kv/range", request)
+            except Exception as ex:
+                raise BackendError("Could not read etcd: {}".format(ex))
+            if response.status_code != 200:
+                raise BackendError("Could not read etcd: bad status_code {}".format(response.status_code))
+            result = response.json()
+            kvs = result.get("kvs", [])
+            nodes.extend(_node(kv) for kv in kvs)
+            if revision is None:
+                # Later pages are read at the same revision, so together they are consistent
+                revision = int(result.get("header", {}).get("revision", 0))
+                request["revision"] = revision
+            if not result.get("more") or not kvs:
+                break
+            request["key"] = _encode(_decode(kvs[-1]["key"]) + "\x00")
+
+        if not nodes:
+            return ({}, revision)
+        return ({"node": {"key": RESOURCE_PREFIX.rstrip("/"), "dir": True, "nodes": nodes}}, revision)
+
+    def watch(self, since=0):
+        return Etcd3ChangeStream(self, since)
+
+
+class Etcd3ChangeStream(ChangeStream):
+    """
+    A watch on the etcd v3 JSON gateway, delivering v2 style events. Should the
+    watch fail, it is re-established from the revision following the last
+    delivered. If etcd has compacted away revisions which had not yet been
+    delivered, an index_skip event is sent and the watch carries on from the
+    oldest revision still available.
+
+    Progress notifications, sent to idle watches, carry the revision up to
+    which every change has been delivered, so a watch idle through a
+    compaction resumes after it rather than skipping changes it hasn't missed.
+    """
+
+    def __init__(self, backend, since=0):
+        super(Etcd3ChangeStream, self).__init__()
+        self._backend = backend
+        self._logger = backend.logger
+        self._response = None
+        self.revision = since
+        self._alive = True
+        self._greenlet = gevent.spawn(self._run)
+
+    def _run(self):
+        while self._alive:
+            try:
+                self._watch()
+            except Exception as ex:
+                if not self._alive:
+                    break
+                if _timed_out(ex):
+                    self._logger.writeDebug("etcd watch idle, resuming from {}".format(self.revision + 1))
+                    continue
+                self._logger.writeWarning("etcd watch failed, resuming from {}: {}".format(self.revision + 1, ex))
+                gevent.sleep(1)
+
+    def _watch(self):
+        request = {"create_request": {
+            "key": _encode(RESOURCE_PREFIX),
+            "range_end": _encode(_prefix_end(RESOURCE_PREFIX)),
+            "start_revision": self.revision + 1,
+            "prev_kv": True,
+            "progress_notify": True
+        }}
+        self._response = self._backend._post("/watch", request, stream=True, timeout=(5, WATCH_TIMEOUT),
+                                             long_poll=True)
+        if self._response.status_code != 200:
+            raise BackendError("bad status_code {}".format(self._response.status_code))
+        try:
+            for line in self._response.iter_lines():
+                if isinstance(line, bytes):
+                    line = line.decode('utf-8')
+                if line and not self._process(json.loads(line)):
+                    return
+        finally:
+            self._response.close()
+
+    def _process(self, message):
+        """Deliver the events in a watch response. Returns False if the watch must be re-established."""
+        if "error" in message:
+            raise BackendError("watch error: {}".format(message["error"]))
+        result = message.get("result", {})
+        compact_revision = int(result.get("compact_revision", 0))
+        if compact_revision > self.revision + 1:
+            # Changes between the last delivered and the compaction are lost
+            self._logger.writeWarning("etcd history not available; skipping {} -> {}".format(
+                self.revision, compact_revision - 1))
+            self.queue.put({"action": "index_skip", "from": self.revision, "to": compact_revision - 1})
+            self.revision = compact_revision - 1
+            return False
+        if result.get("canceled"):
+            return False
+        revision = int(result.get("header", {}).get("revision", 0))
+        self.last_index = max(self.last_index, revision)
+        events = result.get("events", [])
+        for event in events:
+            translated = translate_event(event, revision)
+            self.queue.put(translated)
+            self.revision = max(self.revision, translated["node"]["modifiedIndex"])
+        if not events and not result.get("created"):
+            # A progress notification, only sent once every change up to its revision has been
+            self.revision = max(self.revision, revision)
+        return True
+
+    def stop(self):
+        self._alive = False
+        if self._response is not None:
+            self._response.close()
+        self._greenlet.kill(timeout=5)
+        super(Etcd3ChangeStream, self).stop()
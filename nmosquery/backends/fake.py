@@ -0,0 +1,96 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from .base import RegistryBackend, ChangeStream, BackendError
+
+
+class FakeBackend(RegistryBackend):
+    """
+    An in-process store with etcd's semantics, for tests. Changes are made with
+    put() and delete(), and every change is kept (until compact() is called) so
+    that watches may start from any revision. Setting `available' to False
+    makes snapshots fail as if the store couldn't be reached.
+    """
+
+    def __init__(self, host=None, port=None, logger=None, pool=None):
+        self.revision = 0
+        self.available = True
+        self._values = {}
+        self._history = []
+        self._compacted = 0
+        self._streams = []
+
+    def put(self, key, value):
+        """Set `key' to the string `value', returning the new revision"""
+        self.revision += 1
+        prev = self._values.get(key)
+        created = prev["createdIndex"] if prev else self.revision
+        node = {"key": key, "value": value, "modifiedIndex": self.revision, "createdIndex": created}
+        self._values[key] = node
+        event = {"action": "set", "node": dict(node)}
+        if prev:
+            event["prevNode"] = dict(prev)
+        self._publish(event)
+        return self.revision
+
+    def delete(self, key):
+        """Remove `key', returning the new revision, or None if it doesn't exist"""
+        prev = self._values.pop(key, None)
+        if prev is None:
+            return None
+        self.revision += 1
+        self._publish({"action": "delete", "node": {"key": key, "modifiedIndex": self.revision},
+                       "prevNode": dict(prev)})
+        return self.revision
+
+    def compact(self, revision=None):
+        """Forget the history of changes up to and including `revision' (by default, all of it)"""
+        self._compacted = self.revision if revision is None else revision
+        self._history = [event for event in self._history if event["node"]["modifiedIndex"] > self._compacted]
+
+    def _publish(self, event):
+        self._history.append(event)
+        for stream in list(self._streams):
+            stream.last_index = self.revision
+            stream.queue.put(event)
+
+    def snapshot(self):
+        if not self.available:
+            raise BackendError("Fake backend is unavailable")
+        if not self._values:
+            return ({}, self.revision)
+        nodes = [dict(self._values[key]) for key in sorted(self._values)]
+        return ({"node": {"key": "/resource", "dir": True, "nodes": nodes}}, self.revision)
+
+    def watch(self, since=0):
+        stream = FakeChangeStream(self)
+        stream.last_index = self.revision
+        if since < self._compacted:
+            stream.queue.put({"action": "index_skip", "from": since, "to": self._compacted})
+        for event in self._history:
+            if event["node"]["modifiedIndex"] > since:
+                stream.queue.put(event)
+        self._streams.append(stream)
+        return stream
+
+
+class FakeChangeStream(ChangeStream):
+    def __init__(self, backend):
+        super(FakeChangeStream, self).__init__()
+        self._backend = backend
+
+    def stop(self):
+        if self in self._backend._streams:
+            self._backend._streams.remove(self)
+        super(FakeChangeStream, self).stop()
@@ -13,27 +13,41 @@
 # limitations under the License.
 
 import gevent
-from .etcd_watch import EtcdEventQueue
+import gevent.event
 
 
 class ChangeWatcher(gevent.Greenlet):
-    def __init__(self, host, port, handler, logger):
+    def __init__(self, backend, handler, logger):
         gevent.Greenlet.__init__(self)
-        self.host = host
-        self.port = port
+        self.backend = backend
         self.handler = handler
         self.logger = logger
         self.events = None
+        # Set once the handler is seeded and changes from that point are being watched for
+        self.watching = gevent.event.Event()
+
+    def _seed(self, secs):
+        # Snapshot the registry before watching, so that the watch can resume from
+        # the index the snapshot reflects without missing or repeating any events
+        retries = 0
+        since = self.handler.seed()
+        while since is None and self.running:
+            retries = min(retries + 1, len(secs) - 1)
+            gevent.sleep(secs[retries])
+            since = self.handler.seed()
+        return since
 
     def _run(self):
         retries = 0
         secs = [0, 1, 3, 10]  # incrementing retry sleep
-        self.events = EtcdEventQueue(self.host, self.port, self.logger)
         self.running = True
+        since = self._seed(secs)
+        self.events = self.backend.watch(since=since or 0)
+        self.watching.set()
         while self.running:
             try:
                 # Wait for queued events, and process each. This "blocks" until
-                # the event queue is drained (see etcd_watch.EtcdEventQueue.stop)
+                # the event queue is drained (see backends.ChangeStream.stop)
                 for event in self.events.queue:
                     self.handler._process_response(event)
 
@@ -44,7 +58,7 @@ class ChangeWatcher(gevent.Greenlet):
                     # At this point, the registry has probably died, so disconnect any client websockets
                     # TODO: really?
                     self.logger.writeError('Disconnecting all subscribed WebSocket clients')
-                    self.handler.query_sockets.del_all_socks()
+                    self.handler.del_all_socks()
                 self.logger.writeError('comms err: {}'.format(e))
                 gevent.sleep(secs[retries])
 
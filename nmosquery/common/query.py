@@ -17,10 +17,10 @@ monkey.patch_all()
 
 import json # noqa E402
 import os # noqa E402
-import requests # noqa E402
 import socket as socketlib # noqa E402 # To avoid namespace clashes
 import uuid # noqa E402
 import copy # noqa E402
+import hashlib # noqa E402
 from six import string_types # noqa E402
 
 from nmoscommon.logger import Logger # noqa E402
@@ -28,31 +28,43 @@ from nmoscommon.utils import translate_api_version # noqa E402
 
 from ..util import translate_resourcetypes, get_resourcetypes # noqa E402
 from .. import VALID_TYPES # noqa E402
-from ..changewatcher import ChangeWatcher # noqa E402
+from .. import projection # noqa E402
+from ..registry import Registry # noqa E402
+from ..backends import BackendError # noqa E402
 from ..etcd_util import etcd_unpack # noqa E402
+from ..paging import TimeOrder, paginate, resource_timestamp, DEFAULT_PAGING_LIMIT # noqa E402
 from ..grainevent import GrainEvent # noqa E402
 from .querysockets import QuerySocketsCommon, QueryFilterCommon # noqa E402
 
 reg = {'host': 'localhost', 'port': 2379}
 WS_PORT = 8870
 
+# Most resources sent in each message of a subscription's initial sync
+SYNC_GRAINS_PER_MESSAGE = 100
+
 
 class QueryCommon(object):
 
-    def __init__(self, logger=None, api_version="v1.0"):
+    def __init__(self, logger=None, api_version="v1.0", registry=None):
         self.logger = Logger("regquery", _parent=logger)
         self.query_sockets = QuerySocketsCommon(WS_PORT, logger=self.logger)
 
-        # there is a choice here: watch at specific top levels (if flat), or watch all data.
-        # initially, watch all data - this may be less than ideal.
-        self.watcher = ChangeWatcher(reg['host'], reg['port'], handler=self, logger=self.logger)
-        self.watcher.start()
+        # local copy of the registry, kept current by its watcher and shared by all
+        # API versions when supplied. Without one, this instance watches for itself.
+        self._owns_registry = registry is None
+        if self._owns_registry:
+            registry = Registry(reg['host'], reg['port'], logger=self.logger)
+        self.registry = registry
+        self.registry.add_listener(self)
+        if self._owns_registry:
+            self.registry.start()
 
         self.api_version = api_version
 
     def _cleanup(self):
-        self.watcher.stop()
-        self.watcher.join(timeout=5)
+        self.registry.remove_listener(self)
+        if self._owns_registry:
+            self.registry.stop()
 
     # generates a predictable UID for this process
     def gen_source_id(self):
@@ -76,32 +88,14 @@ class QueryCommon(object):
     # extract objects of given types that also match supplied url and args
     def _match_nodes(self, obj, pattern, args, verbose):
         retval = []
+        matches_args = self._compile_args(args)
+        downgrade_ver = self._downgrade_version(args)
 
         for k, v in obj.items():
             if any(rtype in k for rtype in VALID_TYPES) and isinstance(v, string_types):
                 if self._matches_path(k, pattern):
-                    downgrade_ver = None
-                    if args and "query.downgrade" in args:
-                        downgrade_ver = args["query.downgrade"]
-
-                    # Downgrade / convert any mis-versioned objects as required
-                    resource_type = get_resourcetypes(k).replace("/", "")
-                    json_repr = None
-                    if resource_type != "":
-                        json_repr = json.loads(v)
-                        json_repr = translate_api_version(
-                            json_repr,
-                            resource_type,
-                            self.api_version, downgrade_ver
-                        )
-
-                    # If nothing could be downgraded, skip over the object
-                    if not json_repr:
-                        continue
-
-                    node = self._summarise(json_repr)
-
-                    if self._matches_args(node, args):
+                    node = self._match_node(k, json.loads(v), downgrade_ver, matches_args)
+                    if node is not None:
                         if verbose:
                             retval.append(node)
                         else:
@@ -113,14 +107,71 @@ class QueryCommon(object):
 
         return retval
 
+    # as _match_nodes, for decoded resources held by the registry mirror
+    def _match_objects(self, resources, args, verbose):
+        return list(self._iter_objects(resources, args, verbose))
+
+    # generate the matches of _match_objects one at a time. The modifiedIndex of each resource
+    # may be given as `modified', in case the registry changes while this is in progress.
+    def _iter_objects(self, resources, args, verbose, modified=None):
+        matches_args = self._compile_args(args)
+        downgrade_ver = self._downgrade_version(args)
+        if modified is None:
+            modified = self.registry.get_modified_index
+
+        for key, obj in resources.items():
+            node = self._match_node(key, obj, downgrade_ver, matches_args, modified(key))
+            if node is not None:
+                if verbose:
+                    yield node
+                else:
+                    yield node['id']
+
+    def _downgrade_version(self, args):
+        if args and "query.downgrade" in args:
+            return args["query.downgrade"]
+        return None
+
+    # return a single decoded resource in presentable form if it matches, or None
+    def _match_node(self, key, obj, downgrade_ver, matches_args, modified_index=None):
+        node = self._translate(key, obj, downgrade_ver, modified_index)
+        if node is not None and matches_args(node):
+            return node
+        return None
+
+    # Return a resource in presentable form for this API version, or None if it can't be presented.
+    # Results are cached by the registry, so are shared and must not be modified.
+    def _translate(self, key, obj, downgrade_ver, modified_index=None):
+        def translate():
+            # Downgrade / convert any mis-versioned objects as required
+            resource_type = get_resourcetypes(key).replace("/", "")
+            json_repr = None
+            if resource_type != "" and obj is not None:
+                json_repr = translate_api_version(
+                    obj,
+                    resource_type,
+                    self.api_version, downgrade_ver
+                )
+
+            # If nothing could be downgraded, skip over the object
+            if not json_repr:
+                return None
+
+            return self._summarise(json_repr)
+
+        return self.registry.translations.get(key, modified_index, self.api_version, downgrade_ver, translate)
+
     # see if href matches supplied regex
     def _matches_path(self, href, pattern):
         return pattern is None or pattern in href
 
     # see if object matches supplied arguments
     def _matches_args(self, obj, args):
-        arg_checker = QueryFilterCommon()
-        return arg_checker.check_args(args, obj)
+        return self._compile_args(args)(obj)
+
+    # compile supplied arguments into a predicate on objects
+    def _compile_args(self, args):
+        return QueryFilterCommon().compile(args)
 
     # summarise service in a presentable way
     def _summarise(self, json_repr):
@@ -133,45 +184,117 @@ class QueryCommon(object):
 
         return json_repr
 
-    def _process_response(self, response):
-        """
-        Process a response from a GET long-poll on etcd (watch).
-        `response' is a dict, decoded from JSON.
-        """
-        self.logger.writeDebug('process response {} {}'.format(self.api_version, response))
-        if response['action'] == 'set' or response['action'] == 'delete':
-            unpacked = etcd_unpack(response)
-            for k, v in unpacked.items():
-                restype = get_resourcetypes(k)
-
-                if restype in VALID_TYPES:
-                    post_obj = {}
-                    pre_obj = {}
-                    if v:
-                        post_obj = json.loads(v.get('node', '{}'))
-                        pre_obj = json.loads(v.get('prevNode', '{}'))
-                    if response['action'] == 'set' and pre_obj != post_obj:
-                        self.do_sup(k, pre_obj, post_obj)
-                    elif response['action'] == 'delete':
-                        self.do_sdown(k, pre_obj, post_obj)
-                else:
-                    self.logger.writeError("Invalid type '{}' in response.".format(restype))
-
     # Queries
     # get data for supplied path
     def get_data_for_path(self, path, args):
 
         # Set verbosity
         verbose = (args.get('verbose', '').lower() != 'false')
+        data = self._get_data(path, args, verbose)
+        if verbose:
+            return self._project(data, args)
+        return data
+
+    def iter_data_for_path(self, path, args):
+        """
+        As get_data_for_path, but generating the matching resources one at a
+        time, so that they may be encoded as they are found. The resources to
+        be examined are fixed when the generator is created.
+        """
+        verbose = (args.get('verbose', '').lower() != 'false')
+        project = projection.for_args(args) if verbose else None
+        if not self.registry.seeded:
+            items = iter(self._get_data(path, args, verbose) or [])
+        else:
+            resources = self.registry.get_resources(path, args)
+            modified = {key: self.registry.get_modified_index(key) for key in resources}
+            items = self._iter_objects(resources, args, verbose, modified.get)
+        if project is not None:
+            return (project(item) for item in items)
+        return items
+
+    def _project(self, nodes, args):
+        """
+        Reduce resources to the fields selected by any 'query.fields' argument.
+        This is done last, once resources have been filtered and ordered using
+        every field, and makes copies, leaving the cached resources untouched.
+        """
+        project = projection.for_args(args)
+        if project is None or not nodes:
+            return nodes
+        return [project(node) for node in nodes]
+
+    def get_etag(self, path, args):
+        """
+        Return an entity tag for the response to a query of `path' with `args',
+        which changes whenever the registry mirror changes in a way which could
+        alter that response, or None if the mirror isn't yet available. Single
+        resources are tagged by their own etcd modifiedIndex and collections by
+        the index of the mirror as a whole, so no data is read to produce it.
+        """
+        if not self.registry.seeded:
+            return None
+        resource_path = translate_resourcetypes(path)
+        if '/' in resource_path:
+            index = self.registry.get_modified_index('/resource/' + resource_path)
+            if index is None:
+                return None
+        else:
+            index = self.registry.index
+        if hasattr(args, "items") and hasattr(args, "getlist"):
+            items = args.items(multi=True)
+        else:
+            items = (args or {}).items()
+        tag = json.dumps([self.api_version, resource_path, index, sorted(items)])
+        return hashlib.sha1(tag.encode('utf-8')).hexdigest()
+
+    def _get_data(self, path, args, verbose):
+        if self.registry.seeded:
+            return self._match_objects(self.registry.get_resources(path, args), args, verbose)
 
-        url = 'http://%s:%i/v2/keys/resource/?recursive=true' % (reg['host'], reg['port'])
-        response = requests.request('GET', url, proxies={'http': ''})
-        if response.status_code != 200:
-            self.logger.writeError('bad status_code %i' % response.status_code)
+        # Mirror not yet available, so fall back to reading everything from the store
+        try:
+            tree, _ = self.registry.backend.snapshot()
+        except BackendError as ex:
+            self.logger.writeError('Could not read registry: {}'.format(ex))
             return None
 
+        return self.parse_services_dict(tree, path, args, verbose)
+
+    def get_page_for_path(self, path, args, order="update", since=None, until=None, limit=DEFAULT_PAGING_LIMIT):
+        """
+        Get one page of the resource collection at `path', in creation or update
+        order. See paging.paginate for the meaning of since, until and limit.
+        """
+        verbose = (args.get('verbose', '').lower() != 'false')
+        resource_type = translate_resourcetypes(path)
+
+        if self.registry.seeded:
+            matches_args = self._compile_args(args)
+            downgrade_ver = self._downgrade_version(args)
+            candidates = self.registry.candidates(resource_type, args)
+
+            def resolve(key):
+                if candidates is not None and key not in candidates:
+                    return None
+                return self._match_node(key, self.registry.get_value(key), downgrade_ver, matches_args,
+                                        self.registry.get_modified_index(key))
+
+            time_order = self.registry.get_order(resource_type, order)
+        else:
+            # Mirror not yet available, so order a full fetch by resource version instead
+            nodes = self._get_data(path, args, True) or []
+            time_order = TimeOrder()
+            for pos, node in enumerate(nodes):
+                time_order.add(resource_timestamp(node), pos)
+            resolve = nodes.__getitem__
+
+        page = paginate(time_order, resolve, since, until, limit)
+        if not verbose:
+            page.items = [node['id'] for node in page.items]
         else:
-            return self.parse_services_dict(json.loads(response.text), path, args, verbose)
+            page.items = self._project(page.items, args)
+        return page
 
     def get_ws_subscribers(self, socket_id=None):
         obj = None
@@ -190,42 +313,52 @@ class QueryCommon(object):
         return res
 
     def do_sync(self, ws, socket):
-        # HTTP GET on etcd registry at top level
-        path = translate_resourcetypes(socket.resource_path)
-        url = 'http://{}:{}/v2/keys/resource/{}?recursive=true'.format(reg['host'], reg['port'], path)
-
-        event = GrainEvent()
-        event.source_id = self.gen_source_id()
-        event.topic = socket.resource_path
-        event.flow_id = socket.uuid
-
-        # TODO: could get expensive with lots of flows...
+        """
+        Send a new subscriber `ws' the current state of the resources matching
+        its subscription, then any changes held back while doing so (see
+        QuerySocketCommon.add_subscriber). The state is read from the registry
+        mirror at once, before anything else can change it, so that it follows
+        on exactly from the changes the subscriber has been sent. It is sent as
+        a series of grain events of at most SYNC_GRAINS_PER_MESSAGE resources.
+        """
         try:
-            r = requests.request('GET', url, proxies={'http': ''})
-            if r.status_code not in [200, 404]:
-                err = {"type": "error", "data": "{} getting resources of topic {}".format(r.status_code, path)}
-                ws.send(json.dumps(err))
-                return err
-
-            obj = json.loads(r.text)
-            unpacked = etcd_unpack(obj)
-            nodes = self._match_nodes(unpacked, path, socket.params, verbose=True)
-
-            for node in nodes:
-                event.addGrainFromObj(pre_obj=node, post_obj=node)
-            ws.send(json.dumps(event.obj()))
+            if self.registry.seeded:
+                # Already decoded and held locally
+                nodes = self._get_data(socket.resource_path, socket.params, True)
+            else:
+                try:
+                    tree, _ = self.registry.backend.snapshot()
+                except BackendError as ex:
+                    err = {"type": "error", "data": "{} getting resources of topic {}".format(
+                        ex, translate_resourcetypes(socket.resource_path))}
+                    socket.send(ws, json.dumps(err))
+                    socket.end_sync(ws)
+                    return err
+                nodes = self.parse_services_dict(tree, socket.resource_path, socket.params, True)
+            nodes = [self.query_sockets._project(socket, node) for node in nodes]
+
+            source_id = self.gen_source_id()
+            for start in range(0, max(len(nodes), 1), SYNC_GRAINS_PER_MESSAGE):
+                event = GrainEvent()
+                event.source_id = source_id
+                event.topic = socket.resource_path
+                event.flow_id = socket.uuid
+                for node in nodes[start:start + SYNC_GRAINS_PER_MESSAGE]:
+                    event.addGrainFromObj(pre_obj=node, post_obj=node)
+                socket.send(ws, json.dumps(event.obj()))
+            socket.end_sync(ws)
 
         except Exception as err:
             self.logger.writeError('Exception in do_sync: {}'.format(err))
+            socket.end_sync(ws, send=False)
 
-    def do_sup(self, path, pre_obj, post_obj):
+    def do_sup(self, path, pre_obj, post_obj, pre_index=None, post_index=None):
         self.logger.writeDebug('do_sup {} {}'.format(self.api_version, path))
         if post_obj == pre_obj:
             return
         sockets = self.query_sockets.find_socks(path=path, obj=post_obj, p_obj=pre_obj)
-        event = GrainEvent()
-        event.source_id = self.gen_source_id()
-        event.topic = get_resourcetypes(path)
+        source_id = self.gen_source_id()
+        topic = get_resourcetypes(path)
         for socket in sockets:
             self.logger.writeDebug('next ws ' + socket.ws_href)
 
@@ -233,42 +366,32 @@ class QueryCommon(object):
             if socket.params and "query.downgrade" in socket.params:
                 downgrade_ver = socket.params["query.downgrade"]
 
-            socket_post_obj = translate_api_version(
-                post_obj,
-                event.topic.replace("/", ""),
-                self.api_version, downgrade_ver
-            )
-
-            socket_pre_obj = translate_api_version(
-                pre_obj,
-                event.topic.replace("/", ""),
-                self.api_version, downgrade_ver
-            )
+            socket_post_obj = self._translate(path, post_obj, downgrade_ver, post_index)
+            socket_pre_obj = self._translate(path, pre_obj, downgrade_ver, pre_index)
 
-            if not socket_post_obj and not socket_pre_obj:
+            if socket_post_obj is None and socket_pre_obj is None:
                 continue
 
-            socket_post_obj = self._summarise(socket_post_obj)
-            socket_pre_obj = self._summarise(socket_pre_obj)
-
-            event.flow_id = socket.uuid
-            event.clearGrains()
-            if socket_pre_obj is None or not self._matches_args(socket_pre_obj, socket.params):
+            project = self.query_sockets._project
+            if socket_pre_obj is None or not self.query_sockets._check_args(socket, socket_pre_obj):
                 # Didn't previously match filter, so should be returned
-                event.addGrainFromObj(pre_obj=None, post_obj=socket_post_obj)
-            elif socket_post_obj is None or not self._matches_args(socket_post_obj, socket.params):
+                socket.queue_grain(source_id, topic, pre_obj=None, post_obj=project(socket, socket_post_obj))
+            elif socket_post_obj is None or not self.query_sockets._check_args(socket, socket_post_obj):
                 # Doesn't match filter any longer, so shouldn't be returned
-                event.addGrainFromObj(pre_obj=socket_pre_obj, post_obj=None)
+                socket.queue_grain(source_id, topic, pre_obj=project(socket, socket_pre_obj), post_obj=None)
             else:
-                event.addGrainFromObj(pre_obj=socket_pre_obj, post_obj=socket_post_obj)
-            socket.notify_subscribers(event.obj())
-
-    def do_sdown(self, path, pre_obj, post_obj):
+                socket_pre_obj = project(socket, socket_pre_obj)
+                socket_post_obj = project(socket, socket_post_obj)
+                if socket_pre_obj == socket_post_obj:
+                    # Only fields the subscriber hasn't asked for have changed
+                    continue
+                socket.queue_grain(source_id, topic, pre_obj=socket_pre_obj, post_obj=socket_post_obj)
+
+    def do_sdown(self, path, pre_obj, post_obj, pre_index=None, post_index=None):
         self.logger.writeDebug('do_sdown {} {}'.format(self.api_version, path))
         sockets = self.query_sockets.find_socks(path=path, obj=post_obj, p_obj=pre_obj)
-        event = GrainEvent()
-        event.source_id = self.gen_source_id()
-        event.topic = get_resourcetypes(path)
+        source_id = self.gen_source_id()
+        topic = get_resourcetypes(path)
         for socket in sockets:
             self.logger.writeDebug('next ws ' + socket.ws_href)
 
@@ -276,19 +399,9 @@ class QueryCommon(object):
             if socket.params and "query.downgrade" in socket.params:
                 downgrade_ver = socket.params["query.downgrade"]
 
-            socket_pre_obj = translate_api_version(
-                pre_obj,
-                event.topic.replace("/", ""),
-                self.api_version, downgrade_ver
-            )
-
-            if not socket_pre_obj:
+            socket_pre_obj = self._translate(path, pre_obj, downgrade_ver, pre_index)
+            if socket_pre_obj is None:
                 continue
 
-            socket_pre_obj = self._summarise(socket_pre_obj)
-
-            event.flow_id = socket.uuid
-            event.clearGrains()
-            event.addGrainFromObj(pre_obj=socket_pre_obj, post_obj=None)
-
-            socket.notify_subscribers(event.obj())
+            socket.queue_grain(source_id, topic, pre_obj=self.query_sockets._project(socket, socket_pre_obj),
+                               post_obj=None)
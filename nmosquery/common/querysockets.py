@@ -15,13 +15,126 @@
 # limitations under the License.
 
 import json
+import time
 import uuid
 import socket
+import gevent
+import gevent.event
+from collections import OrderedDict, deque
 
 import nmosquery.util as util
+import nmosquery.rql as rql
+import nmosquery.projection as projection
+from nmosquery.subscriptionindex import SubscriptionIndex
+from nmosquery.grainevent import GrainEvent
+from nmosquery.metrics import REGISTRY, Counter
 from nmoscommon.utils import getLocalIP
 from nmoscommon import nmoscommonconfig
 
+try:
+    from geventwebsocket.websocket import WebSocket, Header
+except ImportError:  # pragma: no cover
+    WebSocket = None
+
+# Maximum number of compiled filters held in the predicate cache
+PREDICATE_CACHE_SIZE = 1024
+
+_predicate_cache = {}
+_MISS = object()
+
+# Totals across all subscriptions of messages sent to subscribers, and of the JSON
+# encodes and websocket frames needed to send them
+FANOUT_COUNTERS = {"messages": 0, "encodes": 0, "encodes_saved": 0, "frames": 0}
+
+WEBSOCKET_SENT_BYTES = REGISTRY.register(Counter(
+    "nmosquery_websocket_sent_bytes_total", "Bytes of messages sent to websocket subscribers", ["api_version"]))
+WEBSOCKET_OVERFLOWS = REGISTRY.register(Counter(
+    "nmosquery_websocket_overflows_total", "Subscribers which fell too far behind, by whether they were resynced "
+    "or disconnected", ["api_version", "action"]))
+
+# Maximum number of change messages waiting to be sent to a subscriber before it is judged
+# to have fallen too far behind, and is resynced or, failing that, disconnected
+SEND_QUEUE_LIMIT = 100
+
+# Seconds a non-persistent subscription may go without a subscriber after it is restored, or
+# created or adopted while shared between workers, before it is removed
+UNCLAIMED_EXPIRY = 30
+
+# Queued after a resync, marking the point at which the subscriber has caught up
+_RESYNCED = object()
+
+
+class SubscriberWriter(object):
+    """
+    The outbound queue of a single websocket subscriber, drained in order by
+    a greenlet of its own, so that a slow client holds up nobody but itself
+    and messages can be queued without blocking. `changes' counts the change
+    messages waiting, by which the client's lag is judged, as opposed to
+    parts of a sync. Once a write fails the connection is taken to be lost,
+    and anything more queued is dropped until the subscriber is removed.
+    """
+
+    def __init__(self, ws, api_version, logger, resync=None):
+        self.ws = ws
+        self.api_version = api_version
+        self.logger = logger
+        self.resync = resync
+        self.resyncing = False
+        self.failed = False
+        self.queue = deque()
+        self.changes = 0
+        self._ready = gevent.event.Event()
+        self._greenlet = gevent.spawn(self._run)
+
+    def put(self, message, frame=None, change=False, obj=None):
+        """
+        Queue an encoded message, and optionally the websocket frame which holds
+        it. `obj' is the message before encoding, should it be dropped (see clear).
+        """
+        if self.failed:
+            return
+        self.queue.append((message, frame, change, obj))
+        if change:
+            self.changes += 1
+        self._ready.set()
+
+    def clear(self):
+        """Drop everything queued, returning the unencoded change messages dropped, where known"""
+        dropped = [obj for _, _, change, obj in self.queue if change and obj is not None]
+        self.queue.clear()
+        self.changes = 0
+        return dropped
+
+    def stop(self):
+        self.clear()
+        self._greenlet.kill(block=False)
+
+    def _run(self):
+        while True:
+            if not self.queue:
+                self._ready.clear()
+                self._ready.wait()
+                continue
+            message, frame, change, _ = self.queue.popleft()
+            if change:
+                self.changes -= 1
+            if message is _RESYNCED:
+                self.resyncing = False
+                continue
+            try:
+                if frame is not None and not self.ws.closed:
+                    self.ws.raw_write(frame)
+                    sent = len(frame)
+                else:
+                    self.ws.send(message)
+                    sent = len(message)
+            except Exception as ex:
+                self.logger.writeDebug("Failed to send to subscriber {}: {}".format(self.ws, ex))
+                self.failed = True
+                self.clear()
+                return
+            WEBSOCKET_SENT_BYTES.labels(self.api_version).inc(sent)
+
 
 class QuerySocketCommon(object):
     def __init__(self, resource_path, ws_port, rate=100, persist=False,
@@ -39,6 +152,22 @@ class QuerySocketCommon(object):
         self.params = params
         self.max_update_rate_ms = rate
         self.persist = persist
+        self.predicate = None  # compiled from params on first use
+        self.projection = None  # likewise
+
+        # Changes waiting to be sent, by (topic, resource id), as (pre, post) pairs
+        self.pending = OrderedDict()
+        self.source_id = '0000-0000-0000-0000'
+        self._flusher = None
+        self._last_flush = 0
+
+        # Messages held back from subscribers until their initial sync has been sent
+        self._syncing = {}
+
+        # Outbound queues, by subscriber, and subscribers found to have fallen too far behind
+        self._writers = {}
+        self._overflowed = []
+        self._batch = False
 
     def gen_ws_href(self):
         scheme = "ws"
@@ -55,27 +184,279 @@ class QuerySocketCommon(object):
 
         return '{}://{}/x-nmos/query/{}/ws/?uid={}'.format(scheme, host, self.api_version, self.uuid)
 
-    def add_subscriber(self, ws):
+    def add_subscriber(self, ws, syncing=False, resync=None):
+        """
+        Add a subscriber. If `syncing', it is about to be sent an initial sync
+        of the current state, so messages for it are held back until end_sync
+        is called, and changes already buffered, which that state will include,
+        are sent to the existing subscribers alone. The state must be read
+        before anything else runs, so that no change is missed or sent twice.
+
+        Messages are sent to each subscriber from a queue of its own (see
+        SubscriberWriter). Should one fall more than SEND_QUEUE_LIMIT changes
+        behind, `resync', if given, is called as resync(ws, socket) to send it
+        the current state again in place of what it is waiting for, in the
+        same way as an initial sync, after the removals among what it was
+        waiting for (see _removals). A subscriber which falls behind again
+        before catching up, or which can't be resynced, is disconnected.
+        """
         self.logger.writeDebug('add_subscriber')
+        if syncing:
+            self._hold(ws)
+        self._writers[ws] = SubscriberWriter(ws, self.api_version, self.logger, resync)
         self.subscribers.append(ws)
         self.logger.writeDebug('There are {} subscribers'.format(len(self.subscribers)))
 
+    def _hold(self, ws):
+        if self.pending:
+            events = self._take_pending()
+            subscribers = [subscriber for subscriber in self.subscribers if subscriber is not ws]
+            gevent.spawn(self._notify_events, events, subscribers)
+        self._syncing[ws] = []
+
+    def remove_subscriber(self, ws):
+        """Remove a subscriber whose connection has closed, returning False if it had already gone"""
+        self._syncing.pop(ws, None)
+        writer = self._writers.pop(ws, None)
+        if writer is not None:
+            writer.stop()
+        if ws not in self.subscribers:
+            return False
+        self.subscribers.remove(ws)
+        return True
+
+    def end_sync(self, ws, send=True):
+        """Send a subscriber the messages held back during its initial sync, and then carry on as normal"""
+        held = self._syncing.pop(ws, None)
+        writer = self._writer(ws)
+        if not send or not held or writer is None:
+            return
+        for message in held:
+            writer.put(message, change=True)
+        if writer.changes > SEND_QUEUE_LIMIT:
+            self._overflowed.append(ws)
+            if not self._batch:
+                self._handle_overflows()
+
+    def send(self, ws, message):
+        """Queue an encoded message for a single subscriber"""
+        writer = self._writer(ws)
+        if writer is not None:
+            writer.put(message)
+        else:
+            ws.send(message)
+            WEBSOCKET_SENT_BYTES.labels(self.api_version).inc(len(message))
+
+    def _writer(self, ws):
+        writer = self._writers.get(ws)
+        if writer is None and ws in self.subscribers:
+            writer = self._writers[ws] = SubscriberWriter(ws, self.api_version, self.logger)
+        return writer
+
+    def queued(self):
+        """Return the number of messages waiting to be sent to subscribers"""
+        return sum(len(writer.queue) for writer in list(self._writers.values()))
+
     def del_subscribers(self):
+        if self._flusher is not None:
+            self._flusher.kill(block=False)
+            self._flusher = None
+        self.pending.clear()
+        self._syncing = {}
+        self._overflowed = []
+        for writer in self._writers.values():
+            writer.stop()
+        self._writers = {}
         for ws in self.subscribers:
             ws.close()
         self.subscribers = []
 
-    def notify_subscribers(self, obj):
-        for ws in self.subscribers:
-            ws.send(json.dumps(obj))
+    def notify_subscribers(self, obj, subscribers=None):
+        """
+        Queue obj for every subscriber, or those given. It is encoded once, and
+        where subscribers are gevent-websocket connections the websocket frame
+        is also built once and written to each of them as it is.
+        """
+        if subscribers is None:
+            subscribers = self.subscribers
+        if not subscribers:
+            return
+        message = json.dumps(obj)
+        frame = None
+        queued = 0
+        for ws in list(subscribers):
+            if ws in self._syncing:
+                self._syncing[ws].append(message)
+                continue
+            writer = self._writer(ws)
+            if writer is None or ws in self._overflowed:
+                continue
+            if WebSocket is not None and isinstance(ws, WebSocket):
+                if frame is None:
+                    frame = encode_frame(message)
+                    FANOUT_COUNTERS["frames"] += 1
+                writer.put(message, frame, change=True, obj=obj)
+            else:
+                writer.put(message, change=True, obj=obj)
+            queued += 1
+            if writer.changes > SEND_QUEUE_LIMIT:
+                self._overflowed.append(ws)
+        # Counting only the subscribers queued the message now, not those it is held back from or skipping
+        FANOUT_COUNTERS["messages"] += queued
+        FANOUT_COUNTERS["encodes"] += 1
+        FANOUT_COUNTERS["encodes_saved"] += max(queued - 1, 0)
+        if not self._batch:
+            self._handle_overflows()
+
+    def _handle_overflows(self):
+        """Resync, or failing that disconnect, the subscribers found to have fallen too far behind"""
+        overflowed, self._overflowed = self._overflowed, []
+        for ws in overflowed:
+            writer = self._writers.get(ws)
+            if writer is None:
+                continue
+            if writer.resync is None or writer.resyncing:
+                self.disconnect(ws)
+                continue
+            self.logger.writeWarning("Subscriber to {} fell {} changes behind, resyncing".format(
+                self.uuid, writer.changes))
+            WEBSOCKET_OVERFLOWS.labels(self.api_version, "resync").inc()
+            removals = self._removals(writer.clear())
+            writer.resyncing = True
+            self._hold(ws)
+            # The resync holds only what there is now, so tell of what went away in the changes dropped first
+            for event in removals:
+                writer.put(json.dumps(event.obj()))
+            writer.resync(ws, self)
+            writer.put(_RESYNCED)
+
+    def _removals(self, dropped):
+        """
+        Return grain events, one per topic, of the resources removed by the
+        grain events `dropped', which may be followed by their sync should they
+        be back again. Any other changes they held are in that sync.
+        """
+        removed = OrderedDict()
+        for obj in dropped:
+            grain = obj.get("grain", {}) if isinstance(obj, dict) else {}
+            for data in grain.get("data", []):
+                if data.get("post") is None and data.get("pre") is not None:
+                    removed[(grain.get("topic", ""), data.get("path", ""))] = data["pre"]
+        events = OrderedDict()
+        for (topic, _), pre_obj in removed.items():
+            if topic not in events:
+                event = GrainEvent()
+                event.source_id = self.source_id
+                event.flow_id = self.uuid
+                event.topic = topic
+                events[topic] = event
+            events[topic].addGrainFromObj(pre_obj=pre_obj)
+        return list(events.values())
+
+    def disconnect(self, ws):
+        """Remove a subscriber which can't keep up, and close its connection"""
+        self.logger.writeWarning("Subscriber to {} fell too far behind, disconnecting".format(self.uuid))
+        WEBSOCKET_OVERFLOWS.labels(self.api_version, "disconnect").inc()
+        self.remove_subscriber(ws)
+        gevent.spawn(_close, ws)
+
+    def queue_grain(self, source_id, topic, pre_obj=None, post_obj=None):
+        """
+        Buffer a change to a resource for subscribers. Buffered changes are sent
+        together, at most once every max_update_rate_ms, and repeated changes to
+        the same resource within that time are collapsed into a single grain
+        running from the first pre to the last post.
+        """
+        self.source_id = source_id
+        uid = (post_obj if post_obj is not None else pre_obj or {}).get('id', '')
+        key = (topic, uid)
+        if key in self.pending:
+            pre_obj = self.pending[key][0]
+        if pre_obj is None and post_obj is None:
+            # Appeared and went away again before anyone was told
+            self.pending.pop(key, None)
+        else:
+            self.pending[key] = (pre_obj, post_obj)
+
+        if self._flusher is None:
+            delay = self._last_flush + self._rate_secs() - time.time()
+            if delay > 0:
+                self._flusher = gevent.spawn_later(delay, self.flush)
+            else:
+                self._flusher = gevent.spawn(self.flush)
+
+    def _rate_secs(self):
+        try:
+            return max(float(self.max_update_rate_ms), 0) / 1000.0
+        except (TypeError, ValueError):
+            return 0.1
+
+    def flush(self):
+        """Send all buffered changes, as one grain event per topic"""
+        self._flusher = None
+        self._notify_events(self._take_pending())
+
+    def _take_pending(self):
+        """Remove all buffered changes, returning them as one grain event per topic"""
+        if self._flusher is not None:
+            # Taken early, so there's nothing left for the flusher to send
+            self._flusher.kill(block=False)
+            self._flusher = None
+        self._last_flush = time.time()
+        events = OrderedDict()
+        for (topic, uid), (pre_obj, post_obj) in self.pending.items():
+            if topic not in events:
+                event = GrainEvent()
+                event.source_id = self.source_id
+                event.flow_id = self.uuid
+                event.topic = topic
+                events[topic] = event
+            events[topic].addGrainFromObj(pre_obj=pre_obj, post_obj=post_obj)
+        self.pending.clear()
+        return list(events.values())
+
+    def _notify_events(self, events, subscribers=None):
+        self._batch = True
+        try:
+            for event in events:
+                try:
+                    self.notify_subscribers(event.obj(), subscribers)
+                except Exception as ex:
+                    self.logger.writeWarning("Failed to notify subscribers of {}: {}".format(self.uuid, ex))
+        finally:
+            self._batch = False
+        self._handle_overflows()
+
+
+def _close(ws):
+    try:
+        ws.close()
+    except Exception:
+        # Already lost
+        pass
+
+
+def encode_frame(message):
+    """Build a complete, unmasked websocket text frame holding message"""
+    payload = message if isinstance(message, bytes) else message.encode('utf-8')
+    return bytes(Header.encode_header(True, WebSocket.OPCODE_TEXT, b'', len(payload), 0)) + payload
+
+
+# Parameters by which a request for a subscription is matched to an existing one, with their defaults
+MATCHED_PARAMS = [("resource_path", ''), ("secure", False), ("max_update_rate_ms", 100), ("params", {})]
 
 
 class QuerySocketsCommon(object):
     def __init__(self, ws_port, logger=None):
         # NB. the 'sockets' here aren't really sockets, but 'QuerySocket' instances from above.
         self.sockets = []
+        self.index = SubscriptionIndex()
         self.logger = logger
         self.ws_port = ws_port
+        # Subscriptions shared with other worker processes, if there are any (see SubscriptionStore)
+        self.store = None
+        # Non-persistent sockets yet to have a subscriber since restored or adopted, by id, with the time since
+        self._unclaimed = {}
 
     # add a socket
     def add_sock(self, opts):
@@ -89,32 +470,136 @@ class QuerySocketsCommon(object):
             logger=self.logger,
             api_version=opts.get('api_version', 'v1.0')
         )
+        self.register_sock(sock)
+        return sock
+
+    def register_sock(self, sock):
+        """Start routing changes to a newly created socket"""
         self.sockets.append(sock)
+        self.index.add(sock)
         self.logger.writeDebug('Number of active sockets: {}'.format(len(self.sockets)))
+
+    def remove_sock(self, sock):
+        """Stop routing changes to a socket, without closing its subscribers"""
+        self.index.remove(sock)
+        self.sockets.remove(sock)
+        if self.store is not None and not sock.persist:
+            self.store.detach(sock.uuid)
+
+    def attach(self, sock):
+        """Note that a socket has subscribers here, which other worker processes must not remove it from under"""
+        self._unclaimed.pop(sock.uuid, None)
+        if self.store is not None:
+            self.store.attach(sock.uuid)
+
+    def reconcile(self):
+        """
+        Delete sockets which have been deleted through other worker processes,
+        and non-persistent subscriptions which no subscriber has connected to
+        within UNCLAIMED_EXPIRY seconds of being restored, adopted or shared, as
+        they would be once their last subscriber had gone.
+        """
+        now = time.time()
+        for uid, since in list(self._unclaimed.items()):
+            if now - since < UNCLAIMED_EXPIRY:
+                continue
+            del self._unclaimed[uid]
+            sock = self._get_local_sock({"uuid": uid})
+            if sock is not None and not sock.subscribers:
+                self.logger.writeDebug("Removing subscription {}, unclaimed".format(uid))
+                self.del_sock(sock)
+        if self.store is None:
+            return
+        for uid in self.store.unclaimed(UNCLAIMED_EXPIRY):
+            self.logger.writeDebug("Removing shared subscription {}, unclaimed".format(uid))
+            self.store.remove(uid)
+        for sock in list(self.sockets):
+            if not self.store.exists(sock.uuid):
+                self.logger.writeDebug("Subscription {} deleted by another worker".format(sock.uuid))
+                self.del_sock(sock)
+
+    def _share(self, sock):
+        if self.store is not None:
+            self.store.save(sock.uuid, self._record(sock))
+
+    def _record(self, sock):
+        return {"summary": self._summarise(sock), "secure": sock.secure}
+
+    def records(self):
+        """
+        Return records of the subscriptions worth recreating after a restart
+        (see restore): those which are persistent, or have subscribers who
+        will reconnect to them.
+        """
+        if self.store is not None:
+            return [record for record in self.store.records()
+                    if record["summary"].get("persist", False) or self.store.attached(record["summary"]["id"])]
+        return [self._record(sock) for sock in self.sockets if sock.persist or sock.subscribers]
+
+    def restore(self, records):
+        """Recreate subscriptions from their records, under the same ids, unless they already exist"""
+        existing = set(sock.uuid for sock in self.sockets)
+        for record in records:
+            uid = record["summary"]["id"]
+            if uid in existing or (self.store is not None and self.store.exists(uid)):
+                continue
+            self._share(self._adopt(record))
+
+    def _adopt(self, record):
+        """Start serving a subscription created through another worker process, under the same id"""
+        summary = record["summary"]
+        sock = self.add_sock(dict(summary, secure=record["secure"]))
+        sock.uuid = summary["id"]
+        sock.ws_href = summary["ws_href"]
+        if not sock.persist:
+            self._unclaimed[sock.uuid] = time.time()
         return sock
 
     # delete all sockets
     def del_all_socks(self):
-        for sock in self.sockets:
+        for sock in list(self.sockets):
             self.del_sock(sock)
 
     # delete a socket
     def del_sock(self, sock):
         sock.del_subscribers()
         try:
-            self.sockets.remove(sock)
+            self.remove_sock(sock)
         except ValueError:
             self.logger.writeWarning("del_sock: attempt to remove socket that did not exist")
 
     def match_sock(self, sock, opts):
         """Check if the socket matches the requested opts using the following parameters"""
-        checked_params = [("resource_path", ''), ("secure", False), ("max_update_rate_ms", 100), ("params", {})]
-        for key, value in checked_params:
+        for key, value in MATCHED_PARAMS:
             if getattr(sock, key) != opts.get(key, value):
                 return False
         return True
 
     def get_sock(self, opts, exclude_persist=False):  # exclude_persist causes persistent sockets not to be returned
+        """
+        Return the socket matching opts, adopting one created through another worker
+        process. Only used where a subscriber is about to connect, as every socket
+        here is sent changes; see find_summary otherwise.
+        """
+        sock = self._get_local_sock(opts, exclude_persist)
+        if sock is None and self.store is not None:
+            record = self._get_shared_record(opts, exclude_persist)
+            if record is not None:
+                return self._adopt(record)
+        return sock
+
+    def find_summary(self, opts, exclude_persist=False):
+        """Return the summary of the subscription matching opts, without adopting one from another worker"""
+        sock = self._get_local_sock(opts, exclude_persist)
+        if sock is not None:
+            return self._summarise(sock)
+        if self.store is not None:
+            record = self._get_shared_record(opts, exclude_persist)
+            if record is not None:
+                return record["summary"]
+        return None
+
+    def _get_local_sock(self, opts, exclude_persist=False):
         for sock in self.sockets:
             proposed_sock = None
             uid = opts.get('uuid', None)
@@ -128,13 +613,31 @@ class QuerySocketsCommon(object):
                     return proposed_sock
         return None
 
+    def _get_shared_record(self, opts, exclude_persist=False):
+        uid = opts.get('uuid', None)
+        if uid is not None:
+            records = [self.store.get(uid)]
+        else:
+            records = self.store.records()
+        for record in records:
+            if record is None:
+                continue
+            shared_opts = dict(record["summary"], secure=record["secure"])
+            if uid is None and any(shared_opts.get(key, value) != opts.get(key, value)
+                                   for key, value in MATCHED_PARAMS):
+                continue
+            if not (exclude_persist and shared_opts.get("persist", False)):
+                return record
+        return None
+
     # Return ws subscribers that are interested in given object
     def find_socks(self, path=None, obj=None, p_obj=None):
         retval = []
         # find subscribers for given node
         # eg. path=/dest, args=[label:123]
         # obj = obj[obj.keys()[0]]
-        for s in self.sockets:
+        # Only subscriptions which could match the type and indexed params of the objects are tested
+        for s in self.index.candidates(path, obj, p_obj):
             sock_path = util.translate_resourcetypes(s.resource_path)
             matched = False
             if sock_path:
@@ -153,8 +656,20 @@ class QuerySocketsCommon(object):
         return retval
 
     def _check_args(self, s, obj):
-        arg_checker = QueryFilterCommon()
-        return arg_checker.check_args(s.params, obj)
+        if s.predicate is None:
+            s.predicate = self._compile_params(s.params)
+        return s.predicate(obj)
+
+    def _compile_params(self, params):
+        return QueryFilterCommon().compile(params)
+
+    def _project(self, s, obj):
+        """Reduce obj to the fields selected by any 'query.fields' param of the socket, leaving obj untouched"""
+        if s.projection is None:
+            s.projection = projection.for_args(s.params) or _whole
+        if obj is None:
+            return None
+        return s.projection(obj)
 
     def gen_ws_url(self, path, args):
         argsList = []
@@ -180,13 +695,11 @@ class QuerySocketsCommon(object):
         return (ws_path, query_args)
 
     def get_socket(self, socket_id):
-        retval = None
-        sock = self.get_sock({"uuid": socket_id})
-        if sock:
-            retval = self._summarise(sock)
-        return retval
+        return self.find_summary({"uuid": socket_id})
 
     def get_socketlist(self):
+        if self.store is not None:
+            return [record["summary"] for record in self.store.records()]
         retval = []
         for sock in self.sockets:
             retval.append(self._summarise(sock))
@@ -194,19 +707,23 @@ class QuerySocketsCommon(object):
 
     # Request a socket
     def post_socket(self, json):
-        retval = []
         created = False
-        socket = self.get_sock(json, exclude_persist=True)
-        if not socket or json.get('persist', False):
+        summary = self.find_summary(json, exclude_persist=True)
+        if not summary or json.get('persist', False):
             socket = self.add_sock(json)
+            self._share(socket)
+            summary = self._summarise(socket)
             created = True
-        retval = [self._summarise(socket), created]
-        return retval
+        return [summary, created]
 
     def delete_socket(self, socket_id):
-        socket = self.get_sock({"uuid": socket_id})
-        if socket.persist:
-            self.del_sock(socket)
+        summary = self.find_summary({"uuid": socket_id})
+        if summary["persist"]:
+            socket = self._get_local_sock({"uuid": socket_id})
+            if socket is not None:
+                self.del_sock(socket)
+            if self.store is not None:
+                self.store.remove(socket_id)
             return True
         else:
             return False
@@ -275,3 +792,112 @@ class QueryFilterCommon(object):
                     matched = False
 
         return matched
+
+    def compile(self, args):
+        """
+        Turn `args' into a single predicate, called as predicate(obj), which is
+        equivalent to check_args(args, obj) combined with any 'query.rql'
+        expression. Keys are classified and dotted paths split once, here, rather
+        than for every object tested. Predicates are cached against the normalised
+        args, so repeated queries share them. Raises rql.RQLError if the RQL
+        expression is invalid.
+        """
+        if not args:
+            return _match_all
+
+        cache_key = self._cache_key(args)
+        predicate = _predicate_cache.get(cache_key) if cache_key is not None else None
+        if predicate is None:
+            tests = [self._compile_arg(arg_key, val) for arg_key, val in args.items()
+                     if not (arg_key.startswith("query.") or arg_key.startswith("paging."))]
+            if "query.rql" in args:
+                tests.append(rql.compile(args["query.rql"]))
+            predicate = _match_all_of(tests)
+            if cache_key is not None:
+                if len(_predicate_cache) >= PREDICATE_CACHE_SIZE:
+                    _predicate_cache.clear()
+                _predicate_cache[cache_key] = predicate
+        return predicate
+
+    def _cache_key(self, args):
+        try:
+            cache_key = (self.__class__, tuple(sorted(args.items())))
+            hash(cache_key)
+        except TypeError:
+            # Unhashable or unorderable values (eg. from subscription params) aren't cached
+            return None
+        return cache_key
+
+    def _compile_arg(self, arg_key, val):
+        if "." not in arg_key:
+            # Test will be on a top level key=value
+            def test(obj):
+                if arg_key not in obj:
+                    return False
+                return _test_value(obj[arg_key], val)
+            return test
+
+        # Test will be on a nested key.key.key=value, unless the full key is present
+        arg_parts = arg_key.split(".")
+
+        def test_nested(obj):
+            if arg_key in obj:
+                return _test_value(obj[arg_key], val)
+            test_data = _walk(obj, arg_parts, val)
+            if test_data is _MISS:
+                return False
+            return _test_value(test_data, val)
+        return test_nested
+
+
+def _match_all(obj):
+    return True
+
+
+def _whole(obj):
+    return obj
+
+
+def _match_all_of(tests):
+    if len(tests) == 1:
+        return tests[0]
+
+    def predicate(obj):
+        for test in tests:
+            if not test(obj):
+                return False
+        return True
+    return predicate
+
+
+def _walk(obj, arg_parts, val):
+    """Follow a split dotted key into obj, with the list handling of QueryFilterCommon.check_args"""
+    test_data = obj
+    for arg_part in arg_parts:
+        if isinstance(test_data, list):
+            # Special case: Deal with nested cases such as Node services, searched by type
+            if len(test_data) == 0:
+                return _MISS
+            for child_obj in test_data:
+                if arg_part in child_obj:
+                    if child_obj[arg_part] == val:
+                        # We have a match
+                        test_data = child_obj[arg_part]
+                        break
+                else:
+                    return _MISS
+        elif arg_part in test_data:
+            test_data = test_data[arg_part]
+        else:
+            return _MISS
+    return test_data
+
+
+def _test_value(test_data, val):
+    # An empty value is not tested, so always matches
+    if not test_data:
+        return True
+    # Perform the test, checking within lists if necessary
+    if isinstance(test_data, list):
+        return val in test_data
+    return test_data == val
@@ -16,11 +16,20 @@ import json
 from functools import wraps
 from flask import request, abort, make_response
 from socket import error as socket_error
+from six.moves.urllib.parse import urlencode
 
 from nmoscommon.webapi import on_json, route, jsonify
+from mediajson import NMOSJSONEncoder
 from .. import VALID_TYPES
+from .. import rql
+from .. import projection
+from ..ancestry import parse_ancestry_args
+from ..paging import parse_timestamp, format_timestamp, PAGING_ORDERS, DEFAULT_PAGING_LIMIT, MAX_PAGING_LIMIT, \
+    ZERO_TIMESTAMP
 from .query import QueryCommon
 
+PAGING_LINK_ARGS = ["paging.since", "paging.until", "paging.limit"]
+
 
 class RoutesCommon(object):
 
@@ -46,21 +55,140 @@ class RoutesCommon(object):
         self.logger.writeDebug('ips_type')
         if ips_type not in VALID_TYPES:
             abort(404)
-        for key in request.args:
-            if key.startswith("query.ancestry_"):
-                abort(501)
-            elif key == "query.rql":
-                abort(501)
+        try:
+            ancestry = parse_ancestry_args(request.args)
+        except ValueError as e:
+            abort(400, str(e))
+        if ancestry is not None and not self.query.registry.seeded:
+            # Ancestry is only known to the registry mirror
+            abort(503, "Ancestry queries are unavailable until the registry has been read")
+        if "query.rql" in request.args:
+            self.__check_rql(request.args["query.rql"])
+        self.__check_fields(request.args)
+        if self.api_version != "v1.0":
+            return self.__conditional('/{}'.format(ips_type), lambda: self.__ips_type_page(ips_type))
+        return self.__conditional('/{}'.format(ips_type), lambda: self.__ips_type_all(ips_type))
+
+    def __ips_type_all(self, ips_type):
+        if self.config.get("stream_responses", False) and self.__accepts_json():
+            items = self.query.iter_data_for_path('/{}'.format(ips_type), request.args)
+            return (200, self.__stream_list(items), {"Content-Type": "application/json"})
         obj = self.query.get_data_for_path('/{}'.format(ips_type), request.args)
-        self.logger.writeDebug('obj {}'.format(obj))
         if not obj:
             obj = []
+        self.logger.writeDebug('{} {}'.format(len(obj), ips_type))
         return (200, obj)
 
+    def __accepts_json(self):
+        return request.accept_mimetypes.best_match(['application/json', 'text/html']) == 'application/json'
+
+    def __stream_list(self, items):
+        """
+        Encode a JSON array as it is sent, one element at a time, so that the
+        whole response is never held in memory. Without a Content-Length, it
+        is sent with chunked transfer encoding. Elements are encoded just as
+        nmoscommon's jsonify encodes every other response.
+        """
+        separator = "[\n"
+        for item in items:
+            yield separator + json.dumps(item, indent=4, cls=NMOSJSONEncoder)
+            separator = ",\n"
+        yield "[]" if separator == "[\n" else "\n]"
+
+    def __ips_type_page(self, ips_type):
+        order = request.args.get("paging.order", "update")
+        if order not in PAGING_ORDERS:
+            abort(400, "paging.order must be one of {}".format(", ".join(PAGING_ORDERS)))
+        try:
+            since = self.__paging_timestamp("paging.since")
+            until = self.__paging_timestamp("paging.until")
+        except ValueError:
+            abort(400, "paging.since and paging.until must be timestamps of the form <seconds>:<nanoseconds>")
+        if since is not None and until is not None and since > until:
+            abort(400, "paging.since must not be later than paging.until")
+
+        max_limit = self.config.get("paging_max_limit", MAX_PAGING_LIMIT)
+        limit = self.config.get("paging_default_limit", DEFAULT_PAGING_LIMIT)
+        if "paging.limit" in request.args:
+            try:
+                limit = int(request.args["paging.limit"])
+            except ValueError:
+                limit = 0
+            if limit < 1:
+                abort(400, "paging.limit must be a positive integer")
+        limit = min(limit, max_limit)
+
+        page = self.query.get_page_for_path('/{}'.format(ips_type), request.args, order, since, until, limit)
+        headers = {
+            "X-Paging-Limit": str(page.limit),
+            "X-Paging-Since": format_timestamp(page.since),
+            "X-Paging-Until": format_timestamp(page.until),
+            "Link": self.__paging_links(page)
+        }
+        if self.config.get("stream_responses", False) and self.__accepts_json():
+            headers["Content-Type"] = "application/json"
+            return (200, self.__stream_list(page.items), headers)
+        return (200, page.items, headers)
+
+    def __paging_timestamp(self, arg):
+        if arg not in request.args:
+            return None
+        return parse_timestamp(request.args[arg])
+
+    def __paging_links(self, page):
+        # Links keep every other query argument, including paging.order
+        args = [(k, v) for k, v in request.args.items(multi=True) if k not in PAGING_LINK_ARGS]
+        links = [
+            ("first", [("paging.since", format_timestamp(ZERO_TIMESTAMP))]),
+            ("last", []),
+            ("next", [("paging.since", format_timestamp(page.until))]),
+            ("prev", [("paging.until", format_timestamp(page.since))])
+        ]
+        return ", ".join('<{}?{}>; rel="{}"'.format(
+            request.base_url, urlencode(args + paging + [("paging.limit", page.limit)]), rel
+        ) for rel, paging in links)
+
+    def __conditional(self, path, build):
+        """
+        Answer a GET of `path' with 304 Not Modified if the client's If-None-Match
+        holds its current entity tag, and otherwise with the response from build()
+        tagged with it. Tags come from the registry mirror, so checking is cheap.
+        """
+        etag = self.query.get_etag(path, request.args)
+        if etag is None:
+            return build()
+        headers = {"ETag": 'W/"{}"'.format(etag)}
+        if request.if_none_match.contains_weak(etag):
+            return (304, '', headers)
+        response = build()
+        if response[0] != 200:
+            return response
+        if len(response) > 2:
+            headers.update(response[2])
+        return (response[0], response[1], headers)
+
+    def __check_rql(self, expression):
+        try:
+            rql.compile(expression)
+        except rql.RQLNotSupported as e:
+            abort(501, str(e))
+        except rql.RQLError as e:
+            abort(400, str(e))
+
+    def __check_fields(self, args):
+        try:
+            projection.for_args(args)
+        except projection.ProjectionError as e:
+            abort(400, str(e))
+
     @route('/<ips_type>/<el_id>/')
     def __el_id(self, ips_type, el_id):
         if ips_type not in VALID_TYPES:
             abort(404)
+        self.__check_fields(request.args)
+        return self.__conditional('/{}/{}'.format(ips_type, el_id), lambda: self.__el_id_get(ips_type, el_id))
+
+    def __el_id_get(self, ips_type, el_id):
         obj = self.query.get_data_for_path('/{}/{}'.format(ips_type, el_id), request.args)
         if not obj:
             return(404, '')
@@ -74,6 +202,11 @@ class RoutesCommon(object):
             data = json.loads(request.get_data(as_text=True))
         except ValueError:
             abort(400, "No data supplied")
+        params = data.get("params", {})
+        if isinstance(params, dict) and "query.rql" in params:
+            self.__check_rql(params["query.rql"])
+        if isinstance(params, dict):
+            self.__check_fields(params)
         if self.config["https_mode"] == "enabled":
             if "secure" not in data:
                 data["secure"] = True
@@ -129,9 +262,11 @@ class RoutesCommon(object):
                 self.logger.writeError('handle_sock: socket does not exist: {}'.format(uid))
                 return
 
-            # register client on socket
+            # register client on socket, holding back changes until it has been synced,
+            # and to be synced again should it fall too far behind
             self.logger.writeDebug("new subscriber on ws {} ({})".format(uid, ws))
-            socket.add_subscriber(ws)
+            socket.add_subscriber(ws, syncing=True, resync=self.query.do_sync)
+            self.query.query_sockets.attach(socket)
 
             # do a sync
             self.query.do_sync(ws, socket)
@@ -158,7 +293,8 @@ class RoutesCommon(object):
                     # reduce count of subscribers, if it hits zero, remove the socket.
                     # inlining this functionality here rather than hiding it elsewhere
                     # to make it easier to un-pick when the time comes...
-                    socket.subscribers.remove(ws)
+                    # (it may already have been removed for falling too far behind)
+                    socket.remove_subscriber(ws)
                     self.logger.writeDebug("Removed subscription to {}: {} left".format(uid, len(socket.subscribers)))
                     if not socket.subscribers:
                         if socket in self.query.query_sockets.sockets:
@@ -166,7 +302,7 @@ class RoutesCommon(object):
                                 self.logger.writeDebug("Leaving persistent socket {} in place.".format(uid))
                             else:
                                 self.logger.writeDebug("Removing socket {} for good.".format(uid))
-                                self.query.query_sockets.sockets.remove(socket)
+                                self.query.query_sockets.remove_sock(socket)
                         else:
                             self.logger.writeError(
                                 "Should have found socket {} in query_sockets, didn't. Investigate.".format(uid)
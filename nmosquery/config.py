@@ -26,7 +26,17 @@ CONFIG_DEFAULTS = {
     "priority": 100,
     "https_mode": "disabled",
     "enable_mdns": True,
-    "oauth_mode": False
+    "oauth_mode": False,
+    "paging_default_limit": 100,
+    "paging_max_limit": 1000,
+    "translation_cache_size": 50000,
+    "stream_responses": False,
+    "registry_backend": "etcd2",
+    "etcd_pool_size": 10,
+    "etcd_watch_mode": "long_poll",
+    "workers": 1,
+    "snapshot_path": None,
+    "snapshot_interval": 30
 }
 
 config = {}
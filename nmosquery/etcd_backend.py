@@ -12,46 +12,47 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import six.moves.http_client as http_client
-import six.moves.urllib.parse as urlparse
+from .httppool import shared_pool
 
 
-def __http(addr, port, method, url, payload=None):
-    try:
-        # print '==>',method,addr,port,url,payload
-        headers = {"Content-type": "application/x-www-form-urlencoded"}
-        conn = http_client.HTTPConnection(addr, port)
-        conn.request(method, url, payload, headers)
-        resp = conn.getresponse()
+class EtcdResponse(object):
+    """
+    The response to a put or delete, with the attributes of the httplib
+    responses these once returned (status, reason, data, getheader(s) and
+    read), as well as those of the requests Response it wraps.
+    """
 
-        # Follow temp redirects
-        if resp.status == 307:
-            headers = resp.getheaders()
-            to = [x[1] for x in resp.getheaders() if x[0] == 'location'][0]
-            parts = urlparse.urlparse(to)
-            split_netloc = parts.netloc.split(':')
+    def __init__(self, response):
+        self._response = response
+        self.status = response.status_code
+        self.reason = response.reason
+        self.data = response.content
 
-            # Naively assume path stays the same. For our purposes, it does.
-            if len(split_netloc) > 1:
-                return __http(split_netloc[0], int(split_netloc[1]), method, url, payload)
-            else:
-                return __http(split_netloc[0], port, method, url, payload)
+    def getheader(self, name, default=None):
+        return self._response.headers.get(name, default)
 
-        resp.data = resp.read()  # hack
-        # print '<==',resp.status, resp.data, resp.reason, resp.getheaders()
-        return resp
+    def getheaders(self):
+        return [(name.lower(), value) for name, value in self._response.headers.items()]
 
-    finally:
-        conn.close()
+    def read(self):
+        return self.data
+
+    def __getattr__(self, name):
+        return getattr(self._response, name)
+
+
+def _url(key, port):
+    return "http://localhost:{}/v2/keys{}".format(port, key)
 
 
 def put(key, value, ttl=None, port=2379):
-    value = "value={}".format(value)
+    data = {"value": value}
     if ttl:
-        value += "&ttl={}".format(ttl)
+        data["ttl"] = ttl
 
-    return __http("localhost", port, "PUT", "/v2/keys{}".format(key), value)
+    # Redirects (eg. to the etcd leader) are followed with the same method and data
+    return EtcdResponse(shared_pool().request("PUT", _url(key, port), data=data))
 
 
 def delete(key, port=2379):
-    return __http("localhost", port, "DELETE", "/v2/keys{}?recursive=true".format(key))
+    return EtcdResponse(shared_pool().request("DELETE", _url(key, port) + "?recursive=true"))
@@ -19,10 +19,29 @@ import gevent # noqa E402
 import gevent.queue # noqa E402
 import requests # noqa E402
 import time # noqa E402
+import json # noqa E402
 import socket # noqa E402
+from urllib3.exceptions import ReadTimeoutError # noqa E402
 
 from nmoscommon.logger import Logger # noqa E402
 
+from .httppool import shared_pool # noqa E402
+from .metrics import REGISTRY, Counter # noqa E402
+
+# Ways of watching etcd for changes: a long-poll request for each change, or a
+# single streaming request delivering every change as it happens
+WATCH_LONG_POLL = "long_poll"
+WATCH_STREAM = "stream"
+WATCH_MODES = [WATCH_LONG_POLL, WATCH_STREAM]
+
+# Seconds a watch may wait without any change before it is checked against etcd's index and made again
+WATCH_TIMEOUT = 20
+
+ETCD_WATCH_REQUESTS = REGISTRY.register(Counter(
+    "nmosquery_etcd_watch_requests_total", "Requests made to etcd to watch for changes", ["mode"]))
+ETCD_WATCH_EVENTS = REGISTRY.register(Counter(
+    "nmosquery_etcd_watch_events_total", "Changes received from etcd watches", ["mode"]))
+
 
 def _get_etcd_index(request, logger):
     """
@@ -39,6 +58,13 @@ def _get_etcd_index(request, logger):
     return index
 
 
+def _timed_out(ex):
+    """Whether `ex' was raised by a request timing out, which requests reports differently once streaming"""
+    if isinstance(ex, (socket.timeout, requests.exceptions.Timeout)):
+        return True
+    return bool(ex.args) and isinstance(ex.args[0], (socket.timeout, ReadTimeoutError))
+
+
 class EtcdEventQueue(object):
     """
     Attempt to overcome the "missed etcd event" issue, which can be caused when
@@ -52,6 +78,9 @@ class EtcdEventQueue(object):
     possible, so a "sentinel" message with action=index_skip will be sent to
     the output queue when this happens.
 
+    Events are watched for from the index following `since', so a consumer
+    holding a snapshot taken at a known x-etcd-index sees every later change.
+
     To use this, the `queue' member of EtcdEventQueue is iterable:
 
     q = EtcdEventQueue()
@@ -60,23 +89,38 @@ class EtcdEventQueue(object):
 
     This uses http://www.gevent.org/gevent.queue.html as an underlying data
     structure, so can be consumed from multiple greenlets if necessary.
+
+    As for backends.ChangeStream, `last_index' is the latest etcd index seen.
+
+    With `mode' WATCH_STREAM, a single streaming watch (stream=true) is held
+    open, and changes are delivered as each arrives, rather than making a new
+    long-poll request for each. Should the stream end or fail, a new one is
+    made from the index following the last change delivered.
     """
 
-    def __init__(self, host, port, logger=None):
+    def __init__(self, host, port, logger=None, since=0, pool=None, mode=WATCH_LONG_POLL):
+        if mode not in WATCH_MODES:
+            raise ValueError("Unknown etcd watch mode '{}', must be one of {}".format(mode, ", ".join(WATCH_MODES)))
         self.queue = gevent.queue.Queue()
+        self.last_index = since
+        self.mode = mode
+        self._pool = pool or shared_pool()
         self._base_url = "http://{}:{}/v2/keys/resource/".format(host, port)
         self._long_poll_url = self._base_url + "?recursive=true&wait=true"
-        self._greenlet = gevent.spawn(self._wait_event, 0)
+        # etcd's index when the last watch timed out (see _watch_timed_out)
+        self._quiet_index = None
+        self._greenlet = gevent.spawn(self._stream_events if mode == WATCH_STREAM else self._wait_event, since)
         self._alive = True
         self._logger = Logger("etcd_watch", logger)
 
     def _get_index(self, current_index):
         index = current_index
         try:
-            response = requests.get(self._base_url, proxies={'http': ''}, timeout=1)
+            response = self._pool.get(self._base_url, timeout=1)
             if response is not None:
                 if response.status_code == 200:
                     index = _get_etcd_index(response, self._logger)
+                    self.last_index = max(self.last_index, index)
                     self._logger.writeDebug("waitIndex now = {}".format(index))
 
                     # Always want to know if the index we were waiting on was greater
@@ -116,26 +160,17 @@ class EtcdEventQueue(object):
                 # by network partition or by a node having it's data reset?),
                 # and the query service is not restarted, hence the code below
                 # is left waiting for a much higher modification index than it
-                # should.  To mitigate this simply, when a timeout occurs,
-                # assume that the modified index is "wrong", and forcibly try
-                # to fetch the next index. This may "miss" updates, which is of
-                # limited consequence. An enhancement (and therefore
-                # complication...) could use the fact that the timeout is
-                # small, and set waitIndex to the x-etcd-index result minus
-                # some heuristically determined number of updates, to try and
-                # catch the "back-in-time" updates stored in etcd's log, but
-                # this feels brittle and overcomplicated for something that
-                # could be solved by a browser refresh/handling of the "skip"
-                # event to request a full set of resources.
+                # should.  When a timeout occurs, the index is checked (see
+                # _watch_timed_out) before waiting again.
 
                 # https://github.com/coreos/etcd/blob/master/Documentation/api.md#waiting-for-a-change
                 next_index_param = "&waitIndex={}".format(current_index + 1)
-                req = requests.get(self._long_poll_url + next_index_param, proxies={'http': ''}, timeout=20)
+                ETCD_WATCH_REQUESTS.labels(WATCH_LONG_POLL).inc()
+                req = self._pool.get(self._long_poll_url + next_index_param, timeout=WATCH_TIMEOUT, long_poll=True)
 
             except (socket.timeout, requests.exceptions.ReadTimeout):
-                # Get a new wait index to watch from by querying /resource
-                self._logger.writeDebug("Timeout waiting on long-poll. Refreshing waitIndex...")
-                current_index = self._get_index(current_index)
+                self._logger.writeDebug("Timeout waiting on long-poll. Checking waitIndex...")
+                current_index = self._watch_timed_out(current_index)
                 continue
 
             except Exception as ex:
@@ -153,25 +188,105 @@ class EtcdEventQueue(object):
                     continue
 
                 if req.status_code == 200:
-                    # Return from request was OK, so put the payload on the queue.
-                    # NOTE: we use the "modifiedIndex" of the _node_ we receive, NOT the header.
-                    # This follows the etcd docs linked above.
-                    self.queue.put(json)
-                    current_index = json.get('node', {}).get('modifiedIndex', current_index)
+                    current_index = self._deliver(json, current_index, WATCH_LONG_POLL)
+                    self.last_index = max(self.last_index, _get_etcd_index(req, self._logger))
 
                 else:
-                    # Error codes documented here:
-                    #  https://github.com/coreos/etcd/blob/master/Documentation/errorcode.md
-                    self._logger.writeInfo("error: http:{}, etcd:{}".format(req.status_code, json.get('errorCode', 0)))
-                    if json.get('errorCode', 0) == 401:
-                        # Index has been cleared.
-                        # This may cause missed events, so send an (invented) sentinel message to queue.
-                        new_index = self._get_index(current_index)
-                        self._logger.writeWarning(
-                            "etcd history not available; skipping {} -> {}".format(current_index, new_index)
-                        )
-                        self.queue.put({'action': 'index_skip', 'from': current_index, 'to': new_index})
-                        current_index = new_index
+                    current_index = self._watch_error(req.status_code, json, current_index)
+
+    def _stream_events(self, since):
+        current_index = since
+
+        while self._alive:
+            response = None
+            delivered = False
+            try:
+                next_index_param = "&stream=true&waitIndex={}".format(current_index + 1)
+                ETCD_WATCH_REQUESTS.labels(WATCH_STREAM).inc()
+                response = self._pool.get(self._long_poll_url + next_index_param, stream=True,
+                                          timeout=(5, WATCH_TIMEOUT), long_poll=True)
+                if response.status_code != 200:
+                    current_index = self._watch_error(response.status_code, response.json(), current_index)
+                    continue
+                self.last_index = max(self.last_index, _get_etcd_index(response, self._logger))
+
+                # etcd writes each change as a line of JSON, and flushes it straight away
+                for line in response.iter_lines():
+                    if isinstance(line, bytes):
+                        line = line.decode('utf-8')
+                    if line:
+                        current_index = self._deliver(json.loads(line), current_index, WATCH_STREAM)
+                        delivered = True
+
+                # etcd ends the streams of watchers which fall too far behind, so carry on from the last change
+                self._logger.writeDebug("Streaming watch ended at {}".format(current_index))
+                if not delivered:
+                    gevent.sleep(1)
+
+            except Exception as ex:
+                if not self._alive:
+                    break
+                if _timed_out(ex):
+                    self._logger.writeDebug("Timeout waiting on streaming watch. Checking waitIndex...")
+                    current_index = self._watch_timed_out(current_index)
+                else:
+                    self._logger.writeWarning("Streaming watch failed, resuming from {}: {}".format(
+                        current_index + 1, ex))
+                    gevent.sleep(1)
+
+            finally:
+                if response is not None:
+                    response.close()
+
+    def _deliver(self, event, current_index, mode):
+        """Put a change from a watch on the queue, returning the index to watch on from"""
+        # NOTE: we use the "modifiedIndex" of the _node_ we receive, NOT the header.
+        # This follows the etcd docs linked above.
+        self.queue.put(event)
+        ETCD_WATCH_EVENTS.labels(mode).inc()
+        current_index = event.get('node', {}).get('modifiedIndex', current_index)
+        self.last_index = max(self.last_index, current_index)
+        return current_index
+
+    def _watch_timed_out(self, current_index):
+        """Handle a watch timing out without a change, returning the index to watch on from"""
+        # Changes made since the watch timed out are still in etcd's history (or a
+        # 401 will say they aren't), so carry on from the last change seen rather
+        # than from the current index. But etcd's index moves on with changes to
+        # other keys too, which would in time push the last change seen out of
+        # its 1000 event history. So the current index is kept, and should the
+        # next watch also time out, skipped to: that watch began after etcd had
+        # reached it, so would have had any change to /resource up to it.
+        # Where etcd's index has gone back, there is no later change to wait
+        # for, so skip back to it, sending an index_skip as the changes since
+        # may have been missed.
+        index = self._get_index(current_index)
+        if 0 < index < current_index:
+            self._quiet_index = None
+            self._logger.writeWarning("etcd index went back; skipping {} -> {}".format(current_index, index))
+            self.queue.put({'action': 'index_skip', 'from': current_index, 'to': index})
+            return index
+        quiet_index, self._quiet_index = self._quiet_index, index or None
+        if quiet_index is not None and quiet_index > current_index:
+            self._logger.writeDebug("No changes up to {}; waitIndex now = {}".format(quiet_index, quiet_index + 1))
+            return quiet_index
+        return current_index
+
+    def _watch_error(self, status_code, error, current_index):
+        """Handle an error response to a watch, returning the index to watch on from"""
+        # Error codes documented here:
+        #  https://github.com/coreos/etcd/blob/master/Documentation/errorcode.md
+        self._logger.writeInfo("error: http:{}, etcd:{}".format(status_code, error.get('errorCode', 0)))
+        if error.get('errorCode', 0) == 401:
+            # Index has been cleared.
+            # This may cause missed events, so send an (invented) sentinel message to queue.
+            new_index = self._get_index(current_index)
+            self._logger.writeWarning(
+                "etcd history not available; skipping {} -> {}".format(current_index, new_index)
+            )
+            self.queue.put({'action': 'index_skip', 'from': current_index, 'to': new_index})
+            return new_index
+        return current_index
 
     def stop(self):
         self._logger.writeInfo("Stopping service")
@@ -0,0 +1,122 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# Top level foreign key and enumerated fields which are worth indexing, by resource type
+INDEXED_FIELDS = {
+    "nodes": [],
+    "devices": ["node_id", "type"],
+    "sources": ["device_id", "format"],
+    "flows": ["device_id", "source_id", "format"],
+    "senders": ["device_id", "flow_id", "transport"],
+    "receivers": ["device_id", "format", "transport"],
+}
+
+
+class FieldIndex(object):
+    """
+    Hash indexes from the value of selected fields to the etcd keys of the
+    resources holding that value, so equality filters on those fields can be
+    answered without testing every resource of a type.
+
+    The index only narrows down candidates: callers still apply the full filter
+    to whatever is returned. To stay consistent with QueryFilterCommon, where a
+    filter on a field holding a "falsy" value always passes, such values are all
+    indexed under None and returned as candidates for every lookup.
+    """
+
+    def __init__(self, fields=None):
+        if fields is None:
+            fields = INDEXED_FIELDS
+        self._fields = fields
+        self._index = {}
+        self._entries = {}
+        self.clear()
+
+    def clear(self):
+        self._index = {rtype: {field: {} for field in fields} for rtype, fields in self._fields.items()}
+        self._entries = {}
+
+    def is_indexed(self, rtype, field):
+        return field in self._index.get(rtype, {})
+
+    def add(self, key, rtype, obj):
+        """Index the resource `obj' stored at `key', replacing any previous entry"""
+        self.remove(key)
+        entries = []
+        for field, values in self._index.get(rtype, {}).items():
+            if field not in obj:
+                continue
+            for value in self._tokens(obj[field]):
+                values.setdefault(value, set()).add(key)
+                entries.append((rtype, field, value))
+        self._entries[key] = entries
+
+    def remove(self, key):
+        for rtype, field, value in self._entries.pop(key, []):
+            keys = self._index[rtype][field].get(value)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._index[rtype][field][value]
+
+    def _tokens(self, value):
+        if not value:
+            return [None]
+        if isinstance(value, list):
+            return [v for v in value if self._hashable(v)]
+        if self._hashable(value):
+            return [value]
+        return []
+
+    def _hashable(self, value):
+        try:
+            hash(value)
+        except TypeError:
+            return False
+        return True
+
+    def keys_for(self, rtype, field, values):
+        """
+        Return the set of keys of resources of type `rtype' where `field' could
+        hold any of `values', or None if the field isn't indexed.
+        """
+        if not self.is_indexed(rtype, field) or not all(self._hashable(val) for val in values):
+            return None
+        index = self._index[rtype][field]
+        keys = set(index.get(None, set()))
+        for val in values:
+            keys |= index.get(val, set())
+        return keys
+
+    def lookup(self, rtype, args):
+        """
+        Return the set of keys of resources of type `rtype' which could match the
+        equality filters in `args', or None if none of the filters are indexed.
+        """
+        if not args:
+            return None
+
+        candidates = None
+        for field, val in args.items():
+            if not self.is_indexed(rtype, field) or not self._hashable(val):
+                continue
+            values = self._index[rtype][field]
+            keys = values.get(val, set()) | values.get(None, set())
+            if candidates is None:
+                candidates = keys
+            else:
+                candidates = candidates & keys
+            if not candidates:
+                break
+        return candidates
@@ -0,0 +1,130 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from gevent import monkey
+monkey.patch_all()
+
+from timeit import default_timer # noqa E402
+
+import requests # noqa E402
+from requests.adapters import HTTPAdapter # noqa E402
+
+from .metrics import REGISTRY, Histogram # noqa E402
+
+# Connections kept open to each host
+DEFAULT_POOL_SIZE = 10
+
+# Seconds allowed to connect, and to wait for data, unless a call gives its own
+DEFAULT_TIMEOUT = (3.05, 30)
+
+_shared = None
+
+ETCD_REQUEST_DURATION = REGISTRY.register(Histogram(
+    "nmosquery_etcd_request_duration_seconds", "Round trip time of requests to etcd, other than watches",
+    ["method"]))
+
+
+class HTTPPool(object):
+    """
+    A requests Session keeping a pool of persistent (keep-alive) connections to
+    each host, so that calls to etcd don't each pay for setting up a new TCP
+    connection. Connections beyond the pool size are opened as needed and
+    closed after use. Proxies are never used.
+
+    Calls made through the pool, and the connections it holds, are counted for
+    monitoring (see stats), and the time taken by each is recorded in
+    ETCD_REQUEST_DURATION unless it is a long poll.
+    """
+
+    def __init__(self, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+        self.size = size
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.trust_env = False
+        self._adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+        self.session.mount("http://", self._adapter)
+        self.session.mount("https://", self._adapter)
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+
+    def request(self, method, url, long_poll=False, **kwargs):
+        """
+        As requests.request, with the pool's timeout unless one is given.
+        `long_poll' marks requests which wait for something to happen, such as
+        watches, so their duration isn't taken as a round trip time.
+        """
+        kwargs.setdefault("timeout", self.timeout)
+        self.requests += 1
+        self.in_flight += 1
+        start = default_timer()
+        try:
+            return self.session.request(method, url, **kwargs)
+        except Exception:
+            self.errors += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            if not long_poll:
+                ETCD_REQUEST_DURATION.labels(method).observe(default_timer() - start)
+
+    def get(self, url, **kwargs):
+        return self.request("GET", url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request("POST", url, **kwargs)
+
+    def stats(self):
+        """
+        Return counts of the calls made ("requests", "errors" and "in_flight"),
+        and of the connections opened over the life of the pool and those now
+        idle, ready for reuse.
+        """
+        opened = 0
+        idle = 0
+        pools = self._adapter.poolmanager.pools
+        for key in list(pools.keys()):
+            pool = pools.get(key)
+            if pool is not None:
+                opened += pool.num_connections
+                if pool.pool is not None:
+                    idle += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+        return {
+            "size": self.size,
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "connections_opened": opened,
+            "connections_idle": idle
+        }
+
+    def close(self):
+        self.session.close()
+
+
+def shared_pool():
+    """Return the pool used by default for every call to etcd"""
+    global _shared
+    if _shared is None:
+        _shared = HTTPPool()
+    return _shared
+
+
+def configure_shared_pool(size=DEFAULT_POOL_SIZE, timeout=DEFAULT_TIMEOUT):
+    """Replace the shared pool with one of the given size and default timeout"""
+    global _shared
+    if _shared is not None:
+        _shared.close()
+    _shared = HTTPPool(size, timeout)
+    return _shared
@@ -0,0 +1,220 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Counters, gauges and histograms exposed in the Prometheus text format.
+
+Updating a metric costs a dictionary lookup or two, so they may be left on
+in production. Metrics with labels hold a child for each combination of
+label values, found with labels():
+
+    REQUESTS = REGISTRY.register(Counter("requests_total", "Requests", ["method"]))
+    REQUESTS.labels("GET").inc()
+"""
+
+from bisect import bisect_left
+from timeit import default_timer
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Upper bounds of histogram buckets, in seconds, suiting request latencies
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+
+INF = float("inf")
+
+
+class _Timer(object):
+    def __init__(self, observe):
+        self._observe = observe
+        self._start = None
+
+    def __enter__(self):
+        self._start = default_timer()
+        return self
+
+    def __exit__(self, *exc):
+        self._observe(default_timer() - self._start)
+
+
+class _CounterValue(object):
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        return [("", (), self.value)]
+
+
+class _GaugeValue(_CounterValue):
+    def set(self, value):
+        self.value = value
+
+    def dec(self, amount=1):
+        self.value -= amount
+
+
+class _HistogramValue(object):
+    def __init__(self, buckets):
+        self._buckets = buckets
+        self._counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self._counts[bisect_left(self._buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def time(self):
+        """Return a context manager observing the time taken by its body"""
+        return _Timer(self.observe)
+
+    def samples(self):
+        samples = []
+        total = 0
+        for bound, count in zip(self._buckets + (INF,), self._counts):
+            total += count
+            samples.append(("_bucket", (("le", _format(bound)),), total))
+        samples.append(("_sum", (), self.sum))
+        samples.append(("_count", (), self.count))
+        return samples
+
+
+class Metric(object):
+    """A named metric, with a value for each combination of its labels' values"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children = {}
+
+    def _new_value(self):
+        raise NotImplementedError()
+
+    def labels(self, *values):
+        """Return the value for these label values, which are given in the order of labelnames"""
+        try:
+            return self._children[values]
+        except KeyError:
+            if len(values) != len(self.labelnames):
+                raise ValueError("{} takes labels {}".format(self.name, ", ".join(self.labelnames)))
+            return self._children.setdefault(values, self._new_value())
+
+    def clear(self):
+        self._children = {}
+
+    def samples(self):
+        """Generate (name, labels, value) for each sample, where labels is a tuple of (name, value)"""
+        for values in sorted(self._children):
+            labels = tuple(zip(self.labelnames, values))
+            for suffix, extra, value in self._children[values].samples():
+                yield (self.name + suffix, labels + extra, value)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.documentation.replace("\\", "\\\\").replace("\n", "\\n")),
+                 "# TYPE {} {}".format(self.name, self.type)]
+        for name, labels, value in self.samples():
+            if labels:
+                name += "{" + ",".join('{}="{}"'.format(label, _escape(labelvalue))
+                                       for label, labelvalue in labels) + "}"
+            lines.append("{} {}".format(name, _format(value)))
+        return "\n".join(lines) + "\n"
+
+
+class Counter(Metric):
+    """A count which only goes up"""
+
+    type = "counter"
+
+    def _new_value(self):
+        return _CounterValue()
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+
+class Gauge(Metric):
+    """A value which may go up and down"""
+
+    type = "gauge"
+
+    def _new_value(self):
+        return _GaugeValue()
+
+    def set(self, value):
+        self.labels().set(value)
+
+    def inc(self, amount=1):
+        self.labels().inc(amount)
+
+    def dec(self, amount=1):
+        self.labels().dec(amount)
+
+
+class Histogram(Metric):
+    """Counts of observations, such as durations in seconds, falling into buckets of the given upper bounds"""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def _new_value(self):
+        return _HistogramValue(self.buckets)
+
+    def observe(self, value):
+        self.labels().observe(value)
+
+    def time(self):
+        return self.labels().time()
+
+
+class MetricsRegistry(object):
+    """The metrics of a process, rendered together for scraping"""
+
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        """Add a metric, returning it"""
+        if metric.name in [existing.name for existing in self._metrics]:
+            raise ValueError("Duplicate metric {}".format(metric.name))
+        self._metrics.append(metric)
+        return metric
+
+    def render(self, extra=()):
+        """Return the text exposition of every registered metric, followed by any `extra' ones"""
+        return "".join(metric.render() for metric in list(self._metrics) + list(extra))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format(value):
+    if value == INF:
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+# Metrics updated throughout the service
+REGISTRY = MetricsRegistry()
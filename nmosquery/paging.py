@@ -0,0 +1,191 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import bisect
+from six.moves import range
+
+PAGING_ORDERS = ["create", "update"]
+DEFAULT_PAGING_LIMIT = 100
+MAX_PAGING_LIMIT = 1000
+ZERO_TIMESTAMP = (0, 0)
+
+
+def parse_timestamp(value):
+    """
+    Parse an NMOS "<seconds>:<nanoseconds>" timestamp into a tuple which sorts
+    in time order. Raises ValueError if the value is not a valid timestamp.
+
+>>> parse_timestamp("1441716120:100")
+(1441716120, 100)
+"""
+    parts = str(value).split(':')
+    if len(parts) != 2:
+        raise ValueError("Invalid timestamp: {}".format(value))
+    secs, nanos = int(parts[0]), int(parts[1])
+    if secs < 0 or nanos < 0 or nanos >= 1000000000:
+        raise ValueError("Invalid timestamp: {}".format(value))
+    return (secs, nanos)
+
+
+def format_timestamp(ts):
+    return "{}:{}".format(ts[0], ts[1])
+
+
+def next_timestamp(ts):
+    """Return the timestamp one nanosecond after `ts'"""
+    if ts[1] + 1 < 1000000000:
+        return (ts[0], ts[1] + 1)
+    return (ts[0] + 1, 0)
+
+
+def resource_timestamp(obj):
+    """Return the parsed version timestamp of a resource, or the zero timestamp if it has none"""
+    try:
+        return parse_timestamp(obj.get('version', ''))
+    except (ValueError, AttributeError):
+        return ZERO_TIMESTAMP
+
+
+class TimeOrder(object):
+    """
+    The keys of a set of resources, kept sorted by timestamp so that a range of
+    timestamps can be found by bisection rather than by scanning every resource.
+
+    As in IS-04 registries, no two resources share a timestamp, so that paging
+    from one timestamp to the next never repeats or skips resources. Where a
+    resource is added at a timestamp already in use, it is held at the next
+    free one instead. Nothing is held at 0:0 itself, which paging.since=0:0
+    would leave out.
+    """
+
+    def __init__(self):
+        self._entries = []
+        self._times = set()
+        # For each timestamp found in use, the last one handed out in its place and how many of those are held,
+        # so that runs aren't walked again; and the timestamp asked for of each held in place of another
+        self._bumped = {}
+        self._requested = {}
+
+    def add(self, ts, key):
+        """Add `key' at the timestamp `ts', or the next free one, returning the timestamp it is held at"""
+        if ts in self._times or ts == ZERO_TIMESTAMP:
+            requested = ts
+            last, count = self._bumped.get(requested, (requested, 0))
+            ts = next_timestamp(last)
+            while ts in self._times:
+                ts = next_timestamp(ts)
+            self._bumped[requested] = (ts, count + 1)
+            self._requested[ts] = requested
+        self._times.add(ts)
+        bisect.insort(self._entries, (ts, key))
+        return ts
+
+    def remove(self, ts, key):
+        pos = bisect.bisect_left(self._entries, (ts, key))
+        if pos < len(self._entries) and self._entries[pos] == (ts, key):
+            del self._entries[pos]
+            self._times.discard(ts)
+            requested = self._requested.pop(ts, None)
+            if requested is not None:
+                last, count = self._bumped[requested]
+                if count > 1:
+                    self._bumped[requested] = (last, count - 1)
+                else:
+                    del self._bumped[requested]
+
+    def clear(self):
+        del self._entries[:]
+        self._times.clear()
+        self._bumped.clear()
+        self._requested.clear()
+
+    def newest(self):
+        if self._entries:
+            return self._entries[-1][0]
+        return None
+
+    def _bounds(self, since, until):
+        # Entries strictly after `since' and at or before `until'. A 1-tuple sorts
+        # before every (timestamp, key) entry holding the same timestamp.
+        lo = 0
+        hi = len(self._entries)
+        if since is not None:
+            lo = bisect.bisect_left(self._entries, ((since[0], since[1] + 1),))
+        if until is not None:
+            hi = bisect.bisect_left(self._entries, ((until[0], until[1] + 1),))
+        return lo, hi
+
+    def ascending(self, since=None, until=None):
+        """Yield (timestamp, key) oldest first, for since < timestamp <= until"""
+        lo, hi = self._bounds(since, until)
+        for pos in range(lo, hi):
+            yield self._entries[pos]
+
+    def descending(self, since=None, until=None):
+        """Yield (timestamp, key) newest first, for since < timestamp <= until"""
+        lo, hi = self._bounds(since, until)
+        for pos in range(hi - 1, lo - 1, -1):
+            yield self._entries[pos]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Page(object):
+    def __init__(self, items, since, until, limit):
+        self.items = items
+        self.since = since
+        self.until = until
+        self.limit = limit
+
+
+def paginate(order, resolve, since=None, until=None, limit=DEFAULT_PAGING_LIMIT):
+    """
+    Select one page of resources from the TimeOrder `order'. `resolve' maps a key
+    to the item to return, or None where the resource should be left out (eg.
+    because it doesn't match the query filters).
+
+    Where `since' is given, the page holds the oldest `limit' items after it;
+    otherwise it holds the newest `limit' items at or before `until'. Items are
+    returned newest first, and the page's since/until bounds exactly the items
+    returned, for use in building links to neighbouring pages. Only the entries
+    up to the end of the page are visited.
+    """
+    if until is None:
+        until = order.newest() or ZERO_TIMESTAMP
+
+    items = []
+    if since is not None:
+        page_until = until
+        last_ts = since
+        for ts, key in order.ascending(since, until):
+            if len(items) == limit:
+                page_until = last_ts
+                break
+            item = resolve(key)
+            if item is not None:
+                items.append(item)
+                last_ts = ts
+        items.reverse()
+        return Page(items, since, page_until, limit)
+
+    page_since = ZERO_TIMESTAMP
+    for ts, key in order.descending(None, until):
+        if len(items) == limit:
+            page_since = ts
+            break
+        item = resolve(key)
+        if item is not None:
+            items.append(item)
+    return Page(items, page_since, until, limit)
@@ -0,0 +1,139 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Field projection for 'query.fields' arguments.
+
+A comma separated list of property paths, such as
+
+    id,label,caps.media_types,transport_params.destination_port
+
+is compiled once into a function which copies just those properties of a
+resource, and is then called on each resource before it is encoded. Paths are
+dotted to reach into nested objects. Where a path passes through a list, it
+is followed into each object in the list, and where it passes through any
+other value, that value is kept whole. Keys such as tag names may themselves
+contain dots. Projected resources are new objects, so the resources they are
+projected from, which may be shared, are never modified.
+"""
+
+from six import string_types
+from six.moves import range
+
+FIELDS_ARG = "query.fields"
+
+# Fields kept however a resource is projected, so that it can always be identified
+ALWAYS_FIELDS = ["id"]
+
+# Maximum number of compiled projections held in the cache
+PROJECTION_CACHE_SIZE = 1024
+
+# Most parts a path may have. Each way of joining its parts into keys is compiled in.
+MAX_PATH_PARTS = 8
+
+_cache = {}
+
+
+class ProjectionError(ValueError):
+    """The list of fields is not valid"""
+    pass
+
+
+def for_args(args):
+    """
+    Return the projection selected by the 'query.fields' argument in args,
+    or None if there isn't one. Raises ProjectionError if it isn't valid.
+    """
+    if not args or FIELDS_ARG not in args:
+        return None
+    return compile(args[FIELDS_ARG])
+
+
+def compile(fields):
+    """
+    Return the projection for a comma separated list of property paths, which
+    may be called as projection(obj). Projections are cached against the list.
+    """
+    if not isinstance(fields, string_types):
+        raise ProjectionError("{} must be a comma separated list of fields".format(FIELDS_ARG))
+    projection = _cache.get(fields)
+    if projection is None:
+        projection = _build(_tree(parse(fields) + [[field] for field in ALWAYS_FIELDS]))
+        if len(_cache) >= PROJECTION_CACHE_SIZE:
+            _cache.clear()
+        _cache[fields] = projection
+    return projection
+
+
+def parse(fields):
+    """
+    Split a list of fields into the parts of each path
+
+>>> parse("id,caps.media_types")
+[['id'], ['caps', 'media_types']]
+"""
+    if not isinstance(fields, string_types):
+        raise ProjectionError("{} must be a comma separated list of fields".format(FIELDS_ARG))
+    paths = []
+    for field in fields.split(","):
+        parts = field.strip().split(".")
+        if "" in parts:
+            raise ProjectionError("Invalid field '{}' in {}".format(field, FIELDS_ARG))
+        if len(parts) > MAX_PATH_PARTS:
+            raise ProjectionError("Field '{}' in {} has more than {} parts".format(
+                field, FIELDS_ARG, MAX_PATH_PARTS))
+        paths.append(parts)
+    return paths
+
+
+def _groupings(parts):
+    """Generate every way of joining consecutive parts of a path into keys"""
+    for i in range(1, len(parts) + 1):
+        head = ".".join(parts[:i])
+        if i == len(parts):
+            yield [head]
+        else:
+            for rest in _groupings(parts[i:]):
+                yield [head] + rest
+
+
+def _tree(paths):
+    """Merge paths into nested dicts of the keys they select, where True selects a value whole"""
+    tree = {}
+    for path in paths:
+        for keys in _groupings(path):
+            node = tree
+            for key in keys[:-1]:
+                if node.get(key) is True:
+                    break
+                node = node.setdefault(key, {})
+            else:
+                node[keys[-1]] = True
+    return tree
+
+
+def _build(tree):
+    selected = [(key, None if subtree is True else _build(subtree)) for key, subtree in sorted(tree.items())]
+
+    def project(obj):
+        if isinstance(obj, list):
+            return [project(item) for item in obj]
+        if not isinstance(obj, dict):
+            return obj
+        result = {}
+        for key, child in selected:
+            if key in obj:
+                result[key] = obj[key] if child is None else child(obj[key])
+        return result
+    return project
@@ -0,0 +1,447 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from gevent import monkey
+monkey.patch_all()
+
+import json # noqa E402
+
+from nmoscommon.logger import Logger # noqa E402
+
+from .util import get_resourcetypes, translate_resourcetypes # noqa E402
+from .changewatcher import ChangeWatcher # noqa E402
+from .backends import Etcd2Backend, BackendError # noqa E402
+from .fieldindex import FieldIndex # noqa E402
+from .ancestry import RelationGraph, parse_ancestry_args # noqa E402
+from .paging import TimeOrder, PAGING_ORDERS, resource_timestamp # noqa E402
+from .translationcache import TranslationCache, DEFAULT_TRANSLATION_CACHE_SIZE # noqa E402
+from .metrics import REGISTRY, Counter, Histogram # noqa E402
+from . import VALID_TYPES # noqa E402
+from . import rql # noqa E402
+
+SET_ACTIONS = ["set", "create", "update", "compareAndSwap"]
+DELETE_ACTIONS = ["delete", "expire", "compareAndDelete"]
+
+WATCH_EVENTS = REGISTRY.register(Counter(
+    "nmosquery_watch_events_total", "Events received from the watch on the store", ["action"]))
+DISPATCH_DURATION = REGISTRY.register(Histogram(
+    "nmosquery_event_dispatch_duration_seconds",
+    "Time taken to pass each change to the subscriptions of every API version"))
+
+
+class Registry(object):
+    """
+    A local, materialised copy of the `/resource' tree held in etcd, or
+    another store (see backends.RegistryBackend).
+
+    The mirror is seeded from a snapshot of the store, which records the index
+    (revision) it reflects. It is then kept current by applying the events from
+    a watch on the store from the following index, so HTTP queries can be
+    answered without a round trip to etcd.
+
+    Resources are decoded once, as they arrive from the snapshot or the watch,
+    and held as objects keyed by resource type and then by etcd key (eg.
+    /resource/flows/{uid}), along with the etcd modifiedIndex of each. The
+    objects are shared by every query, so must not be modified. Foreign key and enum
+    fields are indexed as resources arrive (see fieldindex.FieldIndex), the
+    references between resources are kept in an ancestry.RelationGraph, and
+    each type is also held in creation and update order for paging. Creation
+    times aren't recorded in resources, so resources already present when the
+    mirror is seeded are taken to have been created at their current version.
+
+    The mirror may instead be seeded from `warm_start', the index and
+    resources of a snapshot written earlier (see dump and the snapshot module),
+    so that a restarted service needn't read the whole store. Should the store
+    no longer hold the changes made since, the watch reports them as missed,
+    and the mirror is resynced from the store as usual.
+
+    A single Registry owns the process-wide ChangeWatcher. Each watch event is
+    decoded once and then handed to every registered listener (one QueryCommon
+    per API version) through their do_sup and do_sdown methods.
+    """
+
+    def __init__(self, host, port, logger=None, translation_cache_size=DEFAULT_TRANSLATION_CACHE_SIZE, backend=None):
+        self.logger = Logger("registry", _parent=logger)
+        if backend is None:
+            backend = Etcd2Backend(host, port, logger=self.logger)
+        self.backend = backend
+        self._resources = {}
+        self._modified = {}
+        self._orders = {}
+        self._timestamps = {}
+        self.fields = FieldIndex()
+        self.graph = RelationGraph()
+        self.translations = TranslationCache(translation_cache_size)
+        self.index = 0
+        self.seeded = False
+        self.warm_start = None
+        self.listeners = []
+        self.clear()
+        self.watcher = ChangeWatcher(self.backend, handler=self, logger=self.logger)
+
+    @property
+    def ready(self):
+        """An Event set once the mirror is seeded, and being kept current from the index it was seeded at"""
+        return self.watcher.watching
+
+    def start(self):
+        if not self.watcher.started:
+            self.watcher.start()
+
+    def stop(self):
+        self.watcher.stop()
+        self.watcher.join(timeout=5)
+
+    def add_listener(self, listener):
+        if listener not in self.listeners:
+            self.listeners.append(listener)
+
+    def remove_listener(self, listener):
+        if listener in self.listeners:
+            self.listeners.remove(listener)
+
+    def del_all_socks(self):
+        """Disconnect the websocket clients of every listener"""
+        for listener in self.listeners:
+            listener.query_sockets.del_all_socks()
+
+    def clear(self):
+        self._resources = {rtype: {} for rtype in VALID_TYPES}
+        self._orders = {rtype: {order: TimeOrder() for order in PAGING_ORDERS} for rtype in VALID_TYPES}
+        self._timestamps = {}
+        self._modified = {}
+        self.fields.clear()
+        self.graph.clear()
+        self.translations.clear()
+
+    def seed(self):
+        """
+        Replace the contents of the mirror with a fresh snapshot of the store.
+        Returns the index the snapshot reflects, to be used as the point from
+        which to watch for changes, or None if the store could not be read.
+        The first time, any `warm_start' snapshot is used instead.
+        """
+        if self.warm_start is not None:
+            index, resources = self.warm_start
+            self.warm_start = None
+            self.restore(resources, index)
+            return self.index
+
+        try:
+            tree, index = self.backend.snapshot()
+        except BackendError as ex:
+            self.logger.writeWarning("Could not seed registry mirror: {}".format(ex))
+            return None
+
+        self.load(tree, index)
+        return self.index
+
+    def load(self, obj, index):
+        """Replace the contents of the mirror with a decoded etcd v2 style recursive GET response"""
+        self.clear()
+        self._load_node(obj.get('node', {}))
+        self.index = index
+        self.seeded = True
+        self.logger.writeInfo("Registry mirror seeded at index {} with {} resources".format(index, len(self)))
+
+    def restore(self, resources, index):
+        """As load, from a list of (etcd key, modifiedIndex, decoded object), such as dump returns"""
+        self.clear()
+        for key, modified_index, obj in resources:
+            if obj is not None:
+                self._set(key, None, obj, modified_index)
+        self.index = index
+        self.seeded = True
+        self.logger.writeInfo("Registry mirror restored at index {} with {} resources".format(index, len(self)))
+
+    def dump(self):
+        """
+        Return (index, resources): the index the mirror reflects, and a list of
+        (etcd key, modifiedIndex, decoded object) of the resources it holds,
+        consistent with it. The objects are shared, so must not be modified.
+        """
+        resources = [(key, self._modified.get(key), obj)
+                     for rtype in VALID_TYPES
+                     for key, obj in self._resources[rtype].items() if obj is not None]
+        return (self.index, resources)
+
+    def _load_node(self, node):
+        for leaf in _leaves(node):
+            self._set(leaf['key'], leaf['value'], modified_index=leaf.get('modifiedIndex'))
+
+    def resync(self):
+        """
+        Bring the mirror up to date with a fresh snapshot of the store after
+        changes have been missed, passing on the differences to listeners as if
+        they had been watched. Only resources which were created, modified or
+        deleted in the meantime are changed. Returns the index of the snapshot,
+        or None if the store could not be read.
+        """
+        if not self.seeded:
+            return self.seed()
+        try:
+            tree, index = self.backend.snapshot()
+        except BackendError as ex:
+            self.logger.writeWarning("Could not resync registry mirror: {}".format(ex))
+            return None
+
+        changes = []
+        current = set()
+        for leaf in _leaves(tree.get('node', {})):
+            key = leaf['key']
+            modified_index = leaf.get('modifiedIndex')
+            current.add(key)
+            if get_resourcetypes(key) not in self._resources or self._modified.get(key, -1) == modified_index:
+                continue
+            pre_obj = self.get_value(key) or {}
+            pre_index = self._modified.get(key)
+            self._set(key, leaf['value'], modified_index=modified_index)
+            changes.append(('do_sup', key, pre_obj, self.get_value(key) or {}, (pre_index, modified_index)))
+        for key in [key for key in self._modified if key not in current]:
+            pre_obj = self.get_value(key) or {}
+            pre_index = self._modified.get(key)
+            self._delete(key)
+            changes.append(('do_sdown', key, pre_obj, {}, (pre_index, index)))
+        self.index = index
+
+        self.logger.writeInfo("Registry mirror resynced at index {}: {} changes missed".format(index, len(changes)))
+        for method, key, pre_obj, post_obj, indexes in changes:
+            if method == 'do_sdown' or pre_obj != post_obj:
+                self._dispatch(method, key, pre_obj, post_obj, indexes)
+        return index
+
+    def _set(self, key, value, obj=None, modified_index=None):
+        rtype = get_resourcetypes(key)
+        if rtype in self._resources:
+            if obj is None:
+                try:
+                    obj = json.loads(value)
+                except ValueError:
+                    self.logger.writeWarning("Could not decode {}: invalid JSON".format(key))
+            if not isinstance(obj, dict):
+                # Held so the key is known, but never presented
+                obj = None
+            self._resources[rtype][key] = obj
+            self._modified[key] = modified_index
+            self.translations.invalidate(key)
+            self.fields.add(key, rtype, obj or {})
+            self.graph.add(key, rtype, obj or {})
+            self._set_timestamps(key, rtype, resource_timestamp(obj or {}))
+
+    def _set_timestamps(self, key, rtype, updated):
+        # Timestamps are kept unique within each order, so may be held a little later than given
+        orders = self._orders[rtype]
+        if key in self._timestamps:
+            created, previous = self._timestamps[key]
+            orders["update"].remove(previous, key)
+        else:
+            created = orders["create"].add(updated, key)
+        updated = orders["update"].add(updated, key)
+        self._timestamps[key] = (created, updated)
+
+    def _remove_timestamps(self, key, rtype):
+        if key in self._timestamps:
+            created, updated = self._timestamps.pop(key)
+            self._orders[rtype]["create"].remove(created, key)
+            self._orders[rtype]["update"].remove(updated, key)
+
+    def _delete(self, key):
+        rtype = get_resourcetypes(key)
+        if rtype not in self._resources:
+            if key.rstrip('/') == '/resource':
+                self.clear()
+            return
+        if key.rstrip('/').endswith('/resource/' + rtype):
+            for k in self._resources[rtype]:
+                self.fields.remove(k)
+                self.graph.remove(k)
+                self.translations.invalidate(k)
+                self._timestamps.pop(k, None)
+                self._modified.pop(k, None)
+            self._resources[rtype].clear()
+            for order in self._orders[rtype].values():
+                order.clear()
+        elif key in self._resources[rtype]:
+            del self._resources[rtype][key]
+            self.fields.remove(key)
+            self.graph.remove(key)
+            self.translations.invalidate(key)
+            self._modified.pop(key, None)
+            self._remove_timestamps(key, rtype)
+
+    def apply(self, event, obj=None):
+        """
+        Apply a single etcd v2 style watch event (a dict decoded from JSON) to the mirror.
+        `obj' may be given as the already decoded value of the event's node.
+        Returns True if the event changed the mirror, or False if it was not
+        applicable, for instance because the snapshot already reflects it.
+        """
+        if not self.seeded:
+            return False
+
+        action = event.get('action')
+        node = event.get('node', {})
+        modified_index = node.get('modifiedIndex', 0)
+        if modified_index <= self.index:
+            return False
+
+        if action in SET_ACTIONS and 'value' in node:
+            self._set(node['key'], node['value'], obj, modified_index)
+        elif action in DELETE_ACTIONS:
+            self._delete(node.get('key', ''))
+        else:
+            return False
+
+        self.index = modified_index
+        return True
+
+    def _process_response(self, response):
+        """
+        Process an event from the watch on the store.
+        `response' is a dict, in the form of an etcd v2 watch response.
+        """
+        self.logger.writeDebug('process response {}'.format(response))
+        action = response['action']
+        WATCH_EVENTS.labels(action).inc()
+        if action == 'index_skip':
+            # Changes have been missed, so find and pass on what they were
+            self.resync()
+            return
+
+        # Watch events concern a single key. Its values are decoded here, once, and
+        # the results shared by the mirror and every listener. As in the mirror,
+        # values which aren't valid resources are None.
+        node = response.get('node', {})
+        key = node.get('key', '')
+        restype = get_resourcetypes(key)
+        post_obj = {}
+        pre_obj = {}
+        if restype in VALID_TYPES:
+            post_obj = _loads(node.get('value', '{}'))
+            pre_obj = _loads(response.get('prevNode', {}).get('value', '{}'))
+
+        if self.seeded and not self.apply(response, post_obj):
+            # Already reflected in the snapshot
+            return
+        if action == 'set' or action == 'delete':
+            if restype in VALID_TYPES:
+                indexes = (response.get('prevNode', {}).get('modifiedIndex'), node.get('modifiedIndex'))
+                if action == 'set' and pre_obj != post_obj:
+                    self._dispatch('do_sup', key, pre_obj, post_obj, indexes)
+                elif action == 'delete':
+                    self._dispatch('do_sdown', key, pre_obj, post_obj, indexes)
+            else:
+                self.logger.writeError("Invalid type '{}' in response.".format(restype))
+
+    def _dispatch(self, method, path, pre_obj, post_obj, indexes):
+        # Listeners translate (and so copy) objects before modifying them, so the
+        # same decoded objects can safely be shared between all of them. The etcd
+        # modifiedIndex of each lets their translations be cached.
+        pre_index, post_index = indexes
+        with DISPATCH_DURATION.time():
+            for listener in list(self.listeners):
+                try:
+                    getattr(listener, method)(path, pre_obj, post_obj, pre_index=pre_index, post_index=post_index)
+                except Exception as ex:
+                    self.logger.writeError('Exception in {} for {}: {}'.format(method, listener.api_version, ex))
+
+    def get_resources(self, path=None, args=None):
+        """
+        Return a dict of etcd key -> decoded object (None if the value isn't a
+        valid resource) for resources matching the path, which may be None or
+        '/' (everything), /{type} or /{type}/{uid}.
+        Where `args' hold equality filters on indexed fields, including 'eq' and
+        'in' terms in a 'query.rql' expression, only resources which could match
+        those filters are returned; the filters must still be applied.
+        """
+        pattern = None
+        if path is not None and path != '/' and path != '':
+            pattern = translate_resourcetypes(path)
+
+        if pattern is None:
+            retval = {}
+            for resources in self._resources.values():
+                retval.update(resources)
+            return retval
+
+        parts = pattern.split('/')
+        resources = self._resources.get(parts[0], {})
+        if len(parts) == 1:
+            candidates = self.candidates(parts[0], args)
+            if candidates is not None:
+                return {key: resources[key] for key in candidates}
+            return dict(resources)
+
+        key = '/resource/{}'.format(pattern)
+        if key in resources:
+            return {key: resources[key]}
+        return {}
+
+    def candidates(self, rtype, args):
+        """
+        Return the set of keys of resources of type `rtype' which could match the
+        equality filters and any 'query.rql' expression in `args', or None if
+        the indexes can't narrow them down. Ancestry queries are answered here
+        in full, from the relationship graph.
+        """
+        candidates = self.fields.lookup(rtype, args)
+        try:
+            ancestry = parse_ancestry_args(args)
+        except ValueError:
+            ancestry = None
+        if ancestry is not None:
+            keys = set(key for key in self.graph.related_keys(*ancestry) if get_resourcetypes(key) == rtype)
+            candidates = keys if candidates is None else candidates & keys
+        if args and "query.rql" in args:
+            try:
+                keys = rql.compile(args["query.rql"]).candidates(self.fields, rtype)
+            except rql.RQLError:
+                keys = None
+            if keys is not None:
+                candidates = keys if candidates is None else candidates & keys
+        return candidates
+
+    def get_order(self, rtype, order="update"):
+        """Return the TimeOrder of resources of type `rtype' by creation or update time"""
+        return self._orders[rtype][order]
+
+    def get_value(self, key):
+        """Return the decoded object held for an etcd key, or None"""
+        return self._resources.get(get_resourcetypes(key), {}).get(key)
+
+    def get_modified_index(self, key):
+        """Return the etcd modifiedIndex of the value held for a key, or None"""
+        return self._modified.get(key)
+
+    def __len__(self):
+        return sum(len(resources) for resources in self._resources.values())
+
+
+def _loads(value):
+    """Decode the value of a resource, or return None if it isn't valid JSON of an object"""
+    try:
+        obj = json.loads(value)
+    except (TypeError, ValueError):
+        return None
+    return obj if isinstance(obj, dict) else None
+
+
+def _leaves(node):
+    """Generate the nodes holding values in an etcd v2 style tree of nodes"""
+    if 'dir' in node:
+        for child in node.get('nodes', []):
+            for leaf in _leaves(child):
+                yield leaf
+    elif 'value' in node:
+        yield node
@@ -0,0 +1,350 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Resource Query Language (RQL) support for 'query.rql' arguments.
+
+An expression such as
+
+    and(eq(format,urn:x-nmos:format:video),or(lt(grain_rate.numerator,30),ne(label,test)))
+
+is parsed once into a tree of terms, which is then called as a predicate on
+each resource. Property names may be dotted to reach into nested objects, and
+where a property holds a list (or passes through one) a comparison succeeds if
+it succeeds for any of the values. Values are URL decoded and converted as in
+RQL: 'true', 'false', 'null' and numbers become the equivalent JSON values,
+unless given a 'string:', 'number:' or 'boolean:' prefix.
+"""
+
+import re
+import operator
+from six import string_types
+from six.moves.urllib.parse import unquote
+from six.moves import range
+
+# Maximum number of compiled expressions held in the cache
+RQL_CACHE_SIZE = 1024
+
+_cache = {}
+
+_NUMBER = re.compile(r'^-?(\d+\.?\d*|\.\d+)([eE][-+]?\d+)?$')
+_DELIMITERS = '(),'
+
+
+class RQLError(ValueError):
+    """The expression is not valid RQL"""
+    pass
+
+
+class RQLNotSupported(RQLError):
+    """The expression uses an RQL operator which is not implemented"""
+    pass
+
+
+def compile(expression):
+    """
+    Return the term tree for an RQL expression string, which may be called as
+    predicate(obj). Trees are cached against the expression. Raises RQLError if
+    the expression is invalid, or RQLNotSupported if it uses unknown operators.
+    """
+    term = _cache.get(expression)
+    if term is None:
+        term = _build(parse(expression))
+        if len(_cache) >= RQL_CACHE_SIZE:
+            _cache.clear()
+        _cache[expression] = term
+    return term
+
+
+def parse(expression):
+    """
+    Parse an RQL expression into nested (operator, [args]) tuples, where array
+    arguments are lists and values are converted to their JSON types. Several
+    top level calls, separated by commas, are combined with 'and'.
+
+>>> parse("and(eq(a.b,1),in(c,(x,string:2)))")
+('and', [('eq', ['a.b', 1]), ('in', ['c', ['x', '2']])])
+"""
+    if not isinstance(expression, string_types):
+        raise RQLError("RQL expression must be a string")
+    parser = _Parser(expression)
+    calls = parser.parse_args()
+    if parser.pos != len(expression):
+        raise RQLError("Unexpected '{}' at position {}".format(expression[parser.pos], parser.pos))
+    if len(calls) == 0 or not all(isinstance(call, tuple) for call in calls):
+        raise RQLError("RQL expression must consist of operator calls")
+    if len(calls) == 1:
+        return calls[0]
+    return ('and', calls)
+
+
+class _Parser(object):
+    def __init__(self, text):
+        self.text = text
+        self.pos = 0
+
+    def _peek(self):
+        if self.pos < len(self.text):
+            return self.text[self.pos]
+        return None
+
+    def _token(self):
+        start = self.pos
+        while self.pos < len(self.text) and self.text[self.pos] not in _DELIMITERS:
+            self.pos += 1
+        return self.text[start:self.pos]
+
+    def _expect(self, char):
+        if self._peek() != char:
+            found = "end of expression" if self._peek() is None else "'{}'".format(self._peek())
+            raise RQLError("Expected '{}' but found {} at position {}".format(char, found, self.pos))
+        self.pos += 1
+
+    def parse_args(self):
+        """Parse comma separated arguments up to a closing bracket or the end of the text"""
+        args = []
+        if self._peek() in (')', None):
+            return args
+        while True:
+            args.append(self.parse_arg())
+            if self._peek() != ',':
+                return args
+            self.pos += 1
+
+    def parse_arg(self):
+        token = self._token()
+        if self._peek() == '(':
+            self.pos += 1
+            args = self.parse_args()
+            self._expect(')')
+            if token == '':
+                # A bracketed list of values
+                return args
+            return (unquote(token), args)
+        return _convert(unquote(token))
+
+
+def _convert(value):
+    if ':' in value:
+        kind, rest = value.split(':', 1)
+        if kind == 'string':
+            return rest
+        elif kind == 'number':
+            try:
+                return _number(rest)
+            except ValueError:
+                raise RQLError("Invalid number '{}'".format(rest))
+        elif kind == 'boolean':
+            return rest == 'true'
+    if value == 'true':
+        return True
+    elif value == 'false':
+        return False
+    elif value == 'null':
+        return None
+    elif _NUMBER.match(value):
+        return _number(value)
+    return value
+
+
+def _number(value):
+    try:
+        return int(value)
+    except ValueError:
+        return float(value)
+
+
+def _values(obj, parts):
+    """Yield every value found at the split dotted property path `parts' in obj"""
+    if isinstance(obj, list):
+        for item in obj:
+            for value in _values(item, parts):
+                yield value
+        return
+    if not parts:
+        yield obj
+        return
+    if isinstance(obj, dict):
+        # Keys such as tag names may themselves contain dots
+        for i in range(1, len(parts) + 1):
+            key = '.'.join(parts[:i])
+            if key in obj:
+                for value in _values(obj[key], parts[i:]):
+                    yield value
+
+
+class Term(object):
+    """A node in a compiled RQL expression"""
+
+    def __call__(self, obj):
+        raise NotImplementedError()
+
+    def candidates(self, index, rtype):
+        """
+        Return the set of keys which could match this term, from the FieldIndex
+        `index' for resources of type `rtype', or None if it can't narrow them.
+        """
+        return None
+
+
+class And(Term):
+    def __init__(self, terms):
+        self.terms = terms
+
+    def __call__(self, obj):
+        for term in self.terms:
+            if not term(obj):
+                return False
+        return True
+
+    def candidates(self, index, rtype):
+        retval = None
+        for term in self.terms:
+            keys = term.candidates(index, rtype)
+            if keys is not None:
+                retval = keys if retval is None else retval & keys
+        return retval
+
+
+class Or(Term):
+    def __init__(self, terms):
+        self.terms = terms
+
+    def __call__(self, obj):
+        for term in self.terms:
+            if term(obj):
+                return True
+        return False
+
+    def candidates(self, index, rtype):
+        retval = set()
+        for term in self.terms:
+            keys = term.candidates(index, rtype)
+            if keys is None:
+                return None
+            retval |= keys
+        return retval
+
+
+class Not(Term):
+    def __init__(self, term):
+        self.term = term
+
+    def __call__(self, obj):
+        return not self.term(obj)
+
+
+class Compare(Term):
+    def __init__(self, prop, compare, value):
+        self.prop = prop
+        self.parts = prop.split('.')
+        self.compare = compare
+        self.value = value
+
+    def __call__(self, obj):
+        for value in _values(obj, self.parts):
+            try:
+                if self.compare(value, self.value):
+                    return True
+            except TypeError:
+                # Values of different types can't be ordered
+                pass
+        return False
+
+    def candidates(self, index, rtype):
+        if self.compare is operator.eq:
+            return index.keys_for(rtype, self.prop, [self.value])
+        return None
+
+
+class In(Term):
+    def __init__(self, prop, values):
+        self.parts = prop.split('.')
+        self.prop = prop
+        self.values = values
+
+    def __call__(self, obj):
+        for value in _values(obj, self.parts):
+            if value in self.values:
+                return True
+        return False
+
+    def candidates(self, index, rtype):
+        return index.keys_for(rtype, self.prop, self.values)
+
+
+class Matches(Term):
+    def __init__(self, prop, pattern, flags=''):
+        self.parts = prop.split('.')
+        try:
+            self.regex = re.compile(pattern, re.IGNORECASE if 'i' in flags else 0)
+        except re.error as e:
+            raise RQLError("Invalid regular expression '{}': {}".format(pattern, e))
+
+    def __call__(self, obj):
+        for value in _values(obj, self.parts):
+            if isinstance(value, string_types) and self.regex.search(value):
+                return True
+        return False
+
+
+_COMPARISONS = {
+    'eq': operator.eq,
+    'lt': operator.lt,
+    'le': operator.le,
+    'gt': operator.gt,
+    'ge': operator.ge,
+}
+
+
+def _build(call):
+    if not isinstance(call, tuple):
+        raise RQLError("Expected an operator but found '{}'".format(call))
+    name, args = call
+    if name in ('and', 'or'):
+        if len(args) == 0:
+            raise RQLError("'{}' requires at least one argument".format(name))
+        terms = [_build(arg) for arg in args]
+        return And(terms) if name == 'and' else Or(terms)
+    elif name == 'not':
+        _check_args(name, args, 1, 1)
+        return Not(_build(args[0]))
+    elif name in _COMPARISONS or name == 'ne':
+        _check_args(name, args, 2, 2)
+        if name == 'ne':
+            return Not(Compare(_property(name, args), operator.eq, args[1]))
+        return Compare(_property(name, args), _COMPARISONS[name], args[1])
+    elif name in ('in', 'out'):
+        _check_args(name, args, 2, 2)
+        values = args[1] if isinstance(args[1], list) else [args[1]]
+        term = In(_property(name, args), values)
+        return term if name == 'in' else Not(term)
+    elif name == 'matches':
+        _check_args(name, args, 2, 3)
+        if not isinstance(args[1], string_types):
+            raise RQLError("'matches' requires a regular expression string")
+        flags = args[2] if len(args) == 3 else ''
+        return Matches(_property(name, args), args[1], flags if isinstance(flags, string_types) else '')
+    raise RQLNotSupported("RQL operator '{}' is not supported".format(name))
+
+
+def _check_args(name, args, least, most):
+    if not least <= len(args) <= most:
+        raise RQLError("Wrong number of arguments to '{}'".format(name))
+
+
+def _property(name, args):
+    if not isinstance(args[0], string_types) or args[0] == '':
+        raise RQLError("'{}' requires a property name".format(name))
+    return args[0]
@@ -20,6 +20,7 @@ import signal # noqa E402
 import time # noqa E402
 import gevent # noqa E402
 import os # noqa E402
+import multiprocessing # noqa E402
 
 # Handle if systemd is installed instead of newer cysystemd
 try:
@@ -34,6 +35,8 @@ from nmoscommon.logger import Logger # noqa E402
 from nmoscommon.mdns import MDNSEngine # noqa E402
 from nmoscommon.utils import getLocalIP # noqa E402
 from .api import QueryServiceAPI, QUERY_APIVERSIONS # noqa E402
+from .workers import Supervisor # noqa E402
+from .common.query import reg as query_reg # noqa E402
 from .config import config  # noqa E402
 
 reg = {'host': 'localhost', 'port': 2379}
@@ -44,6 +47,9 @@ DNS_SD_HTTPS_PORT = 443
 DNS_SD_NAME = 'query_' + str(HOST)
 DNS_SD_TYPE = '_nmos-query._tcp'
 
+# Seconds between checks that every worker is ready
+READY_POLL_INTERVAL = 0.5
+
 
 class QueryService:
 
@@ -53,7 +59,17 @@ class QueryService:
         self.logger.writeDebug('Running QueryService')
         self.config = config
         self.mdns = MDNSEngine()
-        self.httpServer = HttpServer(QueryServiceAPI, WS_PORT, '0.0.0.0', api_args=[self.logger, self.config])
+
+        # More than one worker process is run by a Supervisor, and 0 means one per CPU
+        workers = self.config.get("workers", 1)
+        if workers == 0:
+            workers = multiprocessing.cpu_count()
+        if workers > 1:
+            self.supervisor = Supervisor(workers, WS_PORT, '0.0.0.0', logger=self.logger, registry=query_reg)
+            self.httpServer = None
+        else:
+            self.supervisor = None
+            self.httpServer = HttpServer(QueryServiceAPI, WS_PORT, '0.0.0.0', api_args=[self.logger, self.config])
 
     def start(self):
         if self.running:
@@ -65,16 +81,21 @@ class QueryService:
 
         self.logger.writeDebug('Running web socket server on %i' % WS_PORT)
 
-        self.httpServer.start()
+        if self.supervisor is not None:
+            self.supervisor.start()
+            self.logger.writeDebug("Running {} workers on port: {}".format(self.supervisor.workers,
+                                                                           self.supervisor.port))
+        else:
+            self.httpServer.start()
 
-        while not self.httpServer.started.is_set():
-            self.logger.writeDebug('Waiting for httpserver to start...')
-            self.httpServer.started.wait()
+            while not self.httpServer.started.is_set():
+                self.logger.writeDebug('Waiting for httpserver to start...')
+                self.httpServer.started.wait()
 
-        if self.httpServer.failed is not None:
-            raise self.httpServer.failed
+            if self.httpServer.failed is not None:
+                raise self.httpServer.failed
 
-        self.logger.writeDebug("Running on port: {}".format(self.httpServer.port))
+            self.logger.writeDebug("Running on port: {}".format(self.httpServer.port))
 
         priority = self.config["priority"]
         if not str(priority).isdigit():
@@ -90,6 +111,15 @@ class QueryService:
             self.mdns.register(DNS_SD_NAME + "_https", DNS_SD_TYPE, DNS_SD_HTTPS_PORT,
                                self._mdns_txt(priority, QUERY_APIVERSIONS, "https", oauth_mode))
 
+    def wait_ready(self):
+        """Wait until the registry mirror, of every worker, is seeded and being kept current with the store"""
+        if self.supervisor is not None:
+            while self.running and not self.supervisor.ready():
+                time.sleep(READY_POLL_INTERVAL)
+        else:
+            self.httpServer.api.registry.ready.wait()
+        self.logger.writeInfo("Registry mirror ready")
+
     def _mdns_txt(self, priority, versions, protocol, oauth_mode):
         return {
             "pri": priority,
@@ -101,13 +131,17 @@ class QueryService:
     def run(self):
         self.running = True
         self.start()
+        self.wait_ready()
         daemon.notify(SYSTEMD_READY)
         while self.running:
             time.sleep(1)
 
     def _cleanup(self):
         self.mdns.close()
-        self.httpServer.stop()
+        if self.supervisor is not None:
+            self.supervisor.stop()
+        else:
+            self.httpServer.stop()
 
     def sig_handler(self):
         self.stop()
@@ -0,0 +1,115 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Snapshots of the registry mirror and of websocket subscriptions, written to a
+local file from time to time so that a restarted service can start warm:
+serving the resources it held, and the subscriptions its clients will
+reconnect to, at once, and watching the store from the index the snapshot
+reflects rather than reading all of it again.
+
+A snapshot is a line of JSON holding a header,
+
+    {"version": 1, "index": 1234, "time": ..., "resources": 2, "subscriptions": {"v1.3": [...], ...}}
+
+followed by a line for each resource, [key, modifiedIndex, resource]. It is
+read through mmap, so that a large snapshot is paged in as it is loaded
+rather than read into memory whole first.
+"""
+
+import os
+import json
+import mmap
+import time
+import gevent
+
+SNAPSHOT_VERSION = 1
+
+# Seconds between snapshots, which are only written if something has changed
+DEFAULT_SNAPSHOT_INTERVAL = 30
+
+# Resources written between yields to other greenlets
+WRITE_BATCH_SIZE = 1000
+
+
+class SnapshotError(Exception):
+    """A snapshot could not be read"""
+    pass
+
+
+def _line(obj):
+    return (json.dumps(obj, separators=(',', ':')) + "\n").encode('utf-8')
+
+
+def write_snapshot(path, index, resources, subscriptions=None):
+    """
+    Write a snapshot of `resources', a list of (key, modifiedIndex, object),
+    reflecting the store at `index', along with `subscriptions', a dict of the
+    records of subscriptions by API version. The file is replaced atomically,
+    so a snapshot being read is never one partly written.
+    """
+    temp = "{}.{}.tmp".format(path, os.getpid())
+    header = {
+        "version": SNAPSHOT_VERSION,
+        "index": index,
+        "time": time.time(),
+        "resources": len(resources),
+        "subscriptions": subscriptions or {}
+    }
+    try:
+        with open(temp, "wb") as f:
+            f.write(_line(header))
+            for count, resource in enumerate(resources, 1):
+                f.write(_line(resource))
+                if count % WRITE_BATCH_SIZE == 0:
+                    gevent.sleep(0)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp, path)
+    except Exception:
+        if os.path.exists(temp):
+            os.unlink(temp)
+        raise
+
+
+def read_snapshot(path):
+    """
+    Return (header, resources) from the snapshot at `path', where resources is
+    a list of (key, modifiedIndex, object). Raises SnapshotError if there is
+    no snapshot, or it can't be used.
+    """
+    try:
+        with open(path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                raise SnapshotError("Snapshot {} is empty".format(path))
+            contents = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (IOError, OSError) as ex:
+        raise SnapshotError("Could not open snapshot {}: {}".format(path, ex))
+
+    try:
+        header = json.loads(contents.readline().decode('utf-8'))
+        if not isinstance(header, dict) or header.get("version") != SNAPSHOT_VERSION:
+            raise SnapshotError("Snapshot {} is not of version {}".format(path, SNAPSHOT_VERSION))
+        resources = []
+        for line in iter(contents.readline, b""):
+            key, modified_index, obj = json.loads(line.decode('utf-8'))
+            resources.append((key, modified_index, obj))
+    except (ValueError, TypeError) as ex:
+        raise SnapshotError("Snapshot {} is corrupt: {}".format(path, ex))
+    finally:
+        contents.close()
+
+    if len(resources) != header.get("resources"):
+        raise SnapshotError("Snapshot {} is incomplete".format(path))
+    return (header, resources)
@@ -0,0 +1,125 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+
+from .util import translate_resourcetypes, get_resourcetypes
+from .fieldindex import INDEXED_FIELDS
+from . import VALID_TYPES
+
+
+class SubscriptionIndex(object):
+    """
+    Websocket subscriptions, by the resource type they watch and then by the
+    value of one equality filter in their params, so that each change need only
+    be tested against the subscriptions which could match it.
+
+    Like FieldIndex, this only narrows down candidates, and is consistent with
+    QueryFilterCommon: a subscription indexed on a field is a candidate for a
+    resource holding the same value in that field, or a "falsy" value, which
+    always passes the filter. Subscriptions without a usable filter, or which
+    watch every type, are candidates for every change of their type.
+    """
+
+    def __init__(self):
+        self._seq = itertools.count()
+        self._entries = {}
+        self._all_types = set()
+        self._types = {}
+        self.clear()
+
+    def clear(self):
+        self._entries = {}
+        self._all_types = set()
+        self._types = {rtype: {"unindexed": set(), "fields": {}} for rtype in VALID_TYPES}
+
+    def add(self, sock):
+        self.remove(sock)
+        rtype = translate_resourcetypes(sock.resource_path or '').split('/')[0]
+        location = None
+        if rtype not in self._types:
+            # Every type, or a path which needs testing against every change
+            bucket = self._all_types
+        else:
+            field = self._index_field(rtype, sock.params)
+            if field is None:
+                bucket = self._types[rtype]["unindexed"]
+            else:
+                location = (rtype, field, sock.params[field])
+                values = self._types[rtype]["fields"].setdefault(field, {})
+                bucket = values.setdefault(location[2], set())
+        bucket.add(sock)
+        self._entries[sock] = (next(self._seq), bucket, location)
+
+    def remove(self, sock):
+        entry = self._entries.pop(sock, None)
+        if entry is None:
+            return
+        seq, bucket, location = entry
+        bucket.discard(sock)
+        if location is not None and not bucket:
+            rtype, field, value = location
+            values = self._types[rtype]["fields"][field]
+            del values[value]
+            if not values:
+                del self._types[rtype]["fields"][field]
+
+    def _index_field(self, rtype, params):
+        if not isinstance(params, dict):
+            return None
+        fields = [field for field in params if self._indexable(field, params[field])]
+        if not fields:
+            return None
+        # Prefer fields which are most likely to be selective
+        preferred = ["id"] + INDEXED_FIELDS.get(rtype, [])
+        fields.sort(key=lambda field: (preferred.index(field) if field in preferred else len(preferred), field))
+        return fields[0]
+
+    def _indexable(self, field, value):
+        if "." in field or field.startswith("query.") or field.startswith("paging."):
+            return False
+        try:
+            hash(value)
+        except TypeError:
+            return False
+        return True
+
+    def candidates(self, path, obj=None, p_obj=None):
+        """
+        Return the subscriptions which could be interested in a change to the
+        resource at etcd key `path', from p_obj to obj, in the order they were added.
+        """
+        found = set(self._all_types)
+        entry = self._types.get(get_resourcetypes(path))
+        if entry is not None:
+            found.update(entry["unindexed"])
+            for field, values in entry["fields"].items():
+                for resource in (obj, p_obj):
+                    if resource and field in resource:
+                        self._match_value(values, resource[field], found)
+        return sorted(found, key=lambda sock: self._entries[sock][0])
+
+    def _match_value(self, values, value, found):
+        if not value:
+            for socks in values.values():
+                found.update(socks)
+            return
+        for val in (value if isinstance(value, list) else [value]):
+            try:
+                found.update(values.get(val, ()))
+            except TypeError:
+                pass
+
+    def __len__(self):
+        return len(self._entries)
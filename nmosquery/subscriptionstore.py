@@ -0,0 +1,162 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import re
+import json
+import time
+import errno
+from six import string_types
+
+# Subscription ids are used as file names, so nothing else is accepted as one
+_UUID = re.compile(r'^[0-9a-fA-F-]{36}$')
+
+
+class SubscriptionStore(object):
+    """
+    Websocket subscriptions shared between worker processes (see
+    nmosquery.workers), held as a file each in the directory `path', so that a
+    subscription created through any worker can be served by all of them.
+
+    Records are whatever QuerySocketsCommon needs to recreate a subscription.
+    A worker serving subscribers of a subscription marks it as "attached", so
+    that a non-persistent subscription is only removed once the last worker
+    serving it has lost its last subscriber.
+    """
+
+    def __init__(self, path, worker):
+        self.path = path
+        self.worker = str(worker)
+        try:
+            os.makedirs(path)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    def for_version(self, api_version):
+        """Return the store for the subscriptions of one API version"""
+        return SubscriptionStore(os.path.join(self.path, api_version), self.worker)
+
+    def _file(self, uid, suffix=".json"):
+        return os.path.join(self.path, uid + suffix)
+
+    def _marker(self, uid, worker):
+        return self._file(uid, ".{}.attached".format(worker))
+
+    def save(self, uid, record):
+        if not _UUID.match(uid):
+            raise ValueError("Invalid subscription id {}".format(uid))
+        temp = self._file(uid, ".{}.tmp".format(self.worker))
+        with open(temp, "w") as f:
+            json.dump(record, f)
+        # Renamed into place, so that other workers never read a partial record
+        os.rename(temp, self._file(uid))
+
+    def get(self, uid):
+        """Return the record of a subscription, or None if there is no such subscription"""
+        if not isinstance(uid, string_types) or not _UUID.match(uid):
+            return None
+        try:
+            with open(self._file(uid)) as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return None
+
+    def exists(self, uid):
+        return os.path.exists(self._file(uid))
+
+    def records(self):
+        """Return the records of every subscription, oldest first"""
+        found = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.path, name)) as f:
+                    found.append((os.fstat(f.fileno()).st_mtime, name, json.load(f)))
+            except (IOError, OSError, ValueError):
+                # Removed while being listed
+                continue
+        return [record for _, _, record in sorted(found, key=lambda entry: entry[:2])]
+
+    def remove(self, uid):
+        if not _UUID.match(uid):
+            return
+        for name in os.listdir(self.path):
+            if name.startswith(uid + ".") and not name.endswith(".tmp"):
+                _unlink(os.path.join(self.path, name))
+
+    def attach(self, uid):
+        """Record that this worker is serving subscribers of a subscription"""
+        if self.exists(uid):
+            open(self._marker(uid, self.worker), "a").close()
+
+    def detach(self, uid, worker=None):
+        """
+        Record that this worker, or the one given, has stopped serving
+        subscribers of a subscription. A non-persistent subscription which no
+        worker is serving any longer is removed, and True returned.
+        """
+        _unlink(self._marker(uid, self.worker if worker is None else worker))
+        if self.attached(uid):
+            return False
+        record = self.get(uid)
+        if record is None or record["summary"].get("persist", False):
+            return False
+        self.remove(uid)
+        return True
+
+    def detach_worker(self, worker):
+        """Detach a worker which has died from every subscription it was serving, of every API version"""
+        suffix = ".{}.attached".format(worker)
+        for name in os.listdir(self.path):
+            if os.path.isdir(os.path.join(self.path, name)):
+                self.for_version(name).detach_worker(worker)
+            elif name.endswith(suffix):
+                self.detach(name[:-len(suffix)], worker)
+
+    def unclaimed(self, age):
+        """
+        Return the ids of non-persistent subscriptions which no worker is
+        serving, saved more than `age' seconds ago. Those which have lost their
+        last subscriber are already gone (see detach), so these have never had one.
+        """
+        found = []
+        now = time.time()
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            uid = name[:-len(".json")]
+            try:
+                if now - os.path.getmtime(self._file(uid)) < age:
+                    continue
+            except OSError:
+                continue
+            record = self.get(uid)
+            if record is not None and not record["summary"].get("persist", False) and not self.attached(uid):
+                found.append(uid)
+        return found
+
+    def attached(self, uid):
+        """Whether any worker is serving subscribers of a subscription"""
+        prefix = uid + "."
+        return any(name.startswith(prefix) and name.endswith(".attached") for name in os.listdir(self.path))
+
+
+def _unlink(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
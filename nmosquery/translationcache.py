@@ -0,0 +1,91 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import OrderedDict
+
+DEFAULT_TRANSLATION_CACHE_SIZE = 50000
+
+
+class TranslationCache(object):
+    """
+    A bounded cache of resources as presented to clients, that is after being
+    decoded and translated to an API version (see translate_api_version).
+
+    Entries are keyed on (etcd key, etcd modifiedIndex, api_version, downgrade
+    target), so a changed resource can never be served from a stale entry, and
+    the registry also invalidates all of a key's entries as it changes. When
+    full, the oldest entries are evicted first.
+
+    Cached objects are shared between every request and subscription which
+    asks for them, so they must not be modified.
+    """
+
+    def __init__(self, size=DEFAULT_TRANSLATION_CACHE_SIZE):
+        self.size = size
+        self._entries = OrderedDict()
+        self._by_key = {}
+        self.hits = 0
+        self.misses = 0
+
+    def clear(self):
+        self._entries.clear()
+        self._by_key = {}
+
+    def get(self, key, modified_index, api_version, downgrade_ver, translate):
+        """
+        Return the cached translation of the resource at `key', calling
+        translate() to produce it on a miss. Where modified_index is None the
+        version of the resource isn't known, so it is translated uncached.
+        """
+        if modified_index is None or self.size <= 0:
+            return translate()
+        cache_key = (key, modified_index, api_version, downgrade_ver)
+        try:
+            value = self._entries[cache_key]
+        except KeyError:
+            self.misses += 1
+        else:
+            self.hits += 1
+            return value
+
+        value = translate()
+        while len(self._entries) >= self.size:
+            self._forget(self._entries.popitem(last=False)[0])
+        self._entries[cache_key] = value
+        self._by_key.setdefault(key, set()).add(cache_key)
+        return value
+
+    def _forget(self, cache_key):
+        keys = self._by_key.get(cache_key[0])
+        if keys is not None:
+            keys.discard(cache_key)
+            if not keys:
+                del self._by_key[cache_key[0]]
+
+    def invalidate(self, key):
+        """Drop every entry for the resource at `key'"""
+        for cache_key in self._by_key.pop(key, ()):
+            self._entries.pop(cache_key, None)
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "size": len(self._entries),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": float(self.hits) / lookups if lookups else 0.0
+        }
+
+    def __len__(self):
+        return len(self._entries)
@@ -17,11 +17,10 @@ from nmosquery.v1_1.querysockets import QuerySockets, QueryFilter
 
 
 class Query(QueryCommon):
-    def __init__(self, logger=None):
-        super(Query, self).__init__(logger, "v1.1")
+    def __init__(self, logger=None, registry=None):
+        super(Query, self).__init__(logger, "v1.1", registry)
         self.query_sockets = QuerySockets(WS_PORT, logger=self.logger)
 
-    # see if object matches supplied arguments
-    def _matches_args(self, obj, args):
-        arg_checker = QueryFilter()
-        return arg_checker.check_args(args, obj)
+    # compile supplied arguments into a predicate on objects
+    def _compile_args(self, args):
+        return QueryFilter().compile(args)
@@ -18,6 +18,6 @@ from nmosquery.v1_1.query import Query
 
 
 class Routes(RoutesCommon):
-    def __init__(self, logger, config):
-        query = Query(logger=logger)
+    def __init__(self, logger, config, registry=None):
+        query = Query(logger=logger, registry=registry)
         super(Routes, self).__init__(logger, config, "v1.1", query)
@@ -41,13 +41,11 @@ class QuerySockets(QuerySocketsCommon):
             logger=self.logger,
             authorization=OAUTH_MODE
         )
-        self.sockets.append(sock)
-        self.logger.writeDebug('Number of active sockets: {}'.format(len(self.sockets)))
+        self.register_sock(sock)
         return sock
 
-    def _check_args(self, s, obj):
-        arg_checker = QueryFilter()
-        return arg_checker.check_args(s.params, obj)
+    def _compile_params(self, params):
+        return QueryFilter().compile(params)
 
     # summarise service in a presentable way
     def _summarise(self, obj):
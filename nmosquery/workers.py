@@ -0,0 +1,305 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Pre-forked worker processes for the Query API.
+
+A Supervisor binds the listening socket and starts a number of worker
+processes which all accept connections from it, so that decoding, filtering
+and encoding are spread across CPU cores. Each worker keeps its own registry
+mirror. Websocket subscriptions are shared through a SubscriptionStore, so a
+subscription created through one worker has a ws_href which any of them will
+serve. Workers which die are restarted, and the load on each is logged.
+
+Workers are started as `python -m nmosquery.workers', inheriting the socket.
+"""
+
+from gevent import monkey
+monkey.patch_all()
+
+import os # noqa E402
+import sys # noqa E402
+import json # noqa E402
+import time # noqa E402
+import shutil # noqa E402
+import signal # noqa E402
+import socket # noqa E402
+import argparse # noqa E402
+import tempfile # noqa E402
+import subprocess # noqa E402
+import gevent # noqa E402
+import gevent.event # noqa E402
+from six import PY2 # noqa E402
+
+from gevent.pywsgi import WSGIServer # noqa E402
+from geventwebsocket.handler import WebSocketHandler # noqa E402
+from nmoscommon.httpserver import HttpServer # noqa E402
+from nmoscommon.logger import Logger # noqa E402
+
+from .subscriptionstore import SubscriptionStore # noqa E402
+
+# Seconds between reports of the load on each worker
+STATUS_INTERVAL = 10
+# Minimum seconds between starts of the same worker, so that one which fails at once isn't restarted in a tight loop
+RESTART_DELAY = 1
+# Seconds allowed for workers to exit when stopped, before they are killed
+STOP_TIMEOUT = 10
+
+LISTEN_BACKLOG = 1024
+
+
+def listen(host, port, backlog=LISTEN_BACKLOG):
+    """Return a listening socket to be shared by worker processes"""
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    # Inherited by accepted connections on Linux, so that responses, which pywsgi
+    # writes in several parts, aren't held up by Nagle's algorithm
+    listener.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    listener.bind((host, port))
+    listener.listen(backlog)
+    return listener
+
+
+class ListenerHttpServer(HttpServer):
+    """An HttpServer for a socket which is already listening, such as one shared by several worker processes"""
+
+    def __init__(self, api, listener, **kwargs):
+        super(ListenerHttpServer, self).__init__(api, listener.getsockname()[1], **kwargs)
+        self.listener = listener
+
+    def run(self):
+        try:
+            self.api = self.api_class(*self.api_args, **self.api_kwargs)
+            self.api.port = self.port
+            self.server = WSGIServer(self.listener, self.api.app, handler_class=WebSocketHandler, **(self.ssl or {}))
+            self.server.start()
+        except Exception as e:
+            self.failed = e
+        self.started.set()
+        if self.failed is None:
+            self.server.serve_forever()
+
+
+class Supervisor(object):
+    """
+    Runs `workers' processes serving the Query API on a listening socket of
+    its own, restarting any which die, and logging the load on each of them
+    every STATUS_INTERVAL seconds.
+    """
+
+    def __init__(self, workers, port, host='0.0.0.0', logger=None, registry=None):
+        self.workers = workers
+        self.port = port
+        self.host = host
+        self.logger = Logger("workers", _parent=logger)
+        self.registry = registry
+        self.listener = None
+        self.state_dir = None
+        self.store = None
+        self.processes = {}
+        self.started_at = {}
+        self.restarts = {}
+        self.running = False
+        self._last_status = {}
+        self._monitor = None
+
+    def start(self):
+        self.listener = listen(self.host, self.port)
+        self.port = self.listener.getsockname()[1]
+        self.state_dir = tempfile.mkdtemp(prefix="nmosquery-")
+        os.mkdir(os.path.join(self.state_dir, "workers"))
+        self.store = SubscriptionStore(os.path.join(self.state_dir, "subscriptions"), "supervisor")
+        self.running = True
+        for index in range(self.workers):
+            self._start_worker(index)
+        self._monitor = gevent.spawn(self._run)
+
+    def _start_worker(self, index):
+        fd = self.listener.fileno()
+        args = [sys.executable, "-m", "nmosquery.workers", "--worker", str(index), "--fd", str(fd),
+                "--state-dir", self.state_dir]
+        if self.registry is not None:
+            args += ["--registry", "{}:{}".format(self.registry["host"], self.registry["port"])]
+        env = dict(os.environ)
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env["PYTHONPATH"] = os.pathsep.join(path for path in [package_dir, env.get("PYTHONPATH")] if path)
+        if PY2:
+            process = subprocess.Popen(args, env=env, close_fds=False)
+        else:
+            process = subprocess.Popen(args, env=env, pass_fds=(fd,))
+        self.processes[index] = process
+        self.started_at[index] = time.time()
+        self.logger.writeInfo("Started worker {} (pid {})".format(index, process.pid))
+
+    def _run(self):
+        last_report = time.time()
+        while self.running:
+            gevent.sleep(1)
+            try:
+                self.check()
+                if time.time() - last_report >= STATUS_INTERVAL:
+                    last_report = time.time()
+                    self.report()
+            except Exception as ex:
+                self.logger.writeError("Failed to check workers: {}".format(ex))
+
+    def check(self):
+        """Restart any worker which has died"""
+        for index, process in list(self.processes.items()):
+            code = process.poll()
+            if code is None or time.time() - self.started_at[index] < RESTART_DELAY:
+                continue
+            self.logger.writeError("Worker {} (pid {}) exited with {}, restarting".format(index, process.pid, code))
+            self.restarts[index] = self.restarts.get(index, 0) + 1
+            self.store.detach_worker(index)
+            self._start_worker(index)
+
+    def status(self):
+        """
+        Return the status last reported by each worker: its pid, CPU time,
+        requests answered, subscriptions and subscribers, and the number of
+        times it has been restarted. Where two reports have been seen from the
+        same process, its CPU use and request rate between them are included.
+        """
+        statuses = []
+        for index, process in sorted(self.processes.items()):
+            status = self._read_status(index, process)
+            status.update(worker=index, pid=process.pid, restarts=self.restarts.get(index, 0))
+            previous = self._last_status.get(index)
+            if "time" in status:
+                if previous is not None and previous["pid"] == status["pid"] and status["time"] > previous["time"]:
+                    elapsed = status["time"] - previous["time"]
+                    status["cpu_percent"] = 100.0 * (status["cpu"] - previous["cpu"]) / elapsed
+                    status["request_rate"] = (status["requests"] - previous["requests"]) / elapsed
+                self._last_status[index] = status
+            statuses.append(status)
+        return statuses
+
+    def _read_status(self, index, process):
+        try:
+            with open(os.path.join(self.state_dir, "workers", "{}.json".format(index))) as f:
+                status = json.load(f)
+        except (IOError, OSError, ValueError):
+            return {}
+        if status.get("pid") != process.pid:
+            # Not yet reported, or left by its predecessor
+            return {}
+        return status
+
+    def ready(self):
+        """Whether every worker has reported that its registry mirror is seeded and being kept current"""
+        return all(self._read_status(index, process).get("ready", False)
+                   for index, process in self.processes.items())
+
+    def report(self):
+        for status in self.status():
+            details = ["{:.1f}% CPU".format(status["cpu_percent"]) if "cpu_percent" in status else None,
+                       "{:.1f} requests/s".format(status["request_rate"]) if "request_rate" in status else None,
+                       "{} subscribers".format(status["subscribers"]) if "subscribers" in status else None,
+                       "{} restarts".format(status["restarts"])]
+            self.logger.writeInfo("Worker {} (pid {}): {}".format(
+                status["worker"], status["pid"], ", ".join(detail for detail in details if detail is not None)))
+
+    def stop(self):
+        self.running = False
+        if self._monitor is not None:
+            self._monitor.kill(block=False)
+            self._monitor = None
+        processes = list(self.processes.values())
+        for process in processes:
+            try:
+                process.terminate()
+            except OSError:
+                # Already gone
+                pass
+        deadline = time.time() + STOP_TIMEOUT
+        for process in processes:
+            while process.poll() is None and time.time() < deadline:
+                gevent.sleep(0.1)
+            if process.poll() is None:
+                process.kill()
+        self.processes = {}
+        if self.listener is not None:
+            self.listener.close()
+            self.listener = None
+        if self.state_dir is not None:
+            shutil.rmtree(self.state_dir, ignore_errors=True)
+            self.state_dir = None
+
+
+def write_status(path, status):
+    temp = path + ".tmp"
+    with open(temp, "w") as f:
+        json.dump(status, f)
+    os.rename(temp, path)
+
+
+def run_worker(index, fd, state_dir):
+    """Serve the Query API on the inherited listening socket `fd' until told to stop, or the supervisor has gone"""
+    # Imported here, so that the supervisor doesn't load what only workers need
+    from .api import QueryServiceAPI, REQUESTS
+    from .config import config
+
+    logger = Logger("regquery")
+    listener = socket.fromfd(fd, socket.AF_INET, socket.SOCK_STREAM)
+    os.close(fd)
+    store = SubscriptionStore(os.path.join(state_dir, "subscriptions"), index)
+    # Every worker starts from any snapshot, but only the first writes them
+    server = ListenerHttpServer(QueryServiceAPI, listener, api_args=[logger, config],
+                                api_kwargs={"subscriptions": store, "write_snapshots": index == 0})
+    server.start()
+    server.started.wait()
+    if server.failed is not None:
+        raise server.failed
+    logger.writeInfo("Worker {} (pid {}) serving on port {}".format(index, os.getpid(), server.port))
+
+    stopping = gevent.event.Event()
+    gevent.signal_handler(signal.SIGTERM, stopping.set)
+    gevent.signal_handler(signal.SIGINT, stopping.set)
+    supervisor = os.getppid()
+    path = os.path.join(state_dir, "workers", "{}.json".format(index))
+    while not stopping.is_set() and os.getppid() == supervisor:
+        sockets = [sock for api in server.api.apis() for sock in api.query.query_sockets.sockets]
+        times = os.times()
+        write_status(path, {
+            "pid": os.getpid(),
+            "time": time.time(),
+            "cpu": times[0] + times[1],
+            "requests": sum(value for _, _, value in REQUESTS.samples()),
+            "subscriptions": len(sockets),
+            "subscribers": sum(len(sock.subscribers) for sock in sockets),
+            "ready": server.api.registry.ready.is_set(),
+        })
+        stopping.wait(1)
+    server.stop()
+    server.server.stop(timeout=1)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run one worker process of the Query API, under a Supervisor")
+    parser.add_argument("--worker", type=int, required=True, help="index of this worker")
+    parser.add_argument("--fd", type=int, required=True, help="file descriptor of the listening socket")
+    parser.add_argument("--state-dir", required=True, help="directory of state shared between workers")
+    parser.add_argument("--registry", help="host:port of the registry's etcd")
+    args = parser.parse_args(argv)
+    if args.registry:
+        from .common.query import reg
+        host, port = args.registry.rsplit(":", 1)
+        reg["host"] = host
+        reg["port"] = int(port)
+    run_worker(args.worker, args.fd, args.state_dir)
+
+
+if __name__ == '__main__':
+    main()
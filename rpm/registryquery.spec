@@ -27,6 +27,7 @@ Requires:       python-ws4py
 Requires:       ips-etcd
 Requires:       ips-reverseproxy-common
 Requires:       nmoscommon
+Requires:       python-mediajson
 %{?systemd_requires}
 
 %description
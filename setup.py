@@ -47,6 +47,7 @@ package_names = packages.keys()
 packages_required = [
     "gevent>=1.2.2",
     "nmoscommon>=0.20.0",
+    "mediajson",
     "flask>=0.10.1",
     "cysystemd",
     "ws4py>=0.3.4",
@@ -57,7 +58,7 @@ packages_required = [
 
 setup(
     name="registryquery",
-    version="0.8.3",
+    version="0.27.14",
     description="BBC implementation of an AMWA NMOS Query API",
     url='https://github.com/bbc/nmos-query',
     author='Peter Brightwell',
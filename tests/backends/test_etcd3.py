@@ -0,0 +1,196 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import mock
+import json
+import base64
+
+from nmosquery.backends import Etcd3Backend, BackendError
+from nmosquery.backends.etcd3 import translate_event, RANGE_PAGE_SIZE
+
+# Only once nmosquery has monkey patched ssl
+import requests
+from urllib3.exceptions import ReadTimeoutError
+
+
+def b64(value):
+    return base64.b64encode(value.encode('utf-8')).decode('ascii')
+
+
+def kv(key, value=None, mod_revision=None, create_revision=None):
+    retval = {"key": b64(key)}
+    if value is not None:
+        retval["value"] = b64(value)
+    if mod_revision is not None:
+        retval["mod_revision"] = str(mod_revision)
+    if create_revision is not None:
+        retval["create_revision"] = str(create_revision)
+    return retval
+
+
+def response(obj, status_code=200):
+    retval = mock.MagicMock(name='response', status_code=status_code)
+    retval.json.return_value = obj
+    return retval
+
+
+class TestEtcd3Backend(unittest.TestCase):
+    def setUp(self):
+        self.UUT = Etcd3Backend("localhost", 2379, logger=mock.MagicMock(name="logger"))
+
+    def test_snapshot(self):
+        """Snapshots should be read in pages, all at the revision of the first"""
+        pages = [
+            response({"header": {"revision": "42"}, "more": True, "count": "3",
+                      "kvs": [kv("/resource/flows/a", "{}", 10, 9), kv("/resource/flows/b", "[]", 11, 11)]}),
+            response({"header": {"revision": "45"}, "count": "1", "kvs": [kv("/resource/nodes/c", "{}", 12, 12)]}),
+        ]
+        with mock.patch.object(self.UUT.pool, 'post', side_effect=pages) as post:
+            tree, index = self.UUT.snapshot()
+        self.assertEqual(index, 42)
+        self.assertEqual(tree, {"node": {"key": "/resource", "dir": True, "nodes": [
+            {"key": "/resource/flows/a", "value": "{}", "modifiedIndex": 10, "createdIndex": 9},
+            {"key": "/resource/flows/b", "value": "[]", "modifiedIndex": 11, "createdIndex": 11},
+            {"key": "/resource/nodes/c", "value": "{}", "modifiedIndex": 12, "createdIndex": 12},
+        ]}})
+
+        requests = [json.loads(call[1]["data"]) for call in post.call_args_list]
+        self.assertEqual(post.call_args_list[0][0][0], "http://localhost:2379/v3/kv/range")
+        self.assertEqual(requests[0], {"key": b64("/resource/"), "range_end": b64("/resource0"),
+                                       "limit": RANGE_PAGE_SIZE})
+        self.assertEqual(requests[1], {"key": b64("/resource/flows/b\x00"), "range_end": b64("/resource0"),
+                                       "limit": RANGE_PAGE_SIZE, "revision": 42})
+
+    def test_snapshot_empty(self):
+        with mock.patch.object(self.UUT.pool, 'post', return_value=response({"header": {"revision": "7"}})):
+            self.assertEqual(self.UUT.snapshot(), ({}, 7))
+
+    def test_snapshot_failure(self):
+        with mock.patch.object(self.UUT.pool, 'post', side_effect=Exception):
+            self.assertRaises(BackendError, self.UUT.snapshot)
+        with mock.patch.object(self.UUT.pool, 'post', return_value=response({}, status_code=503)):
+            self.assertRaises(BackendError, self.UUT.snapshot)
+
+    def test_translate_event(self):
+        self.assertEqual(translate_event({"kv": kv("/resource/flows/a", "{}", 10, 9)}, 10), {
+            "action": "set", "node": {"key": "/resource/flows/a", "value": "{}", "modifiedIndex": 10, "createdIndex": 9}
+        })
+        self.assertEqual(translate_event({"type": "DELETE", "kv": kv("/resource/flows/a", mod_revision=12),
+                                          "prev_kv": kv("/resource/flows/a", "{}", 10, 9)}, 12), {
+            "action": "delete", "node": {"key": "/resource/flows/a", "modifiedIndex": 12},
+            "prevNode": {"key": "/resource/flows/a", "value": "{}", "modifiedIndex": 10, "createdIndex": 9}
+        })
+        self.assertEqual(translate_event({"type": "DELETE", "kv": kv("/resource/flows/a")}, 13)["node"],
+                         {"key": "/resource/flows/a", "modifiedIndex": 13})
+
+
+class TestEtcd3ChangeStream(unittest.TestCase):
+    def setUp(self):
+        self.backend = Etcd3Backend("localhost", 2379, logger=mock.MagicMock(name="logger"))
+        with mock.patch('gevent.spawn'):
+            self.UUT = self.backend.watch(since=20)
+
+    def events(self):
+        events = []
+        while not self.UUT.queue.empty():
+            events.append(self.UUT.queue.get())
+        return events
+
+    def test_watch(self):
+        """Watches should start after the given revision, and deliver events in etcd v2 form"""
+        lines = [
+            json.dumps({"result": {"header": {"revision": "20"}, "created": True}}),
+            "",
+            json.dumps({"result": {"header": {"revision": "22"}, "events": [
+                {"kv": kv("/resource/flows/a", "{}", 21, 21)},
+                {"type": "DELETE", "kv": kv("/resource/flows/b", mod_revision=22)},
+            ]}}),
+        ]
+        stream = response({})
+        stream.iter_lines.return_value = [line.encode('utf-8') for line in lines]
+        with mock.patch.object(self.backend.pool, 'post', return_value=stream) as post:
+            self.UUT._watch()
+        self.assertEqual(post.call_args[0][0], "http://localhost:2379/v3/watch")
+        self.assertEqual(json.loads(post.call_args[1]["data"])["create_request"]["start_revision"], 21)
+        self.assertTrue(post.call_args[1]["stream"])
+        stream.close.assert_called_once_with()
+
+        self.assertEqual([(event["action"], event["node"]["key"]) for event in self.events()],
+                         [("set", "/resource/flows/a"), ("delete", "/resource/flows/b")])
+        self.assertEqual(self.UUT.revision, 22)
+
+        # Watches resume from the last revision delivered
+        stream.iter_lines.return_value = []
+        with mock.patch.object(self.backend.pool, 'post', return_value=stream) as post:
+            self.UUT._watch()
+        self.assertEqual(json.loads(post.call_args[1]["data"])["create_request"]["start_revision"], 23)
+
+    def test_watch_compacted(self):
+        """Where revisions have been compacted away, changes have been missed"""
+        stream = response({})
+        stream.iter_lines.return_value = [
+            json.dumps({"result": {"compact_revision": "30", "canceled": True}}),
+            json.dumps({"result": {"events": [{"kv": kv("/resource/flows/a", "{}", 31)}]}})
+        ]
+        with mock.patch.object(self.backend.pool, 'post', return_value=stream):
+            self.UUT._watch()
+        self.assertEqual(self.events(), [{"action": "index_skip", "from": 20, "to": 29}])
+        self.assertEqual(self.UUT.revision, 29)
+
+    def test_watch_progress(self):
+        """Progress notifications should move on the revision to resume from, but the created response not"""
+        stream = response({})
+        stream.iter_lines.return_value = [
+            json.dumps({"result": {"header": {"revision": "40"}, "created": True}}),
+            json.dumps({"result": {"header": {"revision": "50"}}})
+        ]
+        with mock.patch.object(self.backend.pool, 'post', return_value=stream):
+            self.UUT._watch()
+        self.assertEqual(self.events(), [])
+        self.assertEqual((self.UUT.revision, self.UUT.last_index), (50, 50))
+
+        # A compaction while idle doesn't cost a resync
+        stream.iter_lines.return_value = [json.dumps({"result": {"compact_revision": "45", "canceled": True}})]
+        with mock.patch.object(self.backend.pool, 'post', return_value=stream) as post:
+            self.UUT._watch()
+        self.assertEqual(json.loads(post.call_args[1]["data"])["create_request"]["start_revision"], 51)
+        self.assertEqual(self.events(), [])
+
+    def test_watch_idle(self):
+        """Watches timing out should be re-established quietly"""
+        timeout = requests.exceptions.ConnectionError(ReadTimeoutError(None, None, "Read timed out."))
+
+        def watch():
+            if watch.calls:
+                self.UUT._alive = False
+                return
+            watch.calls += 1
+            raise timeout
+        watch.calls = 0
+
+        self.UUT._logger = mock.MagicMock(name="logger")
+        with mock.patch.object(self.UUT, '_watch', side_effect=watch) as _watch, mock.patch('gevent.sleep') as sleep:
+            self.UUT._run()
+        self.assertEqual(_watch.call_count, 2)
+        sleep.assert_not_called()
+        self.UUT._logger.writeWarning.assert_not_called()
+
+    def test_watch_failure(self):
+        with mock.patch.object(self.backend.pool, 'post', return_value=response({}, status_code=404)):
+            self.assertRaises(BackendError, self.UUT._watch)
+        stream = response({})
+        stream.iter_lines.return_value = [json.dumps({"error": {"message": "potato"}})]
+        with mock.patch.object(self.backend.pool, 'post', return_value=stream):
+            self.assertRaises(BackendError, self.UUT._watch)
@@ -0,0 +1,82 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import json
+
+from nmosquery.backends import FakeBackend, BackendError
+
+FLOW_KEY = "/resource/flows/flow1"
+SENDER_KEY = "/resource/senders/sender1"
+
+
+def drain(stream):
+    events = []
+    while not stream.queue.empty():
+        events.append(stream.queue.get())
+    return events
+
+
+class TestFakeBackend(unittest.TestCase):
+    def setUp(self):
+        self.UUT = FakeBackend()
+
+    def test_snapshot(self):
+        self.assertEqual(self.UUT.snapshot(), ({}, 0))
+        self.UUT.put(FLOW_KEY, json.dumps({"id": "flow1"}))
+        self.UUT.put(SENDER_KEY, "{}")
+        self.assertEqual(self.UUT.put(FLOW_KEY, json.dumps({"id": "flow1", "label": "a"})), 3)
+        tree, index = self.UUT.snapshot()
+        self.assertEqual(index, 3)
+        self.assertEqual(tree["node"]["nodes"], [
+            {"key": FLOW_KEY, "value": json.dumps({"id": "flow1", "label": "a"}), "modifiedIndex": 3,
+             "createdIndex": 1},
+            {"key": SENDER_KEY, "value": "{}", "modifiedIndex": 2, "createdIndex": 2},
+        ])
+
+        self.assertEqual(self.UUT.delete(FLOW_KEY), 4)
+        self.assertIsNone(self.UUT.delete(FLOW_KEY))
+        self.assertEqual([node["key"] for node in self.UUT.snapshot()[0]["node"]["nodes"]], [SENDER_KEY])
+
+        self.UUT.available = False
+        with self.assertRaises(BackendError):
+            self.UUT.snapshot()
+
+    def test_watch(self):
+        """Watches should deliver every change after the revision they start from, in order"""
+        self.UUT.put(FLOW_KEY, "a")
+        self.UUT.put(FLOW_KEY, "b")
+        stream = self.UUT.watch(since=1)
+        self.UUT.delete(FLOW_KEY)
+        self.assertEqual(drain(stream), [
+            {"action": "set", "node": {"key": FLOW_KEY, "value": "b", "modifiedIndex": 2, "createdIndex": 1},
+             "prevNode": {"key": FLOW_KEY, "value": "a", "modifiedIndex": 1, "createdIndex": 1}},
+            {"action": "delete", "node": {"key": FLOW_KEY, "modifiedIndex": 3},
+             "prevNode": {"key": FLOW_KEY, "value": "b", "modifiedIndex": 2, "createdIndex": 1}},
+        ])
+
+        stream.stop()
+        self.UUT.put(FLOW_KEY, "c")
+        self.assertEqual(list(stream.queue), [])
+
+    def test_watch_compacted(self):
+        """Watches from before the history still held should be told changes were skipped"""
+        self.UUT.put(FLOW_KEY, "a")
+        self.UUT.put(FLOW_KEY, "b")
+        self.UUT.put(FLOW_KEY, "c")
+        self.UUT.compact(2)
+        events = drain(self.UUT.watch(since=0))
+        self.assertEqual(events[0], {"action": "index_skip", "from": 0, "to": 2})
+        self.assertEqual([event["node"]["modifiedIndex"] for event in events[1:]], [3])
+        self.assertEqual([event["node"]["modifiedIndex"] for event in drain(self.UUT.watch(since=2))], [3])
@@ -14,12 +14,15 @@
 
 import unittest
 import mock
+import gevent
 
 import uuid
 import json
 import six
 
 from nmosquery.common.query import QueryCommon, reg
+from nmosquery.backends import Etcd2Backend
+from nmosquery.httppool import DEFAULT_TIMEOUT
 from nmoscommon.utils import translate_api_version
 
 import copy
@@ -222,6 +225,13 @@ etcd_test_data = {
 
 etcd_test_data_string = json.dumps(etcd_test_data)
 
+
+def etcd_response(status_code, text):
+    """A response from etcd's v2 keys API, as returned by requests"""
+    response = mock.MagicMock(name='response', status_code=status_code, text=text, headers={})
+    response.json.side_effect = lambda: json.loads(text)
+    return response
+
 def remove_at_keys(data):
     data = copy.deepcopy(data)
     removals = [x for x in data.keys() if x.startswith("@_")]
@@ -237,15 +247,34 @@ sender_data_versions = { v : remove_at_keys(translate_api_version(copy.deepcopy(
 
 class TestQueryCommon(unittest.TestCase):
 
-    @mock.patch('nmosquery.common.query.ChangeWatcher')
+    @mock.patch('nmosquery.registry.ChangeWatcher')
+    @mock.patch('nmosquery.registry.Logger', side_effect=lambda name, _parent : getattr(_parent, name))
     @mock.patch('nmosquery.common.query.Logger', side_effect=lambda name, _parent : getattr(_parent, name))
-    def setup(self, v, Logger, ChangeWatcher):
+    def setup(self, v, Logger, RegistryLogger, ChangeWatcher):
         """This is not setUp! It is not called automatically!"""
         self.logger = mock.MagicMock(name="Logger()")
+        ChangeWatcher.return_value.started = False
         self.UUT = QueryCommon(logger=self.logger, api_version=v)
 
-        ChangeWatcher.assert_called_once_with(reg['host'], reg['port'], handler=self.UUT, logger=self.logger.regquery)
+        ChangeWatcher.assert_called_once_with(self.UUT.registry.backend, handler=self.UUT.registry,
+                                              logger=self.logger.regquery.registry)
+        self.assertIsInstance(self.UUT.registry.backend, Etcd2Backend)
+        self.assertEqual((self.UUT.registry.backend.host, self.UUT.registry.backend.port), (reg['host'], reg['port']))
         ChangeWatcher.return_value.start.assert_called_once_with()
+        self.assertEqual(self.UUT.registry.listeners, [self.UUT])
+
+    @mock.patch('nmosquery.registry.ChangeWatcher')
+    def test_shared_registry(self, ChangeWatcher):
+        """When given a registry, QueryCommon should listen to it rather than starting its own watcher."""
+        registry = mock.MagicMock(name="registry")
+        UUT = QueryCommon(logger=mock.MagicMock(name="Logger()"), api_version="v1.3", registry=registry)
+        ChangeWatcher.assert_not_called()
+        registry.add_listener.assert_called_once_with(UUT)
+        registry.start.assert_not_called()
+
+        UUT._cleanup()
+        registry.remove_listener.assert_called_once_with(UUT)
+        registry.stop.assert_not_called()
 
 
     @mock.patch('os.getpid', return_value=23)
@@ -262,20 +291,21 @@ class TestQueryCommon(unittest.TestCase):
             self.setup(v)
             # path, args, (db_resp_code, db_resp_data), expected_return_value
             test_data = [
-                [ "/", {}, (404, ""), None ],
+                [ "/", {}, (404, ""), [] ],
+                [ "/", {}, (500, ""), None ],
                 [ "/", {}, (200, json.dumps({ "potatoes" : [ "a", "list", "of", "potatoes" ] })), [] ],
                 [ "/", { }, (200, etcd_test_data_string), [ sender_data_versions[v], flow_data_versions[v] ] + ([flow_v1_0_data_versions[v]] if v == "v1.0" else []) ],
                 [ "/", { "query.downgrade" : "v1.0" }, (200, etcd_test_data_string), [ sender_data_versions[v], flow_data_versions[v], flow_v1_0_data_versions[v] ] ],
-                [ "/flows/", { }, (404, None), None ],
+                [ "/flows/", { }, (404, None), [] ],
                 [ "/flows/", { }, (200, etcd_test_data_string), [ flow_data_versions[v] ] + ([flow_v1_0_data_versions[v]] if v == "v1.0" else []) ],
-                [ "/senders/", { }, (404, None), None ],
+                [ "/senders/", { }, (404, None), [] ],
                 [ "/senders/", { }, (200, etcd_test_data_string), [ sender_data_versions[v] ] ],
                 ]
 
             for (path, args, (code, text), expected) in test_data:
-                with mock.patch('requests.request', return_value=mock.MagicMock(name='response', status_code=code, text=text)) as request:
+                with mock.patch('requests.Session.request', return_value=etcd_response(code, text)) as request:
                     r = self.UUT.get_data_for_path(path, args)
-                    request.assert_called_once_with('GET', 'http://%s:%i/v2/keys/resource/?recursive=true' % (reg['host'], reg['port']), proxies={'http': ''})
+                    request.assert_called_once_with('GET', 'http://%s:%i/v2/keys/resource/?recursive=true' % (reg['host'], reg['port']), timeout=DEFAULT_TIMEOUT)
                 msg = ("Call to get_data_for_path({!r},{!r}) with version {} and GET request returning {!r} returned:"
                        "\n{}\n"
                        "\nwhen we expected:"
@@ -286,6 +316,206 @@ class TestQueryCommon(unittest.TestCase):
                 else:
                     self.assertEqual(r, expected, msg)
 
+    def test_get_data_for_path_from_registry(self):
+        """Once the registry mirror has been seeded, queries should be answered without contacting etcd."""
+        for v in API_VERSIONS:
+            self.setup(v)
+            self.UUT.registry.load(etcd_test_data, 400000000)
+            test_data = [
+                [ "/", { "query.downgrade" : "v1.0" }, [ sender_data_versions[v], flow_data_versions[v], flow_v1_0_data_versions[v] ] ],
+                [ "/flows/", { }, [ flow_data_versions[v] ] + ([flow_v1_0_data_versions[v]] if v == "v1.0" else []) ],
+                [ "/senders/", { }, [ sender_data_versions[v] ] ],
+                [ "/senders/1fe66652-e590-11e7-b23a-2796ce8be661", { }, [ sender_data_versions[v] ] ],
+                [ "/receivers/", { }, [] ],
+                ]
+
+            for (path, args, expected) in test_data:
+                with mock.patch('requests.Session.request') as request:
+                    r = self.UUT.get_data_for_path(path, args)
+                    request.assert_not_called()
+                six.assertCountEqual(self, r, expected)
+
+    def test_translations_cached(self):
+        """Repeated queries should reuse translations of unchanged resources"""
+        for v in API_VERSIONS:
+            self.setup(v)
+            self.UUT.registry.load(etcd_test_data, 400000000)
+            expected = self.UUT.get_data_for_path("/flows/", { "query.downgrade" : "v1.0" })
+            with mock.patch('nmosquery.common.query.translate_api_version') as translate:
+                six.assertCountEqual(self, self.UUT.get_data_for_path("/flows/", { "query.downgrade" : "v1.0" }), expected)
+                translate.assert_not_called()
+            self.assertEqual(self.UUT.registry.translations.hits, 2)
+
+    def test_get_page_for_path(self):
+        """Pages should be served from the registry mirror's time orders, falling back to a full fetch from etcd."""
+        for v in API_VERSIONS:
+            self.setup(v)
+            flows = [ flow_data_versions[v] ] + ([flow_v1_0_data_versions[v]] if v == "v1.0" else [])
+            # Flows sharing a version are held a nanosecond apart, and the mirror holds both
+            flow_version = (1513670741, 520081181 + len(flows))
+            newest = (1513670741, 520081183)
+
+            with mock.patch('requests.Session.request', return_value=etcd_response(200, etcd_test_data_string)):
+                page = self.UUT.get_page_for_path("/flows/", {}, limit=10)
+            six.assertCountEqual(self, page.items, flows)
+            self.assertEqual((page.since, page.until), ((0, 0), flow_version))
+
+            self.UUT.registry.load(etcd_test_data, 400000000)
+            with mock.patch('requests.Session.request') as request:
+                page = self.UUT.get_page_for_path("/flows/", {}, limit=10)
+                request.assert_not_called()
+            six.assertCountEqual(self, page.items, flows)
+            self.assertEqual((page.since, page.until, page.limit), ((0, 0), newest, 10))
+
+            page = self.UUT.get_page_for_path("/flows/", {}, order="update", limit=1)
+            self.assertEqual(len(page.items), 1)
+            self.assertIn(page.items[0], flows)
+
+            page = self.UUT.get_page_for_path("/flows/", { "source_id" : "potato" })
+            self.assertEqual(page.items, [])
+
+            page = self.UUT.get_page_for_path("/flows/", {}, since=newest)
+            self.assertEqual((page.items, page.since, page.until), ([], newest, newest))
+
+    def test_iter_data_for_path(self):
+        """Resources should be generated one at a time, matching get_data_for_path."""
+        for v in API_VERSIONS:
+            self.setup(v)
+            with mock.patch('requests.Session.request', return_value=etcd_response(200, etcd_test_data_string)):
+                expected = self.UUT.get_data_for_path("/flows/", {})
+                six.assertCountEqual(self, list(self.UUT.iter_data_for_path("/flows/", {})), expected)
+
+            self.UUT.registry.load(etcd_test_data, 400000000)
+            with mock.patch('requests.Session.request') as request:
+                items = self.UUT.iter_data_for_path("/flows/", {})
+                self.assertFalse(isinstance(items, list))
+                six.assertCountEqual(self, list(items), expected)
+                request.assert_not_called()
+
+    def test_get_etag(self):
+        """Entity tags should come from the registry mirror, changing as the resources or query they cover do."""
+        self.setup("v1.2")
+        flow_path = "/flows/b30ebee2-e578-11e7-a01e-ab8cee26a3ae"
+        self.assertIsNone(self.UUT.get_etag("/flows", {}))
+
+        self.UUT.registry.load(etcd_test_data, 400000000)
+        collection = self.UUT.get_etag("/flows/", {"format": "urn:x-nmos:format:video", "label": "a"})
+        resource = self.UUT.get_etag(flow_path, {})
+        self.assertEqual(self.UUT.get_etag("/flows", {"label": "a", "format": "urn:x-nmos:format:video"}),
+                         collection)
+        self.assertNotEqual(self.UUT.get_etag("/flows", {"label": "b", "format": "urn:x-nmos:format:video"}),
+                            collection)
+        self.assertNotEqual(self.UUT.get_etag("/senders", {}), self.UUT.get_etag("/flows", {}))
+        self.assertIsNone(self.UUT.get_etag("/flows/potato", {}))
+
+        # A change elsewhere in the registry only alters the tags of collections
+        self.UUT.registry.apply({"action": "set", "node": {
+            "key": "/resource/nodes/potato", "value": "{}", "modifiedIndex": 400000001
+        }})
+        self.assertNotEqual(self.UUT.get_etag("/flows", {"label": "a", "format": "urn:x-nmos:format:video"}),
+                            collection)
+        self.assertEqual(self.UUT.get_etag(flow_path, {}), resource)
+
+        self.UUT.registry.apply({"action": "set", "node": {
+            "key": "/resource" + flow_path, "value": "{}", "modifiedIndex": 400000002
+        }})
+        self.assertNotEqual(self.UUT.get_etag(flow_path, {}), resource)
+
+    @mock.patch('nmosquery.common.querysockets.getLocalIP', return_value="192.168.0.23")
+    def test_do_sync(self, getLocalIP):
+        """The initial sync should come from the registry mirror, in bounded messages, and then release held changes"""
+        self.setup("v1.2")
+        sock = self.UUT.query_sockets.add_sock({"resource_path": "/flows", "params": {}})
+        ws = mock.MagicMock(name="ws")
+
+        # Before the mirror is seeded it falls back to a snapshot of the backend
+        sock.add_subscriber(ws, syncing=True)
+        with mock.patch('requests.Session.request', return_value=etcd_response(200, etcd_test_data_string)):
+            self.UUT.do_sync(ws, sock)
+        gevent.sleep(0)
+        messages = [json.loads(call[0][0]) for call in ws.send.call_args_list]
+        self.assertEqual([[g["post"] for g in m["grain"]["data"]] for m in messages], [[flow_data_versions["v1.2"]]])
+        self.assertNotIn(ws, sock._syncing)
+
+        uids = [str(uuid4()) for i in range(5)]
+        self.UUT.registry.load({"node": {"key": "/resource", "dir": True, "nodes": [
+            {"key": "/resource/flows/" + uid, "value": json.dumps(dict(flow_data, id=uid)), "modifiedIndex": 400000000}
+            for uid in uids
+        ]}}, 400000000)
+
+        ws = mock.MagicMock(name="ws")
+        sock.add_subscriber(ws, syncing=True)
+        sock.notify_subscribers({"id": "held"})
+        with mock.patch('nmosquery.common.query.SYNC_GRAINS_PER_MESSAGE', 2), \
+                mock.patch('requests.Session.request') as request:
+            self.UUT.do_sync(ws, sock)
+            request.assert_not_called()
+        gevent.sleep(0)
+        messages = [json.loads(call[0][0]) for call in ws.send.call_args_list]
+        self.assertEqual([len(m["grain"]["data"]) for m in messages[:-1]], [2, 2, 1])
+        six.assertCountEqual(self, [g["path"] for m in messages[:-1] for g in m["grain"]["data"]], uids)
+        self.assertEqual(len(set((m["source_id"], m["flow_id"]) for m in messages[:-1])), 1)
+        self.assertEqual(messages[-1], {"id": "held"})
+
+        # Nothing matching still means one, empty, message
+        ws = mock.MagicMock(name="ws")
+        empty = self.UUT.query_sockets.add_sock({"resource_path": "/senders", "params": {}})
+        empty.add_subscriber(ws, syncing=True)
+        self.UUT.do_sync(ws, empty)
+        gevent.sleep(0)
+        messages = [json.loads(call[0][0]) for call in ws.send.call_args_list]
+        self.assertEqual([m["grain"]["data"] for m in messages], [[]])
+
+    def test_fields(self):
+        """Resources should be projected to the requested fields, without altering those cached"""
+        fields = {"query.fields": "label,format"}
+        for v in API_VERSIONS:
+            self.setup(v)
+            self.UUT.registry.load(etcd_test_data, 400000000)
+            expected = [{k: flow[k] for k in ("id", "label", "format") if k in flow}
+                        for flow in self.UUT.get_data_for_path("/flows/", {})]
+            six.assertCountEqual(self, self.UUT.get_data_for_path("/flows/", fields), expected)
+            six.assertCountEqual(self, list(self.UUT.iter_data_for_path("/flows/", fields)), expected)
+            six.assertCountEqual(self, self.UUT.get_page_for_path("/flows/", fields).items, expected)
+            self.assertIn(flow_data_versions[v], self.UUT.get_data_for_path("/flows/", {}))
+
+    @mock.patch('nmosquery.common.querysockets.getLocalIP', return_value="192.168.0.23")
+    def test_do_sup_fields(self, getLocalIP):
+        """Subscriptions should be sent changes projected to their fields, and nothing when those don't change"""
+        self.setup("v1.3")
+        path = "/resource/flows/" + flow_data["id"]
+        sock = self.UUT.query_sockets.add_sock({"resource_path": "/flows", "params": {"query.fields": "label"}})
+        with mock.patch.object(sock, 'queue_grain') as queue_grain:
+            self.UUT.do_sup(path, {}, copy.deepcopy(flow_data))
+            queue_grain.assert_called_once_with(self.UUT.gen_source_id(), "flows", pre_obj=None,
+                                                post_obj={"id": flow_data["id"], "label": flow_data["label"]})
+            queue_grain.reset_mock()
+            self.UUT.do_sup(path, copy.deepcopy(flow_data), dict(flow_data, description="changed"))
+            queue_grain.assert_not_called()
+            self.UUT.do_sup(path, copy.deepcopy(flow_data), dict(flow_data, label="changed"))
+            queue_grain.assert_called_once_with(self.UUT.gen_source_id(), "flows",
+                                                pre_obj={"id": flow_data["id"], "label": flow_data["label"]},
+                                                post_obj={"id": flow_data["id"], "label": "changed"})
+
+    @mock.patch('nmosquery.common.querysockets.getLocalIP', return_value="192.168.0.23")
+    def test_do_sup_and_sdown(self, getLocalIP):
+        """Changes should be queued on each matching subscription, to be sent at its update rate"""
+        for v in API_VERSIONS:
+            self.setup(v)
+            path = "/resource/flows/" + flow_data["id"]
+            sock = self.UUT.query_sockets.add_sock({"resource_path": "/flows", "params": {}})
+            other = self.UUT.query_sockets.add_sock({"resource_path": "/senders", "params": {}})
+            with mock.patch.object(sock, 'queue_grain') as queue_grain, \
+                    mock.patch.object(other, 'queue_grain') as other_queue_grain:
+                self.UUT.do_sup(path, {}, copy.deepcopy(flow_data))
+                queue_grain.assert_called_once_with(self.UUT.gen_source_id(), "flows", pre_obj=None,
+                                                    post_obj=flow_data_versions[v])
+                queue_grain.reset_mock()
+                self.UUT.do_sdown(path, copy.deepcopy(flow_data), {})
+                queue_grain.assert_called_once_with(self.UUT.gen_source_id(), "flows",
+                                                    pre_obj=flow_data_versions[v], post_obj=None)
+                other_queue_grain.assert_not_called()
+
     @mock.patch('nmosquery.common.querysockets.getLocalIP', return_value="192.168.0.23")
     def test_get_ws_subscribers(self, getLocalIP):
         def websocket_details(id, resource_path=""):
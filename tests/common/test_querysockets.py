@@ -0,0 +1,475 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import unittest
+import mock
+import json
+import gevent
+import gevent.event
+import shutil
+import tempfile
+
+from geventwebsocket.websocket import WebSocket
+
+from nmosquery.subscriptionstore import SubscriptionStore
+from nmosquery.grainevent import GrainEvent
+from nmosquery.common.querysockets import QueryFilterCommon, QuerySocketsCommon, QuerySocketCommon, FANOUT_COUNTERS, \
+    WEBSOCKET_SENT_BYTES, WEBSOCKET_OVERFLOWS, UNCLAIMED_EXPIRY
+
+NODE = {
+    "id": "efee1ab5-85f1-4ae3-b5d5-3ccc79ae76af",
+    "label": "test_node",
+    "description": "",
+    "tags": {"location": ["studio1", "studio2"]},
+    "api": {"versions": ["v1.2", "v1.3"], "endpoints": [{"host": "127.0.0.1", "port": 80}]},
+    "services": [{"type": "urn:x-nmos:service:a", "href": "http://a/"},
+                 {"type": "urn:x-nmos:service:b", "href": "http://b/"}],
+    "clocks": [],
+}
+
+FILTERS = [
+    {},
+    {"label": "test_node"},
+    {"label": "potato"},
+    {"description": "anything"},
+    {"missing": "value"},
+    {"label": "test_node", "query.downgrade": "v1.0", "paging.limit": "10"},
+    {"api.versions": "v1.3"},
+    {"api.versions": "v1.0"},
+    {"api.endpoints.host": "127.0.0.1"},
+    {"api.endpoints.port": "80"},
+    {"services.type": "urn:x-nmos:service:b"},
+    {"services.type": "urn:x-nmos:service:c"},
+    {"services.href": "http://a/", "label": "test_node"},
+    {"tags.location": "studio2"},
+    {"tags.location": "studio3"},
+    {"clocks.name": "clk0"},
+    {"nope.nope": "value"},
+]
+
+
+class TestQueryFilterCommon(unittest.TestCase):
+
+    def test_compile_matches_check_args(self):
+        """A compiled filter should give exactly the same answers as check_args"""
+        UUT = QueryFilterCommon()
+        for args in FILTERS:
+            self.assertEqual(UUT.compile(args)(NODE), UUT.check_args(args, NODE), args)
+
+    def test_compile_rql(self):
+        """An RQL expression should be combined with the basic filters"""
+        UUT = QueryFilterCommon()
+        self.assertTrue(UUT.compile({"query.rql": "eq(tags.location,studio1)"})(NODE))
+        self.assertTrue(UUT.compile({"query.rql": "eq(api.endpoints.port,80)", "label": "test_node"})(NODE))
+        self.assertFalse(UUT.compile({"query.rql": "eq(api.endpoints.port,80)", "label": "potato"})(NODE))
+        self.assertFalse(UUT.compile({"query.rql": "in(services.type,(urn:x-nmos:service:c))"})(NODE))
+
+    def test_compile_cache(self):
+        UUT = QueryFilterCommon()
+        self.assertIs(UUT.compile({"label": "a", "format": "b"}), UUT.compile({"format": "b", "label": "a"}))
+        self.assertIsNot(UUT.compile({"label": "a"}), UUT.compile({"label": "b"}))
+
+        # Unhashable values are compiled, just not cached
+        predicate = UUT.compile({"label": ["a"]})
+        self.assertIsNot(predicate, UUT.compile({"label": ["a"]}))
+        self.assertFalse(predicate(NODE))
+
+
+class TestQuerySocketCommon(unittest.TestCase):
+
+    @mock.patch('nmosquery.common.querysockets.getLocalIP', return_value="192.168.0.23")
+    def setUp(self, getLocalIP):
+        self.UUT = QuerySocketCommon("/flows", 8870, rate=50, logger=mock.MagicMock(name="logger"))
+        self.ws = mock.MagicMock(name="ws")
+        self.UUT.add_subscriber(self.ws)
+
+    def sent(self):
+        gevent.sleep(0)
+        messages = [json.loads(call[0][0]) for call in self.ws.send.call_args_list]
+        self.ws.send.reset_mock()
+        return messages
+
+    def test_coalesce(self):
+        """Changes within the rate window should be sent as a single event, one grain per resource"""
+        flow_a = {"id": "a", "label": "0"}
+        for i in range(1, 4):
+            self.UUT.queue_grain("src", "flows", pre_obj=dict(flow_a, label=str(i - 1)),
+                                 post_obj=dict(flow_a, label=str(i)))
+        self.UUT.queue_grain("src", "flows", pre_obj=None, post_obj={"id": "b"})
+        gevent.sleep(0)
+
+        messages = self.sent()
+        self.assertEqual(len(messages), 1)
+        self.assertEqual(messages[0]["flow_id"], self.UUT.uuid)
+        self.assertEqual(messages[0]["source_id"], "src")
+        self.assertEqual(messages[0]["grain"]["topic"], "/flows/")
+        self.assertEqual(messages[0]["grain"]["data"], [
+            {"path": "a", "pre": {"id": "a", "label": "0"}, "post": {"id": "a", "label": "3"}},
+            {"path": "b", "post": {"id": "b"}}
+        ])
+
+        # The next change waits for the end of the window
+        self.UUT.queue_grain("src", "flows", pre_obj={"id": "b"}, post_obj=None)
+        gevent.sleep(0)
+        self.assertEqual(self.sent(), [])
+        gevent.sleep(0.1)
+        self.assertEqual([m["grain"]["data"] for m in self.sent()], [[{"path": "b", "pre": {"id": "b"}}]])
+
+    def test_coalesce_create_and_delete(self):
+        self.UUT.queue_grain("src", "flows", pre_obj=None, post_obj={"id": "c"})
+        self.UUT.queue_grain("src", "flows", pre_obj={"id": "c"}, post_obj=None)
+        gevent.sleep(0)
+        self.assertEqual(self.sent(), [])
+
+    def test_del_subscribers(self):
+        self.UUT.queue_grain("src", "flows", pre_obj=None, post_obj={"id": "c"})
+        self.UUT.del_subscribers()
+        gevent.sleep(0)
+        self.assertEqual(self.sent(), [])
+        self.ws.close.assert_called_once_with()
+        self.assertEqual(len(self.UUT.pending), 0)
+
+    def test_sync_holds_messages(self):
+        """A subscriber being synced should be sent nothing else until its sync ends, and then everything"""
+        syncing = mock.MagicMock(name="syncing")
+        self.UUT.add_subscriber(syncing, syncing=True)
+        self.UUT.notify_subscribers({"id": "a"})
+        self.UUT.notify_subscribers({"id": "b"})
+        self.assertEqual([m["id"] for m in self.sent()], ["a", "b"])
+        syncing.send.assert_not_called()
+
+        syncing.send.side_effect = lambda message: syncing.sent.append(message)
+        syncing.sent = ['{"sync": true}']
+        self.UUT.end_sync(syncing)
+        self.UUT.notify_subscribers({"id": "c"})
+        gevent.sleep(0)
+        self.assertEqual([json.loads(m) for m in syncing.sent],
+                         [{"sync": True}, {"id": "a"}, {"id": "b"}, {"id": "c"}])
+
+    def test_sync_takes_pending(self):
+        """Buffered changes, already in the new subscriber's sync, should be sent to the others alone"""
+        self.UUT.queue_grain("src", "flows", pre_obj=None, post_obj={"id": "a"})
+        syncing = mock.MagicMock(name="syncing")
+        self.UUT.add_subscriber(syncing, syncing=True)
+        self.assertEqual(len(self.UUT.pending), 0)
+        self.UUT.end_sync(syncing)
+        gevent.sleep(0)
+        syncing.send.assert_not_called()
+        self.assertEqual([m["grain"]["data"] for m in self.sent()], [[{"path": "a", "post": {"id": "a"}}]])
+
+        # Later changes go to everyone
+        gevent.sleep(0.1)
+        self.UUT.queue_grain("src", "flows", pre_obj={"id": "a"}, post_obj=None)
+        gevent.sleep(0)
+        self.assertEqual(len(self.sent()), 1)
+        self.assertEqual(syncing.send.call_count, 1)
+
+    def test_end_sync_without_send(self):
+        syncing = mock.MagicMock(name="syncing")
+        self.UUT.add_subscriber(syncing, syncing=True)
+        self.UUT.notify_subscribers({"id": "a"})
+        self.UUT.end_sync(syncing, send=False)
+        gevent.sleep(0)
+        syncing.send.assert_not_called()
+        self.UUT.notify_subscribers({"id": "b"})
+        gevent.sleep(0)
+        syncing.send.assert_called_once_with('{"id": "b"}')
+
+    def test_notify_subscribers_encodes_once(self):
+        """Each message should be encoded once however many subscribers there are"""
+        others = [mock.MagicMock(name="ws1"), mock.MagicMock(name="ws2")]
+        for ws in others:
+            self.UUT.add_subscriber(ws)
+        before = dict(FANOUT_COUNTERS)
+        sent_bytes = WEBSOCKET_SENT_BYTES.labels("v1.0").value
+        with mock.patch('json.dumps', side_effect=json.dumps) as dumps:
+            self.UUT.notify_subscribers({"id": "a"})
+            self.assertEqual(dumps.call_count, 1)
+        gevent.sleep(0)
+        for ws in [self.ws] + others:
+            ws.send.assert_called_once_with('{"id": "a"}')
+        self.assertEqual(WEBSOCKET_SENT_BYTES.labels("v1.0").value - sent_bytes, 3 * len('{"id": "a"}'))
+        self.assertEqual(FANOUT_COUNTERS["messages"] - before["messages"], 3)
+        self.assertEqual(FANOUT_COUNTERS["encodes"] - before["encodes"], 1)
+        self.assertEqual(FANOUT_COUNTERS["encodes_saved"] - before["encodes_saved"], 2)
+
+        # Subscribers being synced are held the message, and not counted
+        syncing = mock.MagicMock(name="syncing")
+        self.UUT.subscribers = [self.ws, syncing]
+        self.UUT._syncing[syncing] = []
+        before = dict(FANOUT_COUNTERS)
+        self.UUT.notify_subscribers({"id": "b"})
+        self.assertEqual(FANOUT_COUNTERS["messages"] - before["messages"], 1)
+        self.assertEqual(FANOUT_COUNTERS["encodes_saved"] - before["encodes_saved"], 0)
+        gevent.sleep(0)
+
+    def test_notify_subscribers_shares_frames(self):
+        """gevent-websocket subscribers should all be written the same prebuilt frame"""
+        streams = [mock.MagicMock(name="stream1"), mock.MagicMock(name="stream2")]
+        self.UUT.subscribers = [WebSocket({}, stream, mock.MagicMock(name="handler")) for stream in streams]
+        before = FANOUT_COUNTERS["frames"]
+        sent_bytes = WEBSOCKET_SENT_BYTES.labels("v1.0").value
+        self.UUT.notify_subscribers({"id": "a"})
+        gevent.sleep(0)
+        frame = b'\x81\x0b{"id": "a"}'
+        for stream in streams:
+            stream.write.assert_called_once_with(frame)
+        self.assertIs(streams[0].write.call_args[0][0], streams[1].write.call_args[0][0])
+        self.assertEqual(FANOUT_COUNTERS["frames"] - before, 1)
+        self.assertEqual(WEBSOCKET_SENT_BYTES.labels("v1.0").value - sent_bytes, 2 * len(frame))
+
+    def test_slow_subscriber(self):
+        """A subscriber which is slow to take messages shouldn't hold up anyone else"""
+        blocked = gevent.event.Event()
+        slow = mock.MagicMock(name="slow")
+        slow.send.side_effect = lambda message: blocked.wait()
+        self.UUT.add_subscriber(slow)
+        self.UUT.notify_subscribers({"id": "a"})
+        self.UUT.notify_subscribers({"id": "b"})
+        self.assertEqual([m["id"] for m in self.sent()], ["a", "b"])
+        self.assertEqual(slow.send.call_count, 1)
+        self.assertEqual(self.UUT.queued(), 1)
+
+        blocked.set()
+        gevent.sleep(0)
+        self.assertEqual(slow.send.call_count, 2)
+        self.assertEqual(self.UUT.queued(), 0)
+
+    def add_slow_subscriber(self, resync=None):
+        """Add a subscriber which takes messages only once `blocked' is set"""
+        blocked = gevent.event.Event()
+        slow = mock.MagicMock(name="slow")
+        slow.send.side_effect = lambda message: blocked.wait()
+        self.UUT.add_subscriber(slow, resync=resync)
+        return slow, blocked
+
+    def notify(self, *uids):
+        for uid in uids:
+            self.UUT.notify_subscribers({"id": uid})
+            gevent.sleep(0)
+
+    @mock.patch('nmosquery.common.querysockets.SEND_QUEUE_LIMIT', 2)
+    def test_overflow_resyncs(self):
+        """A subscriber which falls too far behind should have what it's waiting for replaced by a resync"""
+        def resync(ws, socket):
+            socket.send(ws, '{"sync": true}')
+            socket.notify_subscribers({"id": "during"})
+            socket.end_sync(ws)
+
+        resync = mock.MagicMock(name="resync", side_effect=resync)
+        slow, blocked = self.add_slow_subscriber(resync)
+        resyncs = WEBSOCKET_OVERFLOWS.labels("v1.0", "resync").value
+        self.notify("a", "b", "c")
+        resync.assert_not_called()
+        self.notify("d")
+        resync.assert_called_once_with(slow, self.UUT)
+        self.assertEqual(WEBSOCKET_OVERFLOWS.labels("v1.0", "resync").value - resyncs, 1)
+        self.assertEqual([m["id"] for m in self.sent()], ["a", "b", "c", "d", "during"])
+
+        blocked.set()
+        gevent.sleep(0.01)
+        self.assertEqual([json.loads(call[0][0]) for call in slow.send.call_args_list],
+                         [{"id": "a"}, {"sync": True}, {"id": "during"}])
+        self.assertIn(slow, self.UUT.subscribers)
+        self.assertFalse(self.UUT._writers[slow].resyncing)
+
+    @mock.patch('nmosquery.common.querysockets.SEND_QUEUE_LIMIT', 2)
+    def test_overflow_resync_removals(self):
+        """Resources removed in the changes dropped for a resync should be reported removed before it"""
+        def resync(ws, socket):
+            socket.send(ws, '{"sync": true}')
+            socket.end_sync(ws)
+
+        def grain(pre_obj, post_obj):
+            event = GrainEvent()
+            event.topic = "flows"
+            event.addGrainFromObj(pre_obj=pre_obj, post_obj=post_obj)
+            return event.obj()
+
+        slow, blocked = self.add_slow_subscriber(resync)
+        self.UUT.notify_subscribers(grain(None, {"id": "a"}))
+        gevent.sleep(0)
+        self.UUT.notify_subscribers(grain({"id": "b"}, None))
+        self.UUT.notify_subscribers(grain({"id": "c"}, {"id": "c", "label": "new"}))
+        self.UUT.notify_subscribers(grain({"id": "d"}, None))
+        blocked.set()
+        gevent.sleep(0.01)
+
+        sent = [json.loads(call[0][0]) for call in slow.send.call_args_list]
+        self.assertEqual(sent[0]["grain"]["data"], [{"path": "a", "post": {"id": "a"}}])
+        self.assertEqual(sent[1]["grain"]["topic"], "/flows/")
+        self.assertEqual(sent[1]["flow_id"], self.UUT.uuid)
+        self.assertEqual(sent[1]["grain"]["data"],
+                         [{"path": "b", "pre": {"id": "b"}}, {"path": "d", "pre": {"id": "d"}}])
+        self.assertEqual(sent[2:], [{"sync": True}])
+
+    @mock.patch('nmosquery.common.querysockets.SEND_QUEUE_LIMIT', 2)
+    def test_overflow_disconnects(self):
+        """A subscriber which can't be resynced, or falls behind again while resyncing, should be disconnected"""
+        slow, blocked = self.add_slow_subscriber()
+        disconnects = WEBSOCKET_OVERFLOWS.labels("v1.0", "disconnect").value
+        self.notify("a", "b", "c", "d")
+        self.assertNotIn(slow, self.UUT.subscribers)
+        slow.close.assert_called_once_with()
+        self.assertFalse(self.UUT.remove_subscriber(slow))
+        self.assertEqual([m["id"] for m in self.sent()], ["a", "b", "c", "d"])
+
+        def resync(ws, socket):
+            socket.end_sync(ws)
+            self.notify("e", "f", "g")
+
+        slow, blocked = self.add_slow_subscriber(resync)
+        self.notify("a", "b", "c", "d")
+        self.assertNotIn(slow, self.UUT.subscribers)
+        slow.close.assert_called_once_with()
+        self.assertEqual(WEBSOCKET_OVERFLOWS.labels("v1.0", "disconnect").value - disconnects, 2)
+        self.assertEqual([m["id"] for m in self.sent()], ["a", "b", "c", "d", "e", "f", "g"])
+        blocked.set()
+        gevent.sleep(0)
+        slow.send.assert_called_once_with('{"id": "a"}')
+
+
+class TestQuerySocketsCommon(unittest.TestCase):
+
+    @mock.patch('nmosquery.common.querysockets.getLocalIP', return_value="192.168.0.23")
+    def test_find_socks(self, getLocalIP):
+        UUT = QuerySocketsCommon(8870, logger=mock.MagicMock(name="logger"))
+        matching = UUT.add_sock({"resource_path": "/nodes", "params": {"services.type": "urn:x-nmos:service:a"}})
+        UUT.add_sock({"resource_path": "/nodes", "params": {"label": "potato"}})
+        UUT.add_sock({"resource_path": "/flows", "params": {}})
+        unfiltered = UUT.add_sock({"resource_path": "", "params": {}})
+
+        path = "/resource/nodes/" + NODE["id"]
+        self.assertEqual(UUT.find_socks(path=path, obj=NODE, p_obj={}), [matching, unfiltered])
+
+        # The compiled filter is kept on the socket for reuse
+        predicate = matching.predicate
+        self.assertIsNotNone(predicate)
+        UUT.find_socks(path=path, obj=NODE, p_obj={})
+        self.assertIs(matching.predicate, predicate)
+
+    @mock.patch('nmosquery.common.querysockets.getLocalIP', return_value="192.168.0.23")
+    def test_restore(self, getLocalIP):
+        """Subscriptions should be recreated from their records, if persistent or with subscribers"""
+        UUT = QuerySocketsCommon(8870, logger=mock.MagicMock(name="logger"))
+        persistent = UUT.add_sock({"resource_path": "/nodes", "persist": True})
+        subscribed = UUT.add_sock({"resource_path": "/flows", "params": {"label": "a"}})
+        subscribed.add_subscriber(mock.MagicMock(name="ws"))
+        UUT.add_sock({"resource_path": "/senders"})
+        records = UUT.records()
+        self.assertEqual([record["summary"]["id"] for record in records], [persistent.uuid, subscribed.uuid])
+
+        restored = QuerySocketsCommon(8870, logger=mock.MagicMock(name="logger"))
+        restored.restore(records)
+        restored.restore(records)
+        self.assertEqual(restored.get_socketlist(), [UUT._summarise(persistent), UUT._summarise(subscribed)])
+        self.assertEqual(restored.find_socks(path="/resource/flows/x", obj={"id": "x", "label": "a"}),
+                         [restored.sockets[1]])
+
+    @mock.patch('nmosquery.common.querysockets.time')
+    @mock.patch('nmosquery.common.querysockets.getLocalIP', return_value="192.168.0.23")
+    def test_restore_unclaimed(self, getLocalIP, time):
+        """Restored non-persistent subscriptions should go if no subscriber comes back for them in time"""
+        UUT = QuerySocketsCommon(8870, logger=mock.MagicMock(name="logger"))
+        persistent = UUT.add_sock({"resource_path": "/nodes", "persist": True})
+        for resource_path in ["/flows", "/senders"]:
+            UUT.add_sock({"resource_path": resource_path}).add_subscriber(mock.MagicMock(name="ws"))
+        records = UUT.records()
+
+        time.time.return_value = 1000
+        restored = QuerySocketsCommon(8870, logger=mock.MagicMock(name="logger"))
+        restored.restore(records)
+        claimed = restored.sockets[1]
+        claimed.add_subscriber(mock.MagicMock(name="ws"))
+        restored.attach(claimed)
+
+        time.time.return_value = 1000 + UNCLAIMED_EXPIRY - 1
+        restored.reconcile()
+        self.assertEqual(len(restored.sockets), 3)
+        time.time.return_value = 1000 + UNCLAIMED_EXPIRY
+        restored.reconcile()
+        self.assertEqual([sock.uuid for sock in restored.sockets], [persistent.uuid, claimed.uuid])
+
+    @mock.patch('nmosquery.common.querysockets.getLocalIP', return_value="192.168.0.23")
+    def test_shared_unclaimed(self, getLocalIP):
+        """Shared non-persistent subscriptions no subscriber connects to in time should go from every worker"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        workers = []
+        for worker in range(2):
+            UUT = QuerySocketsCommon(8870, logger=mock.MagicMock(name="logger"))
+            UUT.store = SubscriptionStore(path, worker).for_version("v1.0")
+            workers.append(UUT)
+
+        unclaimed, _ = workers[0].post_socket({"resource_path": "/nodes"})
+        claimed, _ = workers[0].post_socket({"resource_path": "/flows"})
+        persistent, _ = workers[0].post_socket({"resource_path": "/senders", "persist": True})
+        workers[1].attach(workers[1].get_sock({"uuid": claimed["id"]}))
+        workers[0].reconcile()
+        self.assertEqual(len(workers[1].get_socketlist()), 3)
+
+        # Saved long enough ago to have expired
+        for subdir, _, names in os.walk(path):
+            for name in names:
+                os.utime(os.path.join(subdir, name), (0, 0))
+        workers[0].reconcile()
+        self.assertEqual(set(summary["id"] for summary in workers[1].get_socketlist()),
+                         set([claimed["id"], persistent["id"]]))
+        self.assertEqual([sock.uuid for sock in workers[0].sockets], [claimed["id"], persistent["id"]])
+
+    @mock.patch('nmosquery.common.querysockets.getLocalIP', return_value="192.168.0.23")
+    def test_shared_subscriptions(self, getLocalIP):
+        """Subscriptions created through one worker process should be served by the others, under the same id"""
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        workers = []
+        for worker in range(2):
+            UUT = QuerySocketsCommon(8870, logger=mock.MagicMock(name="logger"))
+            UUT.store = SubscriptionStore(path, worker).for_version("v1.0")
+            workers.append(UUT)
+
+        opts = {"resource_path": "/nodes", "params": {"label": "a"}, "persist": False}
+        summary, created = workers[0].post_socket(opts)
+        self.assertTrue(created)
+        self.assertEqual(workers[1].get_socketlist(), [summary])
+        self.assertEqual(workers[1].post_socket(opts), [summary, False])
+        self.assertEqual(workers[1].get_socket(summary["id"]), summary)
+        self.assertEqual(workers[1].get_socket("potato"), None)
+
+        # Subscriptions are only served by a worker once a subscriber connects to it
+        self.assertEqual(workers[1].sockets, [])
+        sock = workers[1].get_sock({"uuid": summary["id"]})
+        self.assertEqual((sock.uuid, sock.ws_href), (summary["id"], summary["ws_href"]))
+        self.assertEqual(workers[1].find_socks(path="/resource/nodes/x", obj={"id": "x", "label": "a"}), [sock])
+
+        # Non-persistent subscriptions go once their last subscriber has gone from every worker
+        workers[1].attach(sock)
+        workers[0].attach(workers[0].get_sock({"uuid": summary["id"]}))
+        workers[1].remove_sock(sock)
+        self.assertEqual(workers[0].get_socketlist(), [summary])
+        workers[0].remove_sock(workers[0].sockets[0])
+        self.assertEqual(workers[1].get_socketlist(), [])
+
+        # Persistent subscriptions go when deleted through any worker, and the others follow
+        summary, created = workers[1].post_socket(dict(opts, persist=True))
+        sock = workers[0].get_sock({"uuid": summary["id"]})
+        ws = mock.MagicMock(name="ws")
+        sock.add_subscriber(ws)
+        workers[1].del_sock(workers[1].sockets[0])
+        self.assertTrue(workers[1].delete_socket(summary["id"]))
+        self.assertEqual(workers[0].get_socketlist(), [])
+        workers[0].reconcile()
+        self.assertEqual(workers[0].sockets, [])
+        ws.close.assert_called_once_with()
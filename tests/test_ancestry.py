@@ -0,0 +1,95 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from nmosquery.ancestry import RelationGraph, parse_ancestry_args
+
+RESOURCES = [
+    ("nodes", {"id": "node1"}),
+    ("devices", {"id": "dev1", "node_id": "node1"}),
+    ("sources", {"id": "src1", "device_id": "dev1", "parents": []}),
+    ("sources", {"id": "src2", "device_id": "dev1", "parents": ["src1"]}),
+    ("flows", {"id": "flow1", "source_id": "src1", "device_id": "dev1", "parents": []}),
+    ("flows", {"id": "flow2", "source_id": "src2", "device_id": "dev1", "parents": ["flow1"]}),
+    ("senders", {"id": "snd2", "flow_id": "flow2", "device_id": "dev1"}),
+    ("receivers", {"id": "rcv1", "device_id": "dev1", "subscription": {"sender_id": "snd2"}}),
+]
+
+
+def key(rtype, uid):
+    return "/resource/{}/{}".format(rtype, uid)
+
+
+class TestRelationGraph(unittest.TestCase):
+
+    def setUp(self):
+        self.UUT = RelationGraph()
+        for rtype, obj in RESOURCES:
+            self.UUT.add(key(rtype, obj["id"]), rtype, obj)
+
+    def test_parents(self):
+        self.assertEqual(self.UUT.related("rcv1", "parents"),
+                         set(["snd2", "flow2", "flow1", "src2", "src1", "dev1", "node1"]))
+        self.assertEqual(self.UUT.related("rcv1", "parents", 2), set(["snd2", "dev1", "flow2", "node1"]))
+        self.assertEqual(self.UUT.related("flow2", "parents", 1), set(["flow1", "src2", "dev1"]))
+        self.assertEqual(self.UUT.related("node1", "parents"), set())
+        self.assertEqual(self.UUT.related("potato", "parents"), set())
+
+    def test_children(self):
+        self.assertEqual(self.UUT.related("src1", "children", 1), set(["src2", "flow1"]))
+        self.assertEqual(self.UUT.related("flow1", "children"), set(["flow2", "snd2", "rcv1"]))
+        self.assertEqual(self.UUT.related_keys("src1", "children"),
+                         set([key("sources", "src2"), key("flows", "flow1"), key("flows", "flow2"),
+                              key("senders", "snd2"), key("receivers", "rcv1")]))
+
+    def test_update_and_remove(self):
+        # Resources may refer to ones which don't exist yet
+        self.UUT.add(key("receivers", "rcv1"), "receivers", {"id": "rcv1", "subscription": {"sender_id": "snd3"}})
+        self.assertEqual(self.UUT.related("snd2", "children"), set())
+        self.assertEqual(self.UUT.related_keys("rcv1", "parents"), set())
+        self.UUT.add(key("senders", "snd3"), "senders", {"id": "snd3", "flow_id": "flow1"})
+        self.assertEqual(self.UUT.related_keys("rcv1", "parents", 2),
+                         set([key("senders", "snd3"), key("flows", "flow1")]))
+
+        self.UUT.remove(key("flows", "flow2"))
+        self.assertEqual(self.UUT.related("src2", "children"), set())
+        self.assertEqual(self.UUT.related("flow1", "children"), set(["snd3", "rcv1"]))
+
+        self.UUT.clear()
+        self.assertEqual(self.UUT.related("flow1", "children"), set())
+
+    def test_cycles(self):
+        self.UUT.add(key("sources", "src1"), "sources", {"id": "src1", "parents": ["src2"]})
+        self.assertEqual(self.UUT.related("src1", "parents"), set(["src2", "dev1", "node1"]))
+
+
+class TestParseAncestryArgs(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertIsNone(parse_ancestry_args({}))
+        self.assertIsNone(parse_ancestry_args({"label": "potato"}))
+        self.assertEqual(parse_ancestry_args({"query.ancestry_id": "a", "query.ancestry_type": "children"}),
+                         ("a", "children", None))
+        self.assertEqual(parse_ancestry_args({"query.ancestry_id": "a", "query.ancestry_type": "parents",
+                                              "query.ancestry_generations": "2"}), ("a", "parents", 2))
+
+    def test_invalid(self):
+        for args in [{"query.ancestry_type": "children"},
+                     {"query.ancestry_id": "a"},
+                     {"query.ancestry_id": "a", "query.ancestry_type": "cousins"},
+                     {"query.ancestry_id": "a", "query.ancestry_type": "parents", "query.ancestry_generations": "0"},
+                     {"query.ancestry_id": "a", "query.ancestry_type": "parents", "query.ancestry_generations": "x"}]:
+            with self.assertRaises(ValueError):
+                parse_ancestry_args(args)
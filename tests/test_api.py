@@ -15,9 +15,16 @@
 import unittest
 import mock
 
+import os
 import json
+import uuid
+import shutil
+import tempfile
 
 from functools import wraps
+from fractions import Fraction
+from nmoscommon.webapi import jsonify
+from werkzeug.datastructures import MultiDict, ETags
 from socket import error as socket_error
 
 class WebAPIStub(object):
@@ -30,6 +37,9 @@ class WebAPIStub(object):
         super(WebAPIStub, self).__setattr__('websockets', {})
         self.add_routes(self, '')
 
+    def stop(self):
+        pass
+
     def add_routes(self, cl, basepath):
         """This method checks all the methods of the class specified and its ancestors and assigns them to the "routes" dict if they have the
         annotations added by the _route decorator (below)"""
@@ -86,8 +96,10 @@ def _on_json(path, *args, **kwargs):
 with mock.patch('nmoscommon.webapi.WebAPI', WebAPIStub):
     with mock.patch('nmoscommon.webapi.route', side_effect=_route) as route:
         with mock.patch('nmoscommon.webapi.on_json', side_effect=_on_json) as on_json:
-            from nmosquery.api import QueryServiceAPI
+            from nmosquery.api import QueryServiceAPI, REQUEST_DURATION, REQUESTS
             from nmosquery import VALID_TYPES
+            from nmosquery.paging import Page
+            from nmosquery.snapshot import write_snapshot, read_snapshot
 
 class AbortException(Exception):
     pass
@@ -95,20 +107,31 @@ class AbortException(Exception):
 API_VERSIONS = ['v1.0', 'v1.1', 'v1.2', 'v1.3']
 
 class TestQueryServiceAPI(unittest.TestCase):
+    @mock.patch('nmosquery.api.Registry')
     @mock.patch('nmosquery.common.routes.QueryCommon')
     @mock.patch('nmosquery.v1_0.routes.Query')
     @mock.patch('nmosquery.v1_1.routes.Query')
     @mock.patch('nmosquery.v1_2.routes.Query')
     @mock.patch('nmosquery.v1_3.routes.Query')
-    def setUp(self, v1_3Query, v1_2Query, v1_1Query, v1_0Query, QueryCommon):
+    def setUp(self, v1_3Query, v1_2Query, v1_1Query, v1_0Query, QueryCommon, Registry):
         self.queries = {'v1.0' : v1_0Query.return_value,
                         'v1.1' : v1_1Query.return_value,
                         'v1.2' : v1_2Query.return_value,
                         'v1.3' : v1_3Query.return_value,}
         self.logger = mock.MagicMock(name="logger")
         self.config = mock.MagicMock(dict)
+        self.config.get.side_effect = lambda key, default=None: default
+        for query in self.queries.values():
+            # Behave as if the registry mirror isn't yet available, so no entity tags are given
+            query.get_etag.return_value = None
         self.UUT = QueryServiceAPI(self.logger, self.config)
 
+        # All versions share a single registry and watcher
+        self.registry = Registry.return_value
+        for Query in [v1_0Query, v1_1Query, v1_2Query, v1_3Query]:
+            Query.assert_called_once_with(logger=self.logger, registry=self.registry)
+        self.registry.start.assert_called_once_with()
+
     def test_init(self):
         self.assertIn('/',              self.UUT.routes)
         self.assertEqual(self.UUT.routes['/']['GET'][1], ())
@@ -131,6 +154,107 @@ class TestQueryServiceAPI(unittest.TestCase):
     def test_nameindex(self):
         self.assertEqual(self.UUT.routes['/x-nmos/query/']['GET'][0](), (200, [api_version + "/" for api_version in API_VERSIONS]))
 
+    def test_metrics(self):
+        """Metrics should be rendered for scraping, including those read from the state of the service"""
+        self.queries['v1.2'].query_sockets.sockets = [mock.MagicMock(subscribers=["ws1", "ws2"]),
+                                                      mock.MagicMock(subscribers=[])]
+        self.queries['v1.2'].query_sockets.sockets[0].queued.return_value = 5
+        self.queries['v1.2'].query_sockets.sockets[1].queued.return_value = 0
+        self.registry.index = 7
+        self.registry.seeded = True
+        self.registry.watcher.events.last_index = 10
+        self.registry.watcher.events.queue.qsize.return_value = 2
+        self.registry.translations.stats.return_value = {"size": 4, "hits": 3, "misses": 1, "hit_rate": 0.75}
+
+        response = self.UUT.routes['/metrics']['GET'][0]()
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.headers['Content-Type'].startswith('text/plain; version=0.0.4'))
+        lines = response.get_data(as_text=True).split("\n")
+        for line in ['nmosquery_subscriptions{api_version="v1.2"} 2',
+                     'nmosquery_subscribers{api_version="v1.2"} 2',
+                     'nmosquery_subscribers{api_version="v1.3"} 0',
+                     'nmosquery_websocket_queued_messages{api_version="v1.2"} 5',
+                     'nmosquery_watch_queue_depth 2',
+                     'nmosquery_watch_lag 3',
+                     'nmosquery_translation_cache_lookups_total{result="hit"} 3',
+                     '# TYPE nmosquery_request_duration_seconds histogram',
+                     '# TYPE nmosquery_etcd_request_duration_seconds histogram']:
+            self.assertIn(line, lines)
+
+    @mock.patch('nmosquery.api.gevent.spawn')
+    @mock.patch('nmosquery.api.Registry')
+    @mock.patch('nmosquery.v1_0.routes.Query')
+    @mock.patch('nmosquery.v1_1.routes.Query')
+    @mock.patch('nmosquery.v1_2.routes.Query')
+    @mock.patch('nmosquery.v1_3.routes.Query')
+    def test_snapshots(self, v1_3Query, v1_2Query, v1_1Query, v1_0Query, Registry, spawn):
+        """The service should start from any snapshot, and write new ones as the registry changes"""
+        path = os.path.join(tempfile.mkdtemp(), "snapshot")
+        self.addCleanup(shutil.rmtree, os.path.dirname(path))
+        records = [{"summary": {"id": "a", "persist": True}, "secure": False}]
+        write_snapshot(path, 12, [("/resource/flows/a", 11, {"id": "a"})], {"v1.3": records})
+        config = {"snapshot_path": path, "snapshot_interval": 5}
+        UUT = QueryServiceAPI(self.logger, config)
+
+        registry = Registry.return_value
+        self.assertEqual(registry.warm_start, (12, [("/resource/flows/a", 11, {"id": "a"})]))
+        v1_3Query.return_value.query_sockets.restore.assert_called_once_with(records)
+        v1_0Query.return_value.query_sockets.restore.assert_called_once_with([])
+        spawn.assert_any_call(UUT._reconcile)
+        spawn.assert_any_call(UUT._write_snapshots, 5)
+
+        registry.seeded = True
+        registry.index = 13
+        registry.dump.return_value = (13, [("/resource/flows/b", 13, {"id": "b"})])
+        for Query in [v1_0Query, v1_1Query, v1_2Query, v1_3Query]:
+            Query.return_value.query_sockets.records.return_value = records
+        UUT.write_snapshot()
+        header, resources = read_snapshot(path)
+        self.assertEqual((header["index"], resources), (13, [("/resource/flows/b", 13, {"id": "b"})]))
+        self.assertEqual(header["subscriptions"], {api_version: records for api_version in API_VERSIONS})
+
+        # Unchanged, so not written again until it is
+        with mock.patch('nmosquery.api.write_snapshot') as write:
+            UUT.write_snapshot()
+            write.assert_not_called()
+            registry.index = 14
+            UUT.stop()
+            write.assert_called_once_with(path, 13, mock.ANY, mock.ANY)
+
+    @mock.patch('nmosquery.api.g')
+    @mock.patch('nmosquery.api.request')
+    def test_request_metrics(self, request, g):
+        """Requests should be timed by API version, route and resource type"""
+        request.url_rule.rule = '/x-nmos/query/v1.3/<ips_type>/'
+        request.view_args = {'ips_type': 'flows'}
+        request.method = 'GET'
+        duration = REQUEST_DURATION.labels('v1.3', '/<ips_type>/', 'flows')
+        requests = REQUESTS.labels('v1.3', '/<ips_type>/', 'GET', '200')
+        before = (duration.count, requests.value)
+
+        self.UUT._start_request()
+        response = mock.MagicMock(status_code=200)
+        self.assertIs(self.UUT._finish_request(response), response)
+        self.assertEqual((duration.count, requests.value), (before[0] + 1, before[1] + 1))
+
+        request.url_rule = None
+        request.view_args = None
+        request.method = 'POST'
+        self.UUT._finish_request(mock.MagicMock(status_code=404))
+        self.assertEqual(REQUESTS.labels('', 'unmatched', 'POST', '404').value, 1)
+
+        # Resource types not in the API are counted together, however many are asked for
+        request.url_rule = mock.MagicMock(rule='/x-nmos/query/v1.3/<ips_type>/')
+        request.method = 'GET'
+        children = len(REQUEST_DURATION._children)
+        for ips_type in ['potato', 'potatoes']:
+            request.view_args = {'ips_type': ips_type}
+            self.UUT._start_request()
+            self.UUT._finish_request(mock.MagicMock(status_code=404))
+        self.assertEqual(REQUEST_DURATION.labels('v1.3', '/<ips_type>/', 'other').count, 2)
+        self.assertLessEqual(len(REQUEST_DURATION._children), children + 1)
+        self.assertNotIn(('v1.3', '/<ips_type>/', 'potato'), REQUEST_DURATION._children)
+
     # These additional methods test out routes added by the common.routes.RoutesCommon class
     def test_versionindex(self):
         for v in API_VERSIONS:
@@ -160,24 +284,160 @@ Expected:
     @mock.patch('nmosquery.common.routes.request')
     def test_ips_type(self, request, abort):
         """This method should call through to the relevent query"""
-        for v in API_VERSIONS:
-            for t in VALID_TYPES:
-                self.queries[v].get_data_for_path.reset_mock()
-                self.queries[v].get_data_for_path.return_value = mock.DEFAULT
-                self.assert_route_returns_value(v, '/x-nmos/query/' + v + '/<ips_type>/', [t,], (200, self.queries[v].get_data_for_path.return_value), request)
-                self.queries[v].get_data_for_path.assert_called_once_with('/' + t, request.args)
+        v = 'v1.0'
+        for t in VALID_TYPES:
+            self.queries[v].get_data_for_path.reset_mock()
+            self.queries[v].get_data_for_path.return_value = mock.DEFAULT
+            self.assert_route_returns_value(v, '/x-nmos/query/' + v + '/<ips_type>/', [t,], (200, self.queries[v].get_data_for_path.return_value), request)
+            self.queries[v].get_data_for_path.assert_called_once_with('/' + t, request.args)
+
+            self.queries[v].get_data_for_path.reset_mock()
+            self.queries[v].get_data_for_path.return_value = None
+            self.assert_route_returns_value(v, '/x-nmos/query/' + v + '/<ips_type>/', [t,], (200, []), request)
+            self.queries[v].get_data_for_path.assert_called_once_with('/' + t, request.args)
 
-                self.queries[v].get_data_for_path.reset_mock()
-                self.queries[v].get_data_for_path.return_value = None
-                self.assert_route_returns_value(v, '/x-nmos/query/' + v + '/<ips_type>/', [t,], (200, []), request)
-                self.queries[v].get_data_for_path.assert_called_once_with('/' + t, request.args)
+        for v in API_VERSIONS:
+            abort.reset_mock()
+            with self.assertRaises(AbortException):
+                self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('potato')
+            abort.assert_called_once_with(404)
 
-            if True:
+    @mock.patch('nmosquery.common.routes.abort', side_effect=AbortException)
+    @mock.patch('nmosquery.common.routes.request')
+    def test_ips_type_paged(self, request, abort):
+        """From v1.1 collections should be paged, with the bounds of the page returned in headers"""
+        self.config.get.side_effect = lambda key, default=None: default
+        request.base_url = "http://localhost/x-nmos/query/v1.1/flows/"
+        for v in API_VERSIONS[1:]:
+            query = self.queries[v]
+            query.get_page_for_path.return_value = Page([mock.sentinel.flow], (1, 5), (2, 0), 10)
+            request.args = MultiDict([("format", "urn:x-nmos:format:video"), ("paging.since", "1:5"),
+                                      ("paging.limit", "10")])
+            rval = self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('flows')
+            query.get_page_for_path.assert_called_once_with('/flows', request.args, "update", (1, 5), None, 10)
+            self.assertEqual(rval[:2], (200, [mock.sentinel.flow]))
+            self.assertEqual(rval[2]["X-Paging-Limit"], "10")
+            self.assertEqual(rval[2]["X-Paging-Since"], "1:5")
+            self.assertEqual(rval[2]["X-Paging-Until"], "2:0")
+            base = "<http://localhost/x-nmos/query/v1.1/flows/?format=urn%3Ax-nmos%3Aformat%3Avideo&"
+            self.assertEqual(rval[2]["Link"].split(", "), [
+                base + 'paging.since=0%3A0&paging.limit=10>; rel="first"',
+                base + 'paging.limit=10>; rel="last"',
+                base + 'paging.since=2%3A0&paging.limit=10>; rel="next"',
+                base + 'paging.until=1%3A5&paging.limit=10>; rel="prev"'
+            ])
+
+            # Defaults, and limits above the maximum
+            query.get_page_for_path.reset_mock()
+            request.args = MultiDict([("paging.order", "update"), ("paging.limit", "5000")])
+            self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('flows')
+            query.get_page_for_path.assert_called_once_with('/flows', request.args, "update", None, None, 1000)
+
+            for args in [[("paging.order", "potato")], [("paging.since", "potato")], [("paging.until", "1:-1")],
+                         [("paging.limit", "0")], [("paging.limit", "potato")],
+                         [("paging.since", "2:0"), ("paging.until", "1:0")]]:
                 abort.reset_mock()
+                request.args = MultiDict(args)
                 with self.assertRaises(AbortException):
-                    self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('potato')
-                abort.assert_called_once_with(404)
+                    self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('flows')
+                self.assertEqual(abort.call_args[0][0], 400)
+
+    @mock.patch('nmosquery.common.routes.abort', side_effect=AbortException)
+    @mock.patch('nmosquery.common.routes.request')
+    def test_ips_type_streamed(self, request, abort):
+        """When configured, collections should be encoded one element at a time as they are sent"""
+        config = {"stream_responses": True}
+        self.config.get.side_effect = lambda key, default=None: config.get(key, default)
+        request.args = MultiDict()
+        request.base_url = "http://localhost/x-nmos/query/v1.1/flows/"
+        request.accept_mimetypes.best_match.return_value = 'application/json'
+        flows = [{"id": "a", "label": "flow a"}, {"id": "b", "label": "flow b"}]
+        for v in API_VERSIONS:
+            query = self.queries[v]
+            query.iter_data_for_path.return_value = iter(flows)
+            query.get_page_for_path.return_value = Page(flows, (1, 5), (2, 0), 10)
+            rval = self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('flows')
+            self.assertEqual(rval[0], 200)
+            self.assertEqual(rval[2]["Content-Type"], "application/json")
+            self.assertNotIsInstance(rval[1], list)
+            self.assertEqual(json.loads("".join(rval[1])), flows)
+            query.get_data_for_path.assert_not_called()
+
+        self.queries['v1.0'].iter_data_for_path.return_value = iter([])
+        rval = self.UUT.routes['/x-nmos/query/v1.0/<ips_type>/']['GET'][0]('flows')
+        self.assertEqual(json.loads("".join(rval[1])), [])
+
+        # Encoded as every other response is
+        flows = [{"id": uuid.UUID(int=1), "grain_rate": Fraction(25, 1)}]
+        self.queries['v1.0'].iter_data_for_path.return_value = iter(flows)
+        rval = self.UUT.routes['/x-nmos/query/v1.0/<ips_type>/']['GET'][0]('flows')
+        self.assertEqual(json.loads("".join(rval[1])), json.loads(jsonify(flows).get_data(as_text=True)))
+
+        # Clients asking for HTML get the usual page
+        request.accept_mimetypes.best_match.return_value = 'text/html'
+        self.queries['v1.0'].get_data_for_path.return_value = flows
+        self.assertEqual(self.UUT.routes['/x-nmos/query/v1.0/<ips_type>/']['GET'][0]('flows'), (200, flows))
+
+    @mock.patch('nmosquery.common.routes.abort', side_effect=AbortException)
+    @mock.patch('nmosquery.common.routes.request')
+    def test_ips_type_rql(self, request, abort):
+        """RQL queries should be passed through to the query once they have been checked"""
+        v = 'v1.0'
+        request.args = MultiDict([("query.rql", "eq(label,potato)")])
+        self.queries[v].get_data_for_path.return_value = [mock.sentinel.flow]
+        self.assertEqual(self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('flows'),
+                         (200, [mock.sentinel.flow]))
+        self.queries[v].get_data_for_path.assert_called_once_with('/flows', request.args)
+
+        for expression, status in [("eq(label,potato", 400), ("potato", 400), ("sort(+label)", 501)]:
+            abort.reset_mock()
+            request.args = MultiDict([("query.rql", expression)])
+            with self.assertRaises(AbortException):
+                self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('flows')
+            abort.assert_called_once_with(status, mock.ANY)
 
+    @mock.patch('nmosquery.common.routes.abort', side_effect=AbortException)
+    @mock.patch('nmosquery.common.routes.request')
+    def test_ips_type_fields(self, request, abort):
+        """Lists of fields should be checked before being passed through to the query"""
+        v = 'v1.0'
+        request.args = MultiDict([("query.fields", "label,caps.media_types")])
+        self.queries[v].get_data_for_path.return_value = [mock.sentinel.flow]
+        self.assertEqual(self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('flows'),
+                         (200, [mock.sentinel.flow]))
+        self.queries[v].get_data_for_path.assert_called_once_with('/flows', request.args)
+
+        request.args = MultiDict([("query.fields", "label,,caps")])
+        with self.assertRaises(AbortException):
+            self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('flows')
+        abort.assert_called_once_with(400, mock.ANY)
+
+    @mock.patch('nmosquery.common.routes.abort', side_effect=AbortException)
+    @mock.patch('nmosquery.common.routes.request')
+    def test_ips_type_ancestry(self, request, abort):
+        """Ancestry queries should be checked, then passed through to the query"""
+        v = 'v1.0'
+        request.args = MultiDict([("query.ancestry_id", "a"), ("query.ancestry_type", "children")])
+        self.queries[v].get_data_for_path.return_value = [mock.sentinel.flow]
+        self.assertEqual(self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('flows'),
+                         (200, [mock.sentinel.flow]))
+        self.queries[v].get_data_for_path.assert_called_once_with('/flows', request.args)
+
+        for args in [[("query.ancestry_id", "a")], [("query.ancestry_type", "children")],
+                     [("query.ancestry_id", "a"), ("query.ancestry_type", "children"),
+                      ("query.ancestry_generations", "-1")]]:
+            abort.reset_mock()
+            request.args = MultiDict(args)
+            with self.assertRaises(AbortException):
+                self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('flows')
+            abort.assert_called_once_with(400, mock.ANY)
+
+        abort.reset_mock()
+        self.queries[v].registry.seeded = False
+        request.args = MultiDict([("query.ancestry_id", "a"), ("query.ancestry_type", "children")])
+        with self.assertRaises(AbortException):
+            self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/']['GET'][0]('flows')
+        abort.assert_called_once_with(503, mock.ANY)
 
     @mock.patch('nmosquery.common.routes.abort', side_effect=AbortException)
     @mock.patch('nmosquery.common.routes.request')
@@ -208,6 +468,44 @@ Expected:
                     self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/<el_id>/']['GET'][0](t, EL_ID)
                 abort.assert_called_once_with(404)
 
+    @mock.patch('nmosquery.common.routes.abort', side_effect=AbortException)
+    @mock.patch('nmosquery.common.routes.request')
+    def test_etags(self, request, abort):
+        """Responses should carry entity tags from the query, and be 304 without a body when the client has them"""
+        for v in API_VERSIONS:
+            query = self.queries[v]
+            query.get_etag.return_value = "abc"
+            query.get_data_for_path.return_value = [mock.sentinel.flow]
+            query.get_page_for_path.return_value = Page([mock.sentinel.flow], (1, 5), (2, 0), 10)
+            request.args = MultiDict()
+            request.base_url = "http://localhost/x-nmos/query/{}/flows/".format(v)
+            self.config.get.side_effect = lambda key, default=None: default
+
+            for path, args in [('/x-nmos/query/' + v + '/<ips_type>/', ['flows']),
+                               ('/x-nmos/query/' + v + '/<ips_type>/<el_id>/', ['flows', 'potato'])]:
+                query.get_data_for_path.reset_mock()
+                query.get_page_for_path.reset_mock()
+                request.if_none_match = ETags(["xyz"])
+                rval = self.UUT.routes[path]['GET'][0](*args)
+                self.assertEqual(rval[0], 200)
+                self.assertEqual(rval[2]["ETag"], 'W/"abc"')
+
+                for tags in [ETags(["abc"]), ETags(weak_etags=["abc"]), ETags(star_tag=True)]:
+                    query.get_data_for_path.reset_mock()
+                    query.get_page_for_path.reset_mock()
+                    request.if_none_match = tags
+                    self.assertEqual(self.UUT.routes[path]['GET'][0](*args), (304, '', {"ETag": 'W/"abc"'}))
+                    query.get_data_for_path.assert_not_called()
+                    query.get_page_for_path.assert_not_called()
+                query.get_etag.assert_called_with(
+                    '/flows' if len(args) == 1 else '/flows/potato', request.args)
+
+            # Not found responses aren't tagged
+            request.if_none_match = ETags()
+            query.get_data_for_path.return_value = None
+            self.assertEqual(self.UUT.routes['/x-nmos/query/' + v + '/<ips_type>/<el_id>/']['GET'][0](
+                'flows', 'potato'), (404, ''))
+
     @mock.patch('nmosquery.common.routes.make_response')
     @mock.patch('nmosquery.common.routes.abort', side_effect=AbortException)
     @mock.patch('nmosquery.common.routes.request')
@@ -244,6 +542,17 @@ Expected:
                 self.UUT.routes[path][request.method][0]()
             abort.assert_called_once_with(400, mock.ANY)
 
+            request.get_data = mock.MagicMock(return_value=json.dumps({"params": {"query.rql": "eq(label"}}))
+            abort.reset_mock()
+            with self.assertRaises(AbortException):
+                self.UUT.routes[path][request.method][0]()
+            abort.assert_called_once_with(400, mock.ANY)
+            request.get_data = mock.MagicMock(return_value=json.dumps({"params": {"query.fields": "label."}}))
+            abort.reset_mock()
+            with self.assertRaises(AbortException):
+                self.UUT.routes[path][request.method][0]()
+            abort.assert_called_once_with(400, mock.ANY)
+
     @mock.patch('nmosquery.common.routes.abort', side_effect=AbortException)
     @mock.patch('nmosquery.common.routes.request')
     def test_subscriptions_get(self, request, abort):
@@ -348,8 +657,10 @@ Expected:
                 return None
 
         self.queries[v].query_sockets.get_sock.side_effect = _get_sock
+        self.queries[v].query_sockets.remove_sock.side_effect = self.queries[v].query_sockets.sockets.remove
         socket.subscribers = []
-        socket.add_subscriber.side_effect = lambda x : socket.subscribers.append(x)
+        socket.add_subscriber.side_effect = lambda x, syncing=False, resync=None : socket.subscribers.append(x)
+        socket.remove_subscriber.side_effect = socket.subscribers.remove
         socket.persist = persist
         ws = mock.MagicMock(name="ws", environ={'QUERY_STRING' : '&'.join(('='.join((k,v)) for (k,v) in args.items()))})
         ws.receive.side_effect = [ msg, raise_exception ]
@@ -359,7 +670,8 @@ Expected:
         self.queries[v].query_sockets.get_sock.assert_called_once_with({ 'uuid' : args['uid']})
 
         if has_socket:
-            socket.add_subscriber.assert_called_once_with(ws)
+            socket.add_subscriber.assert_called_once_with(ws, syncing=True, resync=self.queries[v].do_sync)
+            socket.remove_subscriber.assert_called_once_with(ws)
             self.queries[v].do_sync.assert_called_once_with(ws, socket)
             self.UUT.websockets['/x-nmos/query/' + v + '/ws/'][1].assert_called_once_with(ws, msg)
             if not persist:
@@ -26,24 +26,29 @@ class TestChangeWatcher(unittest.TestCase):
     def setUp(self):
         self.handler = mock.MagicMock(name='handler')
         self.logger  = mock.MagicMock(name='logger')
-        self.UUT = ChangeWatcher(mock.sentinel.host, mock.sentinel.port, self.handler, self.logger)
+        self.backend = mock.MagicMock(name='backend')
+        self.UUT = ChangeWatcher(self.backend, self.handler, self.logger)
 
     @mock.patch('gevent.sleep')
-    @mock.patch('nmosquery.changewatcher.EtcdEventQueue')
-    def test_run(self, EtcdEventQueue, sleep):
+    def test_run(self, sleep):
         """The _run method is called by the greenlet as the body of the `thread', make sure it does what it's supposed to"""
         EVENTS = [ mock.sentinel.event0, mock.sentinel.event1, mock.sentinel.event2, mock.sentinel.exceptional_event ]
-        EtcdEventQueue.return_value.queue = EVENTS
+        self.backend.watch.return_value.queue = EVENTS
         def _process_response(event):
             if event == mock.sentinel.exceptional_event:
                 raise Exception
             elif event in EVENTS:
                 EVENTS.remove(event)
         self.handler._process_response.side_effect = _process_response
-        self.handler.query_sockets.del_all_socks.side_effect = self.UUT.stop
+        self.handler.del_all_socks.side_effect = self.UUT.stop
 
+        self.assertFalse(self.UUT.watching.is_set())
         self.UUT._run()
 
+        self.handler.seed.assert_called_once_with()
+        self.assertTrue(self.UUT.watching.is_set())
+        self.backend.watch.assert_called_once_with(since=self.handler.seed.return_value)
+
         six.assertCountEqual(self, self.handler._process_response.mock_calls,
                              [mock.call(mock.sentinel.event0),
                               mock.call(mock.sentinel.event1),
@@ -53,4 +58,12 @@ class TestChangeWatcher(unittest.TestCase):
                               mock.call(mock.sentinel.exceptional_event),
                               mock.call(mock.sentinel.exceptional_event)])
         self.assertListEqual(sleep.mock_calls, [ mock.call(1), mock.call(3), mock.call(10), mock.call(10) ])
-        self.handler.query_sockets.del_all_socks.assert_called_once_with()
+        self.handler.del_all_socks.assert_called_once_with()
+
+    @mock.patch('gevent.sleep')
+    def test_seed_retries(self, sleep):
+        """The watcher should not start watching until the registry has been snapshotted"""
+        self.UUT.running = True
+        self.handler.seed.side_effect = [ None, None, 42 ]
+        self.assertEqual(self.UUT._seed([0, 1, 3, 10]), 42)
+        self.assertListEqual(sleep.mock_calls, [ mock.call(1), mock.call(3) ])
@@ -0,0 +1,50 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+import mock
+
+from requests.structures import CaseInsensitiveDict
+
+from nmosquery import etcd_backend
+
+
+def response(status_code=200, content=b'{"action": "set"}'):
+    retval = mock.MagicMock(name="response", status_code=status_code, reason="OK", content=content)
+    retval.headers = CaseInsensitiveDict({"X-Etcd-Index": "12"})
+    return retval
+
+
+@mock.patch('nmosquery.etcd_backend.shared_pool')
+class TestEtcdBackend(unittest.TestCase):
+
+    def test_put(self, shared_pool):
+        """Keys should be set through the shared pool, with responses in the form once returned"""
+        shared_pool.return_value.request.return_value = response(201)
+        resp = etcd_backend.put("/resource/flows/a", "{}", ttl=12, port=4001)
+        shared_pool.return_value.request.assert_called_once_with(
+            "PUT", "http://localhost:4001/v2/keys/resource/flows/a", data={"value": "{}", "ttl": 12})
+        self.assertEqual((resp.status, resp.reason, resp.data, resp.read()),
+                         (201, "OK", b'{"action": "set"}', b'{"action": "set"}'))
+        self.assertEqual(resp.getheader("x-etcd-index"), "12")
+        self.assertEqual(resp.getheaders(), [("x-etcd-index", "12")])
+
+        # As well as that of a requests Response
+        self.assertEqual(resp.status_code, 201)
+
+    def test_delete(self, shared_pool):
+        shared_pool.return_value.request.return_value = response(404, b'{"errorCode": 100}')
+        resp = etcd_backend.delete("/resource/flows/a")
+        shared_pool.return_value.request.assert_called_once_with(
+            "DELETE", "http://localhost:2379/v2/keys/resource/flows/a?recursive=true")
+        self.assertEqual((resp.status, resp.data), (404, b'{"errorCode": 100}'))
@@ -0,0 +1,150 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import mock
+import json
+import requests
+from urllib3.exceptions import ReadTimeoutError
+
+from nmosquery.etcd_watch import EtcdEventQueue, WATCH_STREAM, ETCD_WATCH_EVENTS, ETCD_WATCH_REQUESTS
+
+
+def response(status_code=200, lines=None, body=None, index=None):
+    retval = mock.MagicMock(name='response', status_code=status_code)
+    retval.headers = {"x-etcd-index": str(index)} if index is not None else {}
+    retval.json.return_value = body
+    retval.iter_lines.return_value = [(json.dumps(line) + "\n").encode('utf-8').rstrip() for line in (lines or [])]
+    return retval
+
+
+def event(key, index):
+    return {"action": "set", "node": {"key": key, "value": "{}", "modifiedIndex": index}}
+
+
+class TestEtcdEventQueue(unittest.TestCase):
+    def setUp(self):
+        self.pool = mock.MagicMock(name="pool")
+        with mock.patch('gevent.spawn'):
+            self.UUT = EtcdEventQueue("localhost", 2379, logger=mock.MagicMock(name="logger"), since=20,
+                                      pool=self.pool, mode=WATCH_STREAM)
+
+    def events(self):
+        events = []
+        while not self.UUT.queue.empty():
+            events.append(self.UUT.queue.get())
+        return events
+
+    def stream(self, *responses, **kwargs):
+        """Run the streaming watch until it has made a request for each of `responses'"""
+        return self.watch(self.UUT._stream_events, responses, **kwargs)
+
+    def watch(self, run, responses, index=100):
+        """Run a watch until it has made a request for each of `responses', with etcd's index at `index'"""
+        responses = list(responses)
+
+        def get(url, **kwargs):
+            if "wait=true" not in url:
+                return response(index=index)
+            if len(responses) == 1:
+                self.UUT._alive = False
+            result = responses.pop(0)
+            if isinstance(result, Exception):
+                raise result
+            return result
+
+        self.pool.get.side_effect = get
+        with mock.patch('gevent.sleep'):
+            run(20)
+        return [call[0][0] for call in self.pool.get.call_args_list if "wait=true" in call[0][0]]
+
+    def test_bad_mode(self):
+        self.assertRaises(ValueError, EtcdEventQueue, "localhost", 2379, mode="potato")
+
+    def test_stream(self):
+        """Changes should be delivered from a single streaming request as they arrive"""
+        events_before = ETCD_WATCH_EVENTS.labels(WATCH_STREAM).value
+        requests_before = ETCD_WATCH_REQUESTS.labels(WATCH_STREAM).value
+        stream = response(lines=[event("/resource/flows/a", 21), event("/resource/flows/b", 23)], index=25)
+        urls = self.stream(stream)
+
+        self.assertEqual(urls, ["http://localhost:2379/v2/keys/resource/?recursive=true&wait=true"
+                                "&stream=true&waitIndex=21"])
+        self.assertTrue(self.pool.get.call_args[1]["stream"])
+        stream.close.assert_called_once_with()
+        self.assertEqual(self.events(), [event("/resource/flows/a", 21), event("/resource/flows/b", 23)])
+        self.assertEqual(self.UUT.last_index, 25)
+        self.assertEqual(ETCD_WATCH_EVENTS.labels(WATCH_STREAM).value - events_before, 2)
+        self.assertEqual(ETCD_WATCH_REQUESTS.labels(WATCH_STREAM).value - requests_before, 1)
+
+    def test_stream_resumes(self):
+        """Streams which end or fail should be resumed from the last change delivered"""
+        failed = response()
+        failed.iter_lines.return_value = iter([json.dumps(event("/resource/flows/a", 22)).encode('utf-8'), b"{"])
+        urls = self.stream(response(lines=[event("/resource/flows/a", 21)]), failed,
+                           requests.exceptions.ConnectionError("potato"), response())
+        self.assertEqual([url.split("waitIndex=")[1] for url in urls], ["21", "22", "23", "23"])
+        self.assertEqual([e["node"]["modifiedIndex"] for e in self.events()], [21, 22])
+
+    def test_stream_idle(self):
+        """Streams which time out without a change should watch again from the last change seen"""
+        timeout = requests.exceptions.ConnectionError(ReadTimeoutError(None, None, "Read timed out."))
+        urls = self.stream(timeout, response())
+        self.assertEqual([url.split("waitIndex=")[1] for url in urls], ["21", "21"])
+        self.assertEqual(self.events(), [])
+        self.assertEqual(self.UUT.last_index, 100)
+
+    def test_stream_idle_other_changes(self):
+        """Watches idle while etcd's index moves on should follow it, so as not to fall out of etcd's history"""
+        timeout = requests.exceptions.ConnectionError(ReadTimeoutError(None, None, "Read timed out."))
+        urls = self.stream(timeout, timeout, timeout, response())
+        self.assertEqual([url.split("waitIndex=")[1] for url in urls], ["21", "21", "101", "101"])
+        self.assertEqual(self.events(), [])
+
+        # Likewise long-polls
+        self.pool.get.reset_mock()
+        self.UUT._alive = True
+        self.UUT._quiet_index = None
+        urls = self.watch(self.UUT._wait_event, [requests.exceptions.ReadTimeout()] * 2 +
+                          [response(status_code=400, body={})], index=500)
+        self.assertEqual([url.split("waitIndex=")[1] for url in urls], ["21", "21", "501"])
+        self.assertEqual(self.events(), [])
+
+    def test_stream_change_after_timeout(self):
+        """A change made between a watch timing out and the next should not be missed"""
+        timeout = requests.exceptions.ConnectionError(ReadTimeoutError(None, None, "Read timed out."))
+        urls = self.stream(response(lines=[event("/resource/flows/a", 21)]), timeout,
+                           response(lines=[event("/resource/flows/b", 22)]))
+        self.assertEqual([url.split("waitIndex=")[1] for url in urls], ["21", "22", "22"])
+        self.assertEqual([e["node"]["modifiedIndex"] for e in self.events()], [21, 22])
+
+    def test_long_poll_change_after_timeout(self):
+        """A change made between a long-poll timing out and the next should not be missed"""
+        urls = self.watch(self.UUT._wait_event, [requests.exceptions.ReadTimeout(),
+                                                 response(body=event("/resource/flows/a", 21), index=21)])
+        self.assertEqual([url.split("waitIndex=")[1] for url in urls], ["21", "21"])
+        self.assertEqual(self.events(), [event("/resource/flows/a", 21)])
+
+    def test_stream_index_went_back(self):
+        """Where etcd's index has gone back, the watch should skip back to it, sending an index_skip"""
+        timeout = requests.exceptions.ConnectionError(ReadTimeoutError(None, None, "Read timed out."))
+        urls = self.stream(timeout, response(), index=10)
+        self.assertEqual([url.split("waitIndex=")[1] for url in urls], ["21", "11"])
+        self.assertEqual(self.events(), [{"action": "index_skip", "from": 20, "to": 10}])
+
+    def test_stream_history_cleared(self):
+        """Where the history of changes has been cleared, an index_skip should be sent"""
+        urls = self.stream(response(status_code=400, body={"errorCode": 401}), response())
+        self.assertEqual([url.split("waitIndex=")[1] for url in urls], ["21", "101"])
+        self.assertEqual(self.events(), [{"action": "index_skip", "from": 20, "to": 100}])
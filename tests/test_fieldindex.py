@@ -0,0 +1,80 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from nmosquery.fieldindex import FieldIndex
+from nmosquery.common.querysockets import QueryFilterCommon
+
+FLOWS = {
+    "/resource/flows/a": {"id": "a", "device_id": "dev1", "source_id": "src1", "format": "urn:x-nmos:format:video"},
+    "/resource/flows/b": {"id": "b", "device_id": "dev1", "source_id": "src2", "format": "urn:x-nmos:format:audio"},
+    "/resource/flows/c": {"id": "c", "device_id": "dev2", "source_id": "src3", "format": "urn:x-nmos:format:video"},
+    "/resource/flows/d": {"id": "d", "device_id": "", "source_id": "src4", "format": "urn:x-nmos:format:data"},
+    "/resource/flows/e": {"id": "e", "source_id": "src5", "format": ["urn:x-nmos:format:mux"]},
+}
+
+
+class TestFieldIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.UUT = FieldIndex()
+        for key, obj in FLOWS.items():
+            self.UUT.add(key, "flows", obj)
+
+    def assert_consistent_with_filter(self, args):
+        """Anything the full filter would match must be among the candidates"""
+        candidates = self.UUT.lookup("flows", args)
+        matches = set(key for key, obj in FLOWS.items() if QueryFilterCommon().check_args(args, obj))
+        self.assertTrue(matches.issubset(candidates), (args, matches, candidates))
+        return candidates
+
+    def test_lookup(self):
+        self.assertEqual(self.assert_consistent_with_filter({"device_id": "dev1"}),
+                         set(["/resource/flows/a", "/resource/flows/b", "/resource/flows/d"]))
+        self.assertEqual(self.assert_consistent_with_filter({"device_id": "dev1", "format": "urn:x-nmos:format:video"}),
+                         set(["/resource/flows/a"]))
+        self.assertEqual(self.assert_consistent_with_filter({"format": "urn:x-nmos:format:mux"}),
+                         set(["/resource/flows/e"]))
+        self.assertEqual(self.assert_consistent_with_filter({"source_id": "potato"}), set())
+
+    def test_lookup_unindexed(self):
+        self.assertIsNone(self.UUT.lookup("flows", {}))
+        self.assertIsNone(self.UUT.lookup("flows", None))
+        self.assertIsNone(self.UUT.lookup("flows", {"label": "potato"}))
+        self.assertIsNone(self.UUT.lookup("nodes", {"device_id": "dev1"}))
+        self.assertEqual(self.UUT.lookup("flows", {"label": "potato", "source_id": "src3"}),
+                         set(["/resource/flows/c"]))
+
+    def test_keys_for(self):
+        self.assertEqual(self.UUT.keys_for("flows", "format", ["urn:x-nmos:format:audio", "urn:x-nmos:format:mux"]),
+                         set(["/resource/flows/b", "/resource/flows/e"]))
+        self.assertEqual(self.UUT.keys_for("flows", "device_id", ["dev2"]),
+                         set(["/resource/flows/c", "/resource/flows/d"]))
+        self.assertIsNone(self.UUT.keys_for("flows", "label", ["potato"]))
+        self.assertIsNone(self.UUT.keys_for("flows", "format", [["unhashable"]]))
+
+    def test_update_and_remove(self):
+        self.UUT.add("/resource/flows/a", "flows", {"id": "a", "device_id": "dev2"})
+        self.assertEqual(self.UUT.lookup("flows", {"device_id": "dev2"}),
+                         set(["/resource/flows/a", "/resource/flows/c", "/resource/flows/d"]))
+        self.assertEqual(self.UUT.lookup("flows", {"source_id": "src1"}), set())
+
+        self.UUT.remove("/resource/flows/c")
+        self.UUT.remove("/resource/flows/c")
+        self.assertEqual(self.UUT.lookup("flows", {"device_id": "dev2"}),
+                         set(["/resource/flows/a", "/resource/flows/d"]))
+
+        self.UUT.clear()
+        self.assertEqual(self.UUT.lookup("flows", {"device_id": "dev2"}), set())
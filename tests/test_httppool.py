@@ -0,0 +1,72 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import mock
+
+from gevent.pywsgi import WSGIServer
+
+from nmosquery.httppool import HTTPPool, DEFAULT_TIMEOUT, ETCD_REQUEST_DURATION
+
+
+def app(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", "2")])
+    return [b"ok"]
+
+
+class TestHTTPPool(unittest.TestCase):
+    def setUp(self):
+        self.UUT = HTTPPool(size=2)
+
+    def tearDown(self):
+        self.UUT.close()
+
+    def test_timeout(self):
+        """Calls should have the pool's timeout unless they give their own"""
+        with mock.patch('requests.Session.request') as request:
+            self.UUT.get("http://localhost:2379/v2/keys/")
+            request.assert_called_once_with("GET", "http://localhost:2379/v2/keys/", timeout=DEFAULT_TIMEOUT)
+            self.UUT.post("http://localhost:2379/v3/watch", data="{}", timeout=20)
+            request.assert_called_with("POST", "http://localhost:2379/v3/watch", data="{}", timeout=20)
+
+    def test_errors(self):
+        with mock.patch('requests.Session.request', side_effect=Exception):
+            self.assertRaises(Exception, self.UUT.get, "http://localhost:2379/v2/keys/")
+        self.assertEqual((self.UUT.requests, self.UUT.errors, self.UUT.in_flight), (1, 1, 0))
+
+    def test_durations(self):
+        """Round trip times should be recorded for every call except long polls"""
+        before = ETCD_REQUEST_DURATION.labels("GET").count
+        with mock.patch('requests.Session.request') as request:
+            self.UUT.get("http://localhost:2379/v2/keys/")
+            self.UUT.get("http://localhost:2379/v2/keys/?wait=true", long_poll=True)
+            request.assert_called_with("GET", "http://localhost:2379/v2/keys/?wait=true", timeout=DEFAULT_TIMEOUT)
+        self.assertEqual(ETCD_REQUEST_DURATION.labels("GET").count - before, 1)
+        self.assertEqual(self.UUT.requests, 2)
+
+    def test_connections_reused(self):
+        """Successive calls to the same host should share a persistent connection"""
+        server = WSGIServer(("127.0.0.1", 0), app, log=None)
+        server.start()
+        try:
+            url = "http://127.0.0.1:{}/".format(server.server_port)
+            for _ in range(3):
+                self.assertEqual(self.UUT.get(url).text, "ok")
+        finally:
+            server.stop()
+        stats = self.UUT.stats()
+        self.assertEqual(stats["requests"], 3)
+        self.assertEqual(stats["connections_opened"], 1)
+        self.assertEqual(stats["connections_idle"], 1)
+        self.assertEqual(stats["size"], 2)
@@ -0,0 +1,65 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from nmosquery.metrics import MetricsRegistry, Counter, Gauge, Histogram
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        counter = Counter("requests_total", "Requests made", ["method", "path"])
+        counter.labels("GET", "/a").inc()
+        counter.labels("GET", "/a").inc(2)
+        counter.labels("PUT", 'a "b"\\c').inc()
+        self.assertEqual(counter.render(), "\n".join([
+            "# HELP requests_total Requests made",
+            "# TYPE requests_total counter",
+            'requests_total{method="GET",path="/a"} 3',
+            'requests_total{method="PUT",path="a \\"b\\"\\\\c"} 1',
+        ]) + "\n")
+        self.assertRaises(ValueError, counter.labels, "GET")
+
+    def test_gauge(self):
+        gauge = Gauge("depth", "Queue depth")
+        gauge.set(5)
+        gauge.dec()
+        gauge.inc(0.5)
+        self.assertEqual(list(gauge.samples()), [("depth", (), 4.5)])
+        self.assertIn("depth 4.5\n", gauge.render())
+
+    def test_histogram(self):
+        histogram = Histogram("latency_seconds", "Latency", buckets=[1, 0.1])
+        for value in [0.05, 0.1, 0.5, 2]:
+            histogram.observe(value)
+        self.assertEqual(list(histogram.samples()), [
+            ("latency_seconds_bucket", (("le", "0.1"),), 2),
+            ("latency_seconds_bucket", (("le", "1"),), 3),
+            ("latency_seconds_bucket", (("le", "+Inf"),), 4),
+            ("latency_seconds_sum", (), 2.65),
+            ("latency_seconds_count", (), 4),
+        ])
+        with histogram.time():
+            pass
+        self.assertEqual(histogram.labels().count, 5)
+
+    def test_registry(self):
+        registry = MetricsRegistry()
+        counter = registry.register(Counter("a_total", "A"))
+        counter.inc()
+        self.assertRaises(ValueError, registry.register, Gauge("a_total", "Another A"))
+        extra = Gauge("b", "B")
+        extra.set(1)
+        self.assertEqual(registry.render([extra]),
+                         "# HELP a_total A\n# TYPE a_total counter\na_total 1\n# HELP b B\n# TYPE b gauge\nb 1\n")
@@ -0,0 +1,155 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from nmosquery.paging import TimeOrder, paginate, parse_timestamp, format_timestamp, resource_timestamp
+
+
+class TestTimestamps(unittest.TestCase):
+
+    def test_parse_timestamp(self):
+        self.assertEqual(parse_timestamp("1441716120:100"), (1441716120, 100))
+        self.assertEqual(format_timestamp((1441716120, 100)), "1441716120:100")
+        for value in ["", "1441716120", "1:2:3", "a:b", "-1:0", "1:1000000000"]:
+            with self.assertRaises(ValueError):
+                parse_timestamp(value)
+
+    def test_resource_timestamp(self):
+        self.assertEqual(resource_timestamp({"version": "10:5"}), (10, 5))
+        self.assertEqual(resource_timestamp({"version": "potato"}), (0, 0))
+        self.assertEqual(resource_timestamp({}), (0, 0))
+
+
+class TestPaginate(unittest.TestCase):
+
+    def setUp(self):
+        # Ten resources, "r1" to "r10", with versions 1:0 to 10:0
+        self.order = TimeOrder()
+        for i in range(10, 0, -1):
+            self.order.add((i, 0), "r{}".format(i))
+
+    def test_time_order(self):
+        self.assertEqual(len(self.order), 10)
+        self.assertEqual(self.order.newest(), (10, 0))
+        self.assertEqual([key for ts, key in self.order.ascending((2, 0), (4, 0))], ["r3", "r4"])
+        self.assertEqual([key for ts, key in self.order.descending((2, 0), (4, 0))], ["r4", "r3"])
+        self.order.remove((4, 0), "r4")
+        self.order.remove((4, 0), "r5")
+        self.assertEqual([key for ts, key in self.order.ascending((2, 0), (5, 0))], ["r3", "r5"])
+        self.order.clear()
+        self.assertIsNone(self.order.newest())
+
+    def test_newest_page(self):
+        page = paginate(self.order, lambda key: key, limit=3)
+        self.assertEqual(page.items, ["r10", "r9", "r8"])
+        self.assertEqual((page.since, page.until), ((7, 0), (10, 0)))
+
+        # Following the 'prev' link
+        page = paginate(self.order, lambda key: key, until=page.since, limit=3)
+        self.assertEqual(page.items, ["r7", "r6", "r5"])
+        self.assertEqual((page.since, page.until), ((4, 0), (7, 0)))
+
+        page = paginate(self.order, lambda key: key, until=(2, 0), limit=3)
+        self.assertEqual(page.items, ["r2", "r1"])
+        self.assertEqual((page.since, page.until), ((0, 0), (2, 0)))
+
+    def test_since_page(self):
+        page = paginate(self.order, lambda key: key, since=(0, 0), limit=3)
+        self.assertEqual(page.items, ["r3", "r2", "r1"])
+        self.assertEqual((page.since, page.until), ((0, 0), (3, 0)))
+
+        # Following the 'next' link
+        page = paginate(self.order, lambda key: key, since=page.until, limit=3)
+        self.assertEqual(page.items, ["r6", "r5", "r4"])
+        self.assertEqual((page.since, page.until), ((3, 0), (6, 0)))
+
+        page = paginate(self.order, lambda key: key, since=(8, 0), limit=3)
+        self.assertEqual(page.items, ["r10", "r9"])
+        self.assertEqual((page.since, page.until), ((8, 0), (10, 0)))
+
+    def test_filtered_page(self):
+        visited = []
+
+        def resolve(key):
+            visited.append(key)
+            return key if int(key[1:]) % 2 == 0 else None
+
+        page = paginate(self.order, resolve, limit=2)
+        self.assertEqual(page.items, ["r10", "r8"])
+        self.assertEqual((page.since, page.until), ((7, 0), (10, 0)))
+        self.assertEqual(visited, ["r10", "r9", "r8"])
+
+        page = paginate(self.order, resolve, since=(1, 0), until=(5, 0), limit=5)
+        self.assertEqual(page.items, ["r4", "r2"])
+        self.assertEqual((page.since, page.until), ((1, 0), (5, 0)))
+
+
+class TestPaginateTies(unittest.TestCase):
+
+    def setUp(self):
+        # Resources sharing timestamps, as those without versions all do, between "a" at 5:0 and "z" at 20:0
+        self.order = TimeOrder()
+        self.order.add((5, 0), "a")
+        for i in range(5):
+            self.order.add((10, 0), "k{}".format(i))
+        self.order.add((0, 0), "none1")
+        self.order.add((0, 0), "none2")
+        self.order.add((20, 0), "z")
+
+    def test_unique_timestamps(self):
+        timestamps = [ts for ts, key in self.order.ascending()]
+        self.assertEqual(timestamps, sorted(set(timestamps)))
+        self.assertEqual(timestamps[:2], [(0, 1), (0, 2)])
+        self.assertEqual([key for ts, key in self.order.ascending((9, 0), (10, 2))], ["k0", "k1", "k2"])
+        self.assertEqual(self.order.add((10, 1), "k5"), (10, 5))
+
+        # Later additions at a timestamp in use sort after the earlier ones
+        self.order.remove((10, 2), "k2")
+        self.assertEqual(self.order.add((10, 0), "k2"), (10, 6))
+        self.assertEqual(self.order.add((10, 999999999), "k6"), (10, 999999999))
+        self.assertEqual(self.order.add((10, 999999999), "k7"), (11, 0))
+
+    def test_remove_bumped(self):
+        """Nothing should be left of resources held in place of a timestamp once they are removed"""
+        for ts, key in list(self.order.ascending()):
+            self.order.remove(ts, key)
+        self.assertEqual(len(self.order), 0)
+        self.assertEqual((self.order._times, self.order._bumped, self.order._requested), (set(), {}, {}))
+
+        # Changing resources come and go without leaving anything behind
+        for i in range(3):
+            held = [self.order.add((10, 0), "k{}".format(n)) for n in range(3)]
+            for ts, n in zip(held, range(3)):
+                self.order.remove(ts, "k{}".format(n))
+        self.assertEqual((self.order._bumped, self.order._requested), ({}, {}))
+
+    def test_prev_links(self):
+        """Following 'prev' links should visit every resource once"""
+        seen = []
+        page = paginate(self.order, lambda key: key, limit=2)
+        seen += page.items
+        while page.since != (0, 0):
+            page = paginate(self.order, lambda key: key, until=page.since, limit=2)
+            seen += page.items
+        self.assertEqual(seen, ["z", "k4", "k3", "k2", "k1", "k0", "a", "none2", "none1"])
+
+    def test_next_links(self):
+        """Following 'next' links should visit every resource once"""
+        seen = []
+        page = paginate(self.order, lambda key: key, since=(0, 0), limit=2)
+        while page.items:
+            seen += reversed(page.items)
+            page = paginate(self.order, lambda key: key, since=page.until, limit=2)
+        self.assertEqual(seen, ["none1", "none2", "a", "k0", "k1", "k2", "k3", "k4", "z"])
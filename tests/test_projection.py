@@ -0,0 +1,61 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import copy
+
+from nmosquery import projection
+
+SENDER = {
+    "id": "1fe66652-e590-11e7-b23a-2796ce8be661",
+    "label": "Camera 1",
+    "flow_id": "b30ebee2-e578-11e7-a01e-ab8cee26a3ae",
+    "caps": {"media_types": ["video/raw"], "event_types": []},
+    "tags": {"location": ["studio1"], "urn:x-nmos:tag:grouphint/v1.0": ["cam1:video"]},
+    "interface_bindings": [{"name": "eth0", "port": 1}, {"name": "eth1", "port": 2}],
+}
+
+
+class TestProjection(unittest.TestCase):
+
+    def test_project(self):
+        """Only the requested paths, and the id, should be kept"""
+        original = copy.deepcopy(SENDER)
+        project = projection.compile("label,caps.media_types,interface_bindings.name")
+        self.assertEqual(project(SENDER), {
+            "id": SENDER["id"],
+            "label": "Camera 1",
+            "caps": {"media_types": ["video/raw"]},
+            "interface_bindings": [{"name": "eth0"}, {"name": "eth1"}],
+        })
+        self.assertEqual(SENDER, original)
+
+    def test_whole_values(self):
+        """Paths through values other than objects should keep them whole, and missing paths be left out"""
+        project = projection.compile("label.first,caps,caps.media_types,missing.path")
+        self.assertEqual(project(SENDER), {"id": SENDER["id"], "label": "Camera 1", "caps": SENDER["caps"]})
+
+    def test_dotted_keys(self):
+        project = projection.compile("tags.urn:x-nmos:tag:grouphint/v1.0")
+        self.assertEqual(project(SENDER), {"id": SENDER["id"],
+                                           "tags": {"urn:x-nmos:tag:grouphint/v1.0": ["cam1:video"]}})
+
+    def test_compile_cache(self):
+        self.assertIs(projection.compile("label"), projection.compile("label"))
+        self.assertIsNone(projection.for_args({"label": "a"}))
+        self.assertIs(projection.for_args({"query.fields": "label"}), projection.compile("label"))
+
+    def test_errors(self):
+        for fields in ["", "label,", "caps..media_types", ".label", "a.b.c.d.e.f.g.h.i", ["label"], None]:
+            self.assertRaises(projection.ProjectionError, projection.compile, fields)
@@ -0,0 +1,324 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import mock
+import json
+import six
+
+from nmosquery.registry import Registry, WATCH_EVENTS, DISPATCH_DURATION
+from nmosquery.backends import FakeBackend
+from nmosquery.httppool import DEFAULT_TIMEOUT
+
+FLOW_KEY = "/resource/flows/b30ebee2-e578-11e7-a01e-ab8cee26a3ae"
+FLOW = {"id": "b30ebee2-e578-11e7-a01e-ab8cee26a3ae", "source_id": "405d0f2e"}
+FLOW_VALUE = json.dumps(FLOW)
+SENDER_KEY = "/resource/senders/1fe66652-e590-11e7-b23a-2796ce8be661"
+SENDER = {"id": "1fe66652-e590-11e7-b23a-2796ce8be661", "flow_id": "b30ebee2"}
+SENDER_VALUE = json.dumps(SENDER)
+
+SNAPSHOT = {
+    "action": "get",
+    "node": {
+        "key": "/resource",
+        "dir": True,
+        "nodes": [
+            {
+                "key": "/resource/flows",
+                "dir": True,
+                "nodes": [{"key": FLOW_KEY, "value": FLOW_VALUE, "modifiedIndex": 10, "createdIndex": 10}]
+            },
+            {
+                "key": "/resource/senders",
+                "dir": True,
+                "nodes": [{"key": SENDER_KEY, "value": SENDER_VALUE, "modifiedIndex": 11, "createdIndex": 11}]
+            },
+            {
+                "key": "/resource/nodes",
+                "dir": True
+            }
+        ]
+    }
+}
+
+
+class TestRegistry(unittest.TestCase):
+
+    @mock.patch('nmosquery.registry.ChangeWatcher')
+    @mock.patch('nmosquery.registry.Logger')
+    def setUp(self, Logger, ChangeWatcher):
+        self.UUT = Registry("localhost", 2379)
+        ChangeWatcher.assert_called_once_with(self.UUT.backend, handler=self.UUT, logger=Logger.return_value)
+
+    def test_seed(self):
+        response = mock.MagicMock(name='response', status_code=200, headers={"x-etcd-index": "12"})
+        response.json.return_value = SNAPSHOT
+        with mock.patch('requests.Session.request', return_value=response) as request:
+            self.assertEqual(self.UUT.seed(), 12)
+            request.assert_called_once_with('GET', 'http://localhost:2379/v2/keys/resource/?recursive=true',
+                                            timeout=DEFAULT_TIMEOUT)
+        self.assertTrue(self.UUT.seeded)
+        self.assertEqual(len(self.UUT), 2)
+        self.assertEqual(self.UUT.get_resources('/flows'), {FLOW_KEY: FLOW})
+        self.assertEqual(self.UUT.get_resources('/'), {FLOW_KEY: FLOW, SENDER_KEY: SENDER})
+
+    def test_invalid_values(self):
+        """Values which aren't valid resources are held, but as None"""
+        self.UUT.load(SNAPSHOT, 12)
+        with mock.patch('json.loads', side_effect=json.loads) as loads:
+            self.UUT.apply({"action": "set", "node": {"key": FLOW_KEY, "value": "potato", "modifiedIndex": 13}})
+            self.UUT.apply({"action": "set", "node": {"key": SENDER_KEY, "value": "[]", "modifiedIndex": 14}})
+            self.assertEqual(loads.call_count, 2)
+        self.assertEqual(self.UUT.get_resources('/'), {FLOW_KEY: None, SENDER_KEY: None})
+        self.assertEqual(self.UUT.get_resources('/flows', {"source_id": "405d0f2e"}), {})
+
+    def test_seed_empty_registry(self):
+        response = mock.MagicMock(name='response', status_code=404, headers={"x-etcd-index": "3"})
+        with mock.patch('requests.Session.request', return_value=response):
+            self.assertEqual(self.UUT.seed(), 3)
+        self.assertTrue(self.UUT.seeded)
+        self.assertEqual(len(self.UUT), 0)
+
+    def test_seed_failure(self):
+        with mock.patch('requests.Session.request', side_effect=Exception):
+            self.assertIsNone(self.UUT.seed())
+        response = mock.MagicMock(name='response', status_code=500, headers={})
+        with mock.patch('requests.Session.request', return_value=response):
+            self.assertIsNone(self.UUT.seed())
+        self.assertFalse(self.UUT.seeded)
+
+    def test_get_resources_single(self):
+        self.UUT.load(SNAPSHOT, 12)
+        self.assertEqual(self.UUT.get_resources('/senders/1fe66652-e590-11e7-b23a-2796ce8be661'),
+                         {SENDER_KEY: SENDER})
+        self.assertEqual(self.UUT.get_resources('/senders/potato'), {})
+        self.assertEqual(self.UUT.get_resources('/receivers'), {})
+
+    def test_get_resources_indexed(self):
+        self.UUT.load(SNAPSHOT, 12)
+        self.assertEqual(self.UUT.get_resources('/flows', {"source_id": "405d0f2e"}), {FLOW_KEY: FLOW})
+        self.assertEqual(self.UUT.get_resources('/flows', {"source_id": "potato"}), {})
+        self.assertEqual(self.UUT.get_resources('/flows', {"label": "potato"}), {FLOW_KEY: FLOW})
+
+        self.UUT.apply({"action": "set", "node": {"key": FLOW_KEY, "value": json.dumps({"source_id": "potato"}),
+                                                  "modifiedIndex": 13}})
+        self.assertEqual(self.UUT.get_resources('/flows', {"source_id": "405d0f2e"}), {})
+        self.assertEqual(list(self.UUT.get_resources('/flows', {"source_id": "potato"})), [FLOW_KEY])
+
+        self.UUT.apply({"action": "delete", "node": {"key": FLOW_KEY, "modifiedIndex": 14}})
+        self.assertEqual(self.UUT.get_resources('/flows', {"source_id": "potato"}), {})
+
+    def test_get_resources_rql(self):
+        self.UUT.load(SNAPSHOT, 12)
+        self.assertEqual(self.UUT.get_resources('/flows', {"query.rql": "eq(source_id,potato)"}), {})
+        self.assertEqual(self.UUT.get_resources('/flows', {"query.rql": "in(source_id,(potato,405d0f2e))"}),
+                         {FLOW_KEY: FLOW})
+        self.assertEqual(self.UUT.get_resources('/flows', {"query.rql": "ne(source_id,405d0f2e)"}),
+                         {FLOW_KEY: FLOW})
+        self.assertEqual(self.UUT.get_resources('/flows', {"query.rql": "eq(source_id,405d0f2e)",
+                                                           "source_id": "potato"}), {})
+        self.assertEqual(self.UUT.get_resources('/flows', {"query.rql": "eq(source_id"}), {FLOW_KEY: FLOW})
+
+    def test_get_resources_ancestry(self):
+        self.UUT.load(SNAPSHOT, 12)
+        args = {"query.ancestry_id": "405d0f2e", "query.ancestry_type": "children"}
+        self.assertEqual(self.UUT.get_resources('/flows', args), {FLOW_KEY: FLOW})
+        self.assertEqual(self.UUT.get_resources('/senders', args), {})
+
+        # The flow is no longer a child of the source once it changes
+        self.UUT.apply({"action": "set", "node": {"key": FLOW_KEY, "value": json.dumps({"source_id": "potato"}),
+                                                  "modifiedIndex": 13}})
+        self.assertEqual(self.UUT.get_resources('/flows', args), {})
+
+    def test_apply(self):
+        self.assertFalse(self.UUT.apply({"action": "set", "node": {"key": FLOW_KEY, "value": "{}",
+                                                                   "modifiedIndex": 13}}))
+        self.UUT.load(SNAPSHOT, 12)
+
+        # Events already reflected in the snapshot are ignored
+        self.assertFalse(self.UUT.apply({"action": "delete", "node": {"key": FLOW_KEY, "modifiedIndex": 12}}))
+        self.assertIn(FLOW_KEY, self.UUT.get_resources('/flows'))
+
+        new_value = json.dumps({"id": "b30ebee2-e578-11e7-a01e-ab8cee26a3ae", "label": "new"})
+        self.assertTrue(self.UUT.apply({"action": "set", "node": {"key": FLOW_KEY, "value": new_value,
+                                                                  "modifiedIndex": 13}}))
+        self.assertEqual(self.UUT.get_resources('/flows'), {FLOW_KEY: json.loads(new_value)})
+        self.assertEqual(self.UUT.index, 13)
+
+        self.assertTrue(self.UUT.apply({"action": "expire", "node": {"key": SENDER_KEY, "modifiedIndex": 14}}))
+        self.assertEqual(self.UUT.get_resources('/senders'), {})
+
+        self.assertTrue(self.UUT.apply({"action": "delete", "node": {"key": "/resource/flows", "dir": True,
+                                                                     "modifiedIndex": 15}}))
+        self.assertEqual(len(self.UUT), 0)
+        self.assertEqual(self.UUT.index, 15)
+
+    def test_translation_cache_invalidation(self):
+        """Cached translations of a resource should be dropped as it changes"""
+        self.UUT.load(SNAPSHOT, 12)
+        self.assertEqual(self.UUT.get_modified_index(FLOW_KEY), 10)
+        translate = mock.MagicMock(return_value={"id": "translated"})
+        self.UUT.translations.get(FLOW_KEY, 10, "v1.3", None, translate)
+        self.assertEqual(len(self.UUT.translations), 1)
+
+        self.UUT.apply({"action": "set", "node": {"key": FLOW_KEY, "value": FLOW_VALUE, "modifiedIndex": 13}})
+        self.assertEqual(self.UUT.get_modified_index(FLOW_KEY), 13)
+        self.assertEqual(len(self.UUT.translations), 0)
+
+        self.UUT.translations.get(FLOW_KEY, 13, "v1.3", None, translate)
+        self.UUT.apply({"action": "delete", "node": {"key": "/resource/flows", "dir": True, "modifiedIndex": 14}})
+        self.assertIsNone(self.UUT.get_modified_index(FLOW_KEY))
+        self.assertEqual(len(self.UUT.translations), 0)
+
+    @mock.patch('nmosquery.registry.ChangeWatcher')
+    def test_backend(self, ChangeWatcher):
+        """The mirror should be seeded from, and kept current by, whichever backend it is given"""
+        backend = FakeBackend()
+        backend.put(FLOW_KEY, FLOW_VALUE)
+        UUT = Registry("localhost", 2379, backend=backend)
+        ChangeWatcher.assert_called_once_with(backend, handler=UUT, logger=mock.ANY)
+        self.assertEqual(UUT.seed(), 1)
+        self.assertEqual(UUT.get_resources('/'), {FLOW_KEY: FLOW})
+
+        stream = backend.watch(since=UUT.index)
+        backend.put(SENDER_KEY, SENDER_VALUE)
+        backend.delete(FLOW_KEY)
+        while not stream.queue.empty():
+            UUT._process_response(stream.queue.get())
+        self.assertEqual(UUT.get_resources('/'), {SENDER_KEY: SENDER})
+        self.assertEqual(UUT.index, 3)
+
+        backend.available = False
+        self.assertIsNone(UUT.seed())
+
+    @mock.patch('nmosquery.registry.ChangeWatcher')
+    def test_index_skip(self, ChangeWatcher):
+        """Missed changes should be found from a fresh snapshot, and passed on to listeners"""
+        backend = FakeBackend()
+        backend.put(FLOW_KEY, FLOW_VALUE)
+        backend.put(SENDER_KEY, SENDER_VALUE)
+        backend.put("/resource/nodes/unchanged", json.dumps({"id": "unchanged"}))
+        UUT = Registry("localhost", 2379, backend=backend)
+        listener = mock.MagicMock(name="listener")
+        UUT.add_listener(listener)
+        UUT.seed()
+        self.assertEqual(UUT.index, 3)
+
+        new_flow = {"id": FLOW["id"], "source_id": "405d0f2e", "label": "new"}
+        new_device = {"id": "device1"}
+        backend.put(FLOW_KEY, json.dumps(new_flow))
+        backend.delete(SENDER_KEY)
+        backend.put("/resource/devices/device1", json.dumps(new_device))
+        backend.put("/resource/nodes/unchanged", json.dumps({"id": "unchanged"}))
+        backend.compact()
+
+        UUT._process_response({"action": "index_skip", "from": 3, "to": 7})
+        self.assertEqual(UUT.index, 7)
+        self.assertEqual(UUT.get_resources('/flows'), {FLOW_KEY: new_flow})
+        self.assertEqual(UUT.get_resources('/senders'), {})
+        self.assertEqual(UUT.fields.lookup("senders", {"flow_id": "b30ebee2"}), set())
+        six.assertCountEqual(self, listener.do_sup.mock_calls, [
+            mock.call(FLOW_KEY, FLOW, new_flow, pre_index=1, post_index=4),
+            mock.call("/resource/devices/device1", {}, new_device, pre_index=None, post_index=6),
+        ])
+        listener.do_sdown.assert_called_once_with(SENDER_KEY, SENDER, {}, pre_index=2, post_index=7)
+
+        # Nothing more is missed
+        listener.reset_mock()
+        self.assertEqual(UUT.resync(), 7)
+        listener.do_sup.assert_not_called()
+        listener.do_sdown.assert_not_called()
+
+        backend.available = False
+        self.assertIsNone(UUT.resync())
+        self.assertEqual(UUT.get_resources('/flows'), {FLOW_KEY: new_flow})
+
+    @mock.patch('nmosquery.registry.ChangeWatcher')
+    def test_warm_start(self, ChangeWatcher):
+        """The mirror should be seeded from a snapshot dumped earlier, and carry on from its index"""
+        backend = FakeBackend()
+        backend.put(FLOW_KEY, FLOW_VALUE)
+        backend.put(SENDER_KEY, SENDER_VALUE)
+        UUT = Registry("localhost", 2379, backend=backend)
+        UUT.seed()
+        index, resources = UUT.dump()
+        self.assertEqual(index, 2)
+        six.assertCountEqual(self, resources, [(FLOW_KEY, 1, FLOW), (SENDER_KEY, 2, SENDER)])
+
+        backend.put("/resource/devices/device1", json.dumps({"id": "device1"}))
+        UUT = Registry("localhost", 2379, backend=backend)
+        UUT.warm_start = (index, resources)
+        backend.available = False
+        self.assertEqual(UUT.seed(), 2)
+        self.assertEqual(UUT.get_resources('/'), {FLOW_KEY: FLOW, SENDER_KEY: SENDER})
+        self.assertEqual(UUT.get_modified_index(SENDER_KEY), 2)
+        self.assertEqual(UUT.fields.lookup("senders", {"flow_id": "b30ebee2"}), set([SENDER_KEY]))
+        self.assertIsNone(UUT.warm_start)
+
+        # Changes since are watched for as usual
+        for event in list(backend.watch(since=UUT.index).queue.queue):
+            UUT._process_response(event)
+        self.assertEqual(UUT.index, 3)
+        self.assertEqual(len(UUT), 3)
+
+    def test_process_response(self):
+        """Each event should be decoded once and handed to every listener"""
+        listeners = [mock.MagicMock(name="v1.0"), mock.MagicMock(name="v1.3")]
+        listeners[0].do_sup.side_effect = Exception
+        for listener in listeners:
+            self.UUT.add_listener(listener)
+        self.UUT.load(SNAPSHOT, 12)
+
+        new_value = json.dumps({"id": "b30ebee2-e578-11e7-a01e-ab8cee26a3ae", "label": "new"})
+        with mock.patch('json.loads', side_effect=json.loads) as loads:
+            self.UUT._process_response({"action": "set",
+                                        "node": {"key": FLOW_KEY, "value": new_value, "modifiedIndex": 13},
+                                        "prevNode": {"key": FLOW_KEY, "value": FLOW_VALUE, "modifiedIndex": 10}})
+            self.assertEqual(loads.call_count, 2)
+        for listener in listeners:
+            listener.do_sup.assert_called_once_with(FLOW_KEY, json.loads(FLOW_VALUE), json.loads(new_value),
+                                                    pre_index=10, post_index=13)
+
+        self.UUT._process_response({"action": "delete", "node": {"key": SENDER_KEY, "modifiedIndex": 14},
+                                    "prevNode": {"key": SENDER_KEY, "value": SENDER_VALUE, "modifiedIndex": 11}})
+        for listener in listeners:
+            listener.do_sdown.assert_called_once_with(SENDER_KEY, json.loads(SENDER_VALUE), {},
+                                                      pre_index=11, post_index=14)
+
+        # Stale events are not passed on, but are counted
+        deletes = WATCH_EVENTS.labels("delete").value
+        dispatches = DISPATCH_DURATION.labels().count
+        self.UUT._process_response({"action": "delete", "node": {"key": SENDER_KEY, "modifiedIndex": 14}})
+        for listener in listeners:
+            self.assertEqual(listener.do_sdown.call_count, 1)
+        self.assertEqual(WATCH_EVENTS.labels("delete").value, deletes + 1)
+        self.assertEqual(DISPATCH_DURATION.labels().count, dispatches)
+
+        # Values which aren't valid resources are passed on as None, as the mirror holds them
+        self.UUT._process_response({"action": "set",
+                                    "node": {"key": FLOW_KEY, "value": "{potato", "modifiedIndex": 15},
+                                    "prevNode": {"key": FLOW_KEY, "value": new_value, "modifiedIndex": 13}})
+        self.UUT._process_response({"action": "set",
+                                    "node": {"key": FLOW_KEY, "value": new_value, "modifiedIndex": 16},
+                                    "prevNode": {"key": FLOW_KEY, "value": "[]", "modifiedIndex": 15}})
+        for listener in listeners:
+            self.assertEqual(listener.do_sup.call_args_list[1:], [
+                mock.call(FLOW_KEY, json.loads(new_value), None, pre_index=13, post_index=15),
+                mock.call(FLOW_KEY, None, json.loads(new_value), pre_index=15, post_index=16)])
+        self.assertEqual(self.UUT.index, 16)
+
+        self.UUT.remove_listener(listeners[1])
+        self.UUT.del_all_socks()
+        listeners[0].query_sockets.del_all_socks.assert_called_once_with()
+        listeners[1].query_sockets.del_all_socks.assert_not_called()
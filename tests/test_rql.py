@@ -0,0 +1,101 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+
+from nmosquery import rql
+from nmosquery.fieldindex import FieldIndex
+
+FLOW = {
+    "id": "b30ebee2-e578-11e7-a01e-ab8cee26a3ae",
+    "label": "Camera 1",
+    "format": "urn:x-nmos:format:video",
+    "grain_rate": {"numerator": 25, "denominator": 1},
+    "tags": {"location": ["studio1", "studio2"], "urn:x-nmos:tag:grouphint/v1.0": ["cam1:video"]},
+    "parents": [],
+}
+
+
+class TestRQL(unittest.TestCase):
+
+    def test_parse(self):
+        self.assertEqual(rql.parse("eq(label,Camera%201)"), ("eq", ["label", "Camera 1"]))
+        self.assertEqual(rql.parse("eq(a,true),eq(b,null)"), ("and", [("eq", ["a", True]), ("eq", ["b", None])]))
+        self.assertEqual(rql.parse("in(a,(1,2.5,string:3,number:4,boolean:false))"),
+                         ("in", ["a", [1, 2.5, "3", 4, False]]))
+        self.assertEqual(rql.parse("eq(a,urn:x-nmos:format:video)"), ("eq", ["a", "urn:x-nmos:format:video"]))
+        self.assertEqual(rql.parse("eq(a,())"), ("eq", ["a", []]))
+
+    def test_parse_errors(self):
+        for expression in ["", "potato", "eq(a,b", "eq(a,b))", "eq(a,b)c", "eq(a,number:x)", None]:
+            with self.assertRaises(rql.RQLError):
+                rql.compile(expression)
+        for expression in ["eq(a)", "ne(a,b,c)", "not(a)", "and()", "in((a),b)", "matches(a,()"]:
+            with self.assertRaises(rql.RQLError):
+                rql.compile(expression)
+        with self.assertRaises(rql.RQLNotSupported):
+            rql.compile("sort(+label)")
+
+    def test_evaluate(self):
+        tests = [
+            ("eq(format,urn:x-nmos:format:video)", True),
+            ("eq(format,urn:x-nmos:format:audio)", False),
+            ("ne(format,urn:x-nmos:format:audio)", True),
+            ("ne(missing,value)", True),
+            ("eq(grain_rate.numerator,25)", True),
+            ("eq(grain_rate.numerator,string:25)", False),
+            ("lt(grain_rate.numerator,30)", True),
+            ("ge(grain_rate.numerator,30)", False),
+            ("gt(label,1)", False),
+            ("le(label,Camera%202)", True),
+            ("eq(tags.location,studio2)", True),
+            ("eq(tags.urn:x-nmos:tag:grouphint/v1.0,cam1:video)", True),
+            ("in(format,(urn:x-nmos:format:audio,urn:x-nmos:format:video))", True),
+            ("out(format,(urn:x-nmos:format:audio,urn:x-nmos:format:video))", False),
+            ("in(tags.location,(studio3))", False),
+            ("matches(label,^camera)", False),
+            ("matches(label,^camera,i)", True),
+            ("and(eq(label,Camera%201),lt(grain_rate.numerator,30))", True),
+            ("or(eq(label,potato),gt(grain_rate.denominator,0))", True),
+            ("not(or(eq(label,potato),eq(parents,potato)))", True),
+        ]
+        for expression, expected in tests:
+            self.assertEqual(rql.compile(expression)(FLOW), expected, expression)
+
+    def test_cache(self):
+        self.assertIs(rql.compile("eq(label,a)"), rql.compile("eq(label,a)"))
+        self.assertIsNot(rql.compile("eq(label,a)"), rql.compile("eq(label,b)"))
+
+    def test_candidates(self):
+        index = FieldIndex()
+        index.add("/resource/flows/a", "flows", {"format": "urn:x-nmos:format:video", "device_id": "dev1"})
+        index.add("/resource/flows/b", "flows", {"format": "urn:x-nmos:format:audio", "device_id": "dev1"})
+        index.add("/resource/flows/c", "flows", {"format": "urn:x-nmos:format:data", "device_id": "dev2"})
+
+        tests = [
+            ("eq(format,urn:x-nmos:format:video)", set(["/resource/flows/a"])),
+            ("in(format,(urn:x-nmos:format:video,urn:x-nmos:format:data))",
+             set(["/resource/flows/a", "/resource/flows/c"])),
+            ("and(eq(device_id,dev1),eq(label,potato))", set(["/resource/flows/a", "/resource/flows/b"])),
+            ("and(eq(device_id,dev1),ne(format,urn:x-nmos:format:video))",
+             set(["/resource/flows/a", "/resource/flows/b"])),
+            ("and(eq(device_id,dev1),eq(format,urn:x-nmos:format:data))", set()),
+            ("or(eq(device_id,dev2),eq(format,urn:x-nmos:format:audio))",
+             set(["/resource/flows/b", "/resource/flows/c"])),
+            ("or(eq(device_id,dev2),eq(label,potato))", None),
+            ("ne(format,urn:x-nmos:format:video)", None),
+            ("eq(label,potato)", None),
+        ]
+        for expression, expected in tests:
+            self.assertEqual(rql.compile(expression).candidates(index, "flows"), expected, expression)
@@ -0,0 +1,115 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+import mock
+import sys
+
+# systemd's bindings are only to be found where systemd is
+try:
+    from nmosquery import service
+except ImportError:
+    systemd = mock.MagicMock(name="systemd")
+    sys.modules.update({"systemd": systemd, "systemd.daemon": systemd.daemon})
+    try:
+        from nmosquery import service
+    finally:
+        del sys.modules["systemd"], sys.modules["systemd.daemon"]
+
+CONFIG = {"priority": 100, "https_mode": "disabled", "enable_mdns": True, "oauth_mode": False}
+
+
+class TestQueryService(unittest.TestCase):
+
+    def setUp(self):
+        patches = [mock.patch('nmosquery.service.MDNSEngine'),
+                   mock.patch('nmosquery.service.HttpServer'),
+                   mock.patch('nmosquery.service.Supervisor'),
+                   mock.patch('nmosquery.service.daemon'),
+                   mock.patch('nmosquery.service.multiprocessing.cpu_count', return_value=4),
+                   mock.patch('time.sleep')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def service(self, **config):
+        with mock.patch('nmosquery.service.config', dict(CONFIG, **config)):
+            return service.QueryService()
+
+    def test_single_worker(self):
+        """One worker should be served from this process"""
+        UUT = self.service()
+        service.Supervisor.assert_not_called()
+        self.assertIs(UUT.httpServer, service.HttpServer.return_value)
+        service.HttpServer.return_value.failed = None
+
+        UUT.start()
+        service.HttpServer.return_value.start.assert_called_once_with()
+        UUT.mdns.register.assert_called_once_with(service.DNS_SD_NAME + "_http", service.DNS_SD_TYPE,
+                                                  service.DNS_SD_HTTP_PORT, {"pri": 100, "api_ver": mock.ANY,
+                                                                             "api_proto": "http", "api_auth": "false"})
+
+        UUT.wait_ready()
+        service.HttpServer.return_value.api.registry.ready.wait.assert_called_once_with()
+
+        UUT.stop()
+        service.HttpServer.return_value.stop.assert_called_once_with()
+
+    def test_workers(self):
+        """Several workers should be run by a Supervisor, on the same port"""
+        UUT = self.service(workers=3)
+        service.HttpServer.assert_not_called()
+        service.Supervisor.assert_called_once_with(3, service.WS_PORT, '0.0.0.0', logger=UUT.logger,
+                                                   registry=service.query_reg)
+        supervisor = service.Supervisor.return_value
+
+        UUT.start()
+        supervisor.start.assert_called_once_with()
+        self.assertEqual(UUT.mdns.register.call_count, 1)
+
+        UUT.stop()
+        supervisor.stop.assert_called_once_with()
+        UUT.mdns.close.assert_called_once_with()
+
+    def test_worker_per_cpu(self):
+        """Workers set to 0 should run one per CPU"""
+        self.service(workers=0)
+        self.assertEqual(service.Supervisor.call_args[0][0], 4)
+
+    def test_wait_ready(self):
+        """Readiness should wait until every worker is ready, polling their status"""
+        UUT = self.service(workers=2)
+        UUT.running = True
+        service.Supervisor.return_value.ready.side_effect = [False, False, True]
+        UUT.wait_ready()
+        self.assertEqual(service.Supervisor.return_value.ready.call_count, 3)
+        self.assertEqual(service.time.sleep.call_args_list, [mock.call(service.READY_POLL_INTERVAL)] * 2)
+
+    def test_wait_ready_stopped(self):
+        """Readiness should stop being waited for once stopped"""
+        UUT = self.service(workers=2)
+        service.Supervisor.return_value.ready.return_value = False
+        service.time.sleep.side_effect = lambda secs: setattr(UUT, "running", False)
+        UUT.running = True
+        UUT.wait_ready()
+        self.assertEqual(service.Supervisor.return_value.ready.call_count, 1)
+
+    def test_run(self):
+        """systemd should be told the service is ready only once the registry mirror is"""
+        UUT = self.service(workers=2)
+        service.Supervisor.return_value.ready.return_value = True
+        with mock.patch.object(UUT, "wait_ready") as wait_ready:
+            service.daemon.notify.side_effect = lambda state: wait_ready.assert_called_once_with()
+            service.time.sleep.side_effect = lambda secs: setattr(UUT, "running", False)
+            UUT.run()
+        service.daemon.notify.assert_called_once_with(service.SYSTEMD_READY)
@@ -0,0 +1,67 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import os
+import shutil
+import tempfile
+
+from nmosquery.snapshot import write_snapshot, read_snapshot, SnapshotError
+
+RESOURCES = [
+    ("/resource/flows/b30ebee2-e578-11e7-a01e-ab8cee26a3ae", 10, {"id": "b30ebee2-e578-11e7-a01e-ab8cee26a3ae",
+                                                                  "label": u"caf\u00e9\nflow"}),
+    ("/resource/nodes/efee1ab5-85f1-4ae3-b5d5-3ccc79ae76af", 12, {"id": "efee1ab5-85f1-4ae3-b5d5-3ccc79ae76af"}),
+]
+SUBSCRIPTIONS = {"v1.3": [{"summary": {"id": "a", "persist": True}, "secure": False}]}
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        self.path = os.path.join(self.dir, "snapshot")
+
+    def test_round_trip(self):
+        write_snapshot(self.path, 12, RESOURCES, SUBSCRIPTIONS)
+        header, resources = read_snapshot(self.path)
+        self.assertEqual((header["index"], header["subscriptions"]), (12, SUBSCRIPTIONS))
+        self.assertEqual(resources, RESOURCES)
+        self.assertEqual(os.listdir(self.dir), ["snapshot"])
+
+        # Snapshots are replaced whole
+        write_snapshot(self.path, 13, RESOURCES[1:])
+        header, resources = read_snapshot(self.path)
+        self.assertEqual((header["index"], header["subscriptions"], resources), (13, {}, RESOURCES[1:]))
+
+    def test_unusable(self):
+        """Snapshots which are missing, incomplete or corrupt should not be used"""
+        self.assertRaises(SnapshotError, read_snapshot, self.path)
+        open(self.path, "w").close()
+        self.assertRaises(SnapshotError, read_snapshot, self.path)
+
+        write_snapshot(self.path, 12, RESOURCES)
+        with open(self.path, "rb") as f:
+            lines = f.readlines()
+        for contents in (lines[:-1], lines[:-1] + [lines[-1][:20]], [b'{"version": 0}\n'] + lines[1:]):
+            with open(self.path, "wb") as f:
+                f.writelines(contents)
+            self.assertRaises(SnapshotError, read_snapshot, self.path)
+
+    def test_write_failure(self):
+        """A snapshot which can't be written should leave any previous one in place"""
+        write_snapshot(self.path, 12, RESOURCES)
+        self.assertRaises(TypeError, write_snapshot, self.path, 13, [("/resource/flows/x", 13, object())])
+        self.assertEqual(read_snapshot(self.path)[0]["index"], 12)
+        self.assertEqual(os.listdir(self.dir), ["snapshot"])
@@ -0,0 +1,97 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import mock
+
+from nmosquery.subscriptionindex import SubscriptionIndex
+from nmosquery.common.querysockets import QuerySocketsCommon
+from nmosquery.util import translate_resourcetypes
+
+SUBSCRIPTIONS = [
+    ("/flows", {}),
+    ("/flows", {"source_id": "src1"}),
+    ("/flows", {"source_id": "src2", "label": "a"}),
+    ("/flows", {"format": "urn:x-nmos:format:video", "device_id": "dev1"}),
+    ("/flows", {"label": "a"}),
+    ("/flows", {"label": ["unhashable"]}),
+    ("/flows", {"tags.location": "studio1"}),
+    ("/flows/flow2", {}),
+    ("/senders", {"flow_id": "flow1"}),
+    ("", {}),
+    ("", {"source_id": "src1"}),
+]
+
+EVENTS = [
+    ("/resource/flows/flow1", {"id": "flow1", "source_id": "src1", "label": "a", "device_id": "dev1",
+                               "format": "urn:x-nmos:format:video", "tags": {"location": ["studio1"]}}, {}),
+    ("/resource/flows/flow2", {"id": "flow2", "source_id": "src2", "label": "b", "device_id": "dev2",
+                               "format": "urn:x-nmos:format:audio"},
+                              {"id": "flow2", "source_id": "src2", "label": "a", "device_id": "dev2",
+                               "format": "urn:x-nmos:format:audio"}),
+    ("/resource/flows/flow3", {"id": "flow3", "source_id": "", "label": ["a", "b"]}, {}),
+    ("/resource/flows/flow4", {}, {"id": "flow4", "device_id": "dev1"}),
+    ("/resource/senders/snd1", {"id": "snd1", "flow_id": "flow1"}, {}),
+    ("/resource/senders/snd2", {"id": "snd2", "flow_id": "flow2"}, {}),
+    ("/resource/nodes/node1", {"id": "node1"}, {}),
+]
+
+
+class TestSubscriptionIndex(unittest.TestCase):
+
+    @mock.patch('nmosquery.common.querysockets.getLocalIP', return_value="192.168.0.23")
+    def setUp(self, getLocalIP):
+        self.UUT = QuerySocketsCommon(8870, logger=mock.MagicMock(name="logger"))
+        for resource_path, params in SUBSCRIPTIONS:
+            self.UUT.add_sock({"resource_path": resource_path, "params": params})
+
+    def scan(self, path, obj, p_obj):
+        """The result of testing every socket, as find_socks used to"""
+        retval = []
+        for s in self.UUT.sockets:
+            sock_path = translate_resourcetypes(s.resource_path)
+            if sock_path and sock_path not in path:
+                continue
+            if (obj and self.UUT._check_args(s, obj)) or (p_obj and self.UUT._check_args(s, p_obj)):
+                retval.append(s)
+        return retval
+
+    def test_find_socks_matches_scan(self):
+        for path, obj, p_obj in EVENTS:
+            self.assertEqual(self.UUT.find_socks(path=path, obj=obj, p_obj=p_obj), self.scan(path, obj, p_obj), path)
+
+    def test_candidates(self):
+        index = self.UUT.index
+        self.assertEqual(len(index), len(SUBSCRIPTIONS))
+        resource_paths = [(s.resource_path, s.params) for s in index.candidates("/resource/senders/snd2",
+                                                                                {"id": "snd2", "flow_id": "flow2"})]
+        self.assertEqual(resource_paths, [("", {}), ("", {"source_id": "src1"})])
+
+        flow = {"id": "flow5", "source_id": "src2", "label": "c"}
+        params = [s.params for s in index.candidates("/resource/flows/flow5", flow)]
+        self.assertEqual(params, [{}, {"source_id": "src2", "label": "a"}, {"label": ["unhashable"]},
+                                  {"tags.location": "studio1"}, {}, {}, {"source_id": "src1"}])
+
+    def test_remove(self):
+        for sock in list(self.UUT.sockets):
+            if sock.params.get("source_id") == "src1":
+                self.UUT.del_sock(sock)
+        path, obj, p_obj = EVENTS[0]
+        self.assertEqual(self.UUT.find_socks(path=path, obj=obj, p_obj=p_obj), self.scan(path, obj, p_obj))
+        self.assertNotIn("src1", [s.params.get("source_id") for s in self.UUT.index.candidates(path, obj)])
+
+        self.UUT.del_all_socks()
+        self.assertEqual(len(self.UUT.sockets), 0)
+        self.assertEqual(len(self.UUT.index), 0)
+        self.assertEqual(SubscriptionIndex().candidates(path, obj), [])
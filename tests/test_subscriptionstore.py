@@ -0,0 +1,92 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import shutil
+import tempfile
+import os
+
+from nmosquery.subscriptionstore import SubscriptionStore
+
+ID_A = "f47ac10b-58cc-4372-a567-0e02b2c3d479"
+ID_B = "9b2f5a8e-1c3d-4e6f-8a7b-2c4d6e8f0a1b"
+
+
+def record(uid, persist=False):
+    return {"summary": {"id": uid, "persist": persist, "resource_path": "/flows"}, "secure": False}
+
+
+class TestSubscriptionStore(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.workers = [SubscriptionStore(self.path, 0).for_version("v1.3"),
+                        SubscriptionStore(self.path, 1).for_version("v1.3")]
+
+    def test_records(self):
+        """Records saved through one worker should be seen by the others"""
+        self.workers[0].save(ID_A, record(ID_A))
+        self.workers[1].save(ID_B, record(ID_B, persist=True))
+        self.assertEqual(self.workers[1].get(ID_A), record(ID_A))
+        self.assertEqual(len(self.workers[0].records()), 2)
+        self.assertIsNone(SubscriptionStore(self.path, 0).for_version("v1.2").get(ID_A))
+
+        self.workers[1].remove(ID_A)
+        self.assertFalse(self.workers[0].exists(ID_A))
+        self.assertEqual(self.workers[0].records(), [record(ID_B, persist=True)])
+
+    def test_invalid_ids(self):
+        """Ids come from clients, so only those which could be subscription ids should reach the filesystem"""
+        self.assertIsNone(self.workers[0].get("../../etc/passwd"))
+        self.assertIsNone(self.workers[0].get(None))
+        self.assertRaises(ValueError, self.workers[0].save, "../x", record("../x"))
+
+    def test_detach(self):
+        """A non-persistent subscription should be removed once the last worker serving it has detached"""
+        self.workers[0].save(ID_A, record(ID_A))
+        self.workers[0].attach(ID_A)
+        self.workers[1].attach(ID_A)
+        self.assertFalse(self.workers[0].detach(ID_A))
+        self.assertTrue(self.workers[0].exists(ID_A))
+        self.assertTrue(self.workers[1].detach(ID_A))
+        self.assertFalse(self.workers[0].exists(ID_A))
+        self.assertEqual(os.listdir(self.workers[0].path), [])
+
+        self.workers[0].save(ID_B, record(ID_B, persist=True))
+        self.workers[0].attach(ID_B)
+        self.assertFalse(self.workers[0].detach(ID_B))
+        self.assertTrue(self.workers[0].exists(ID_B))
+
+    def test_detach_worker(self):
+        """A worker which has died should be detached from everything, in every API version"""
+        self.workers[0].save(ID_A, record(ID_A))
+        self.workers[0].save(ID_B, record(ID_B))
+        self.workers[1].attach(ID_A)
+        self.workers[0].attach(ID_B)
+        self.workers[1].attach(ID_B)
+        SubscriptionStore(self.path, "supervisor").detach_worker(1)
+        self.assertFalse(self.workers[0].exists(ID_A))
+        self.assertTrue(self.workers[0].exists(ID_B))
+
+    def test_unclaimed(self):
+        """Non-persistent subscriptions no worker has served since they were saved long enough ago are unclaimed"""
+        self.workers[0].save(ID_A, record(ID_A))
+        self.workers[0].save(ID_B, record(ID_B, persist=True))
+        self.assertEqual(self.workers[1].unclaimed(30), [])
+        for uid in [ID_A, ID_B]:
+            os.utime(self.workers[0]._file(uid), (0, 0))
+        self.assertEqual(self.workers[1].unclaimed(30), [ID_A])
+        self.workers[1].attach(ID_A)
+        self.assertEqual(self.workers[1].unclaimed(30), [])
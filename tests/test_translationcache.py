@@ -0,0 +1,63 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import mock
+
+from nmosquery.translationcache import TranslationCache
+
+
+class TestTranslationCache(unittest.TestCase):
+
+    def setUp(self):
+        self.UUT = TranslationCache(size=3)
+
+    def test_get(self):
+        translate = mock.MagicMock(side_effect=[{"id": "a"}, None, {"id": "a2"}])
+        self.assertEqual(self.UUT.get("/resource/flows/a", 10, "v1.3", None, translate), {"id": "a"})
+        self.assertEqual(self.UUT.get("/resource/flows/a", 10, "v1.3", None, translate), {"id": "a"})
+        self.assertEqual(translate.call_count, 1)
+
+        # Untranslatable resources are cached too
+        self.assertIsNone(self.UUT.get("/resource/flows/a", 10, "v1.3", "v1.0", translate))
+        self.assertIsNone(self.UUT.get("/resource/flows/a", 10, "v1.3", "v1.0", translate))
+        self.assertEqual(translate.call_count, 2)
+
+        self.assertEqual(self.UUT.get("/resource/flows/a", 11, "v1.3", None, translate), {"id": "a2"})
+        self.assertEqual(translate.call_count, 3)
+        self.assertEqual(self.UUT.stats(), {"size": 3, "hits": 2, "misses": 3, "hit_rate": 0.4})
+
+    def test_unknown_version(self):
+        translate = mock.MagicMock(return_value={"id": "a"})
+        self.UUT.get("/resource/flows/a", None, "v1.3", None, translate)
+        self.UUT.get("/resource/flows/a", None, "v1.3", None, translate)
+        self.assertEqual(translate.call_count, 2)
+        self.assertEqual(len(self.UUT), 0)
+
+    def test_eviction_and_invalidation(self):
+        for i in range(5):
+            self.UUT.get("/resource/flows/{}".format(i), 1, "v1.3", None, lambda: {})
+        self.assertEqual(len(self.UUT), 3)
+
+        # The oldest entries are evicted first
+        translate = mock.MagicMock(return_value={})
+        self.UUT.get("/resource/flows/4", 1, "v1.3", None, translate)
+        self.UUT.get("/resource/flows/0", 1, "v1.3", None, translate)
+        self.assertEqual(translate.call_count, 1)
+
+        self.UUT.invalidate("/resource/flows/0")
+        self.UUT.invalidate("/resource/flows/potato")
+        self.assertEqual(len(self.UUT), 2)
+        self.UUT.clear()
+        self.assertEqual(len(self.UUT), 0)
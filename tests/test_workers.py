@@ -0,0 +1,249 @@
+# Copyright 2019 British Broadcasting Corporation
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import unittest
+import mock
+import os
+import sys
+import json
+import signal
+
+from six import PY2
+
+from nmosquery import workers
+from nmosquery.workers import Supervisor, ListenerHttpServer, run_worker, main, write_status
+
+
+def process(pid, code=None):
+    retval = mock.MagicMock(name="process{}".format(pid), pid=pid)
+    retval.poll.return_value = code
+    return retval
+
+
+class TestSupervisor(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = mock.MagicMock(name="listener")
+        self.listener.getsockname.return_value = ("0.0.0.0", 8870)
+        self.listener.fileno.return_value = 7
+        self.pids = iter(range(100, 200))
+        self.popen = mock.MagicMock(name="Popen", side_effect=lambda args, **kwargs: process(next(self.pids)))
+        patches = [mock.patch('nmosquery.workers.listen', return_value=self.listener),
+                   mock.patch('nmosquery.workers.subprocess.Popen', self.popen),
+                   mock.patch('nmosquery.workers.STOP_TIMEOUT', 0),
+                   mock.patch('gevent.spawn')]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+        self.UUT = Supervisor(2, 0, logger=mock.MagicMock(name="logger"), registry={"host": "etcd", "port": 4001})
+        self.UUT.start()
+        self.addCleanup(self.UUT.stop)
+
+    def write_status(self, index, **status):
+        write_status(os.path.join(self.UUT.state_dir, "workers", "{}.json".format(index)), status)
+
+    def test_start(self):
+        """Workers should be started on the listening socket, sharing a directory of state"""
+        workers.listen.assert_called_once_with('0.0.0.0', 0)
+        self.assertEqual(self.UUT.port, 8870)
+        self.assertTrue(os.path.isdir(os.path.join(self.UUT.state_dir, "workers")))
+        self.assertEqual(sorted(self.UUT.processes), [0, 1])
+
+        self.assertEqual(self.popen.call_count, 2)
+        args, kwargs = self.popen.call_args_list[1]
+        self.assertEqual(args[0], [sys.executable, "-m", "nmosquery.workers", "--worker", "1", "--fd", "7",
+                                   "--state-dir", self.UUT.state_dir, "--registry", "etcd:4001"])
+        if PY2:
+            self.assertFalse(kwargs["close_fds"])
+        else:
+            self.assertEqual(kwargs["pass_fds"], (7,))
+        package_dir = os.path.dirname(os.path.dirname(os.path.abspath(workers.__file__)))
+        self.assertEqual(kwargs["env"]["PYTHONPATH"].split(os.pathsep)[0], package_dir)
+
+    def test_check(self):
+        """Workers which die should be restarted, unless only just started, and their subscribers let go"""
+        self.UUT.processes[0].poll.return_value = 1
+        self.UUT.processes[1].poll.return_value = 1
+        self.UUT.started_at[0] -= workers.RESTART_DELAY
+        store = workers.SubscriptionStore(self.UUT.store.path, 0).for_version("v1.3")
+        store.attach("a")
+
+        self.UUT.check()
+        self.assertEqual(self.popen.call_count, 3)
+        self.assertEqual((self.UUT.processes[0].pid, self.UUT.processes[1].pid), (102, 101))
+        self.assertEqual(self.UUT.restarts, {0: 1})
+        self.assertFalse(store.attached("a"))
+
+    def test_status(self):
+        """The status reported by each worker should be read, with its CPU use and request rate between reports"""
+        self.assertEqual(self.UUT.status(), [{"worker": 0, "pid": 100, "restarts": 0},
+                                             {"worker": 1, "pid": 101, "restarts": 0}])
+
+        self.write_status(0, pid=100, time=10.0, cpu=1.0, requests=10, subscribers=3, ready=True)
+        # Left by the worker's predecessor
+        self.write_status(1, pid=99, time=10.0, cpu=1.0, requests=10, ready=True)
+        self.assertEqual(self.UUT.status()[0]["subscribers"], 3)
+        self.assertNotIn("cpu_percent", self.UUT.status()[0])
+        self.assertEqual(self.UUT.status()[1], {"worker": 1, "pid": 101, "restarts": 0})
+
+        self.write_status(0, pid=100, time=12.0, cpu=1.5, requests=30, subscribers=3, ready=True)
+        status = self.UUT.status()[0]
+        self.assertEqual((status["cpu_percent"], status["request_rate"]), (25.0, 10.0))
+
+        with mock.patch.object(self.UUT.logger, "writeInfo") as writeInfo:
+            self.UUT.report()
+        writeInfo.assert_called_with("Worker 1 (pid 101): 0 restarts")
+
+    def test_ready(self):
+        """The workers should be ready once every one has reported its registry mirror ready"""
+        self.assertFalse(self.UUT.ready())
+        self.write_status(0, pid=100, ready=True)
+        self.write_status(1, pid=101, ready=False)
+        self.assertFalse(self.UUT.ready())
+        self.write_status(1, pid=101, ready=True)
+        self.assertTrue(self.UUT.ready())
+
+    def test_stop(self):
+        """Workers should be terminated, and killed should they not exit in time"""
+        processes = [self.UUT.processes[0], self.UUT.processes[1]]
+        processes[0].poll.return_value = 0
+        state_dir = self.UUT.state_dir
+        self.UUT.stop()
+        for process in processes:
+            process.terminate.assert_called_once_with()
+        processes[0].kill.assert_not_called()
+        processes[1].kill.assert_called_once_with()
+        self.listener.close.assert_called_once_with()
+        self.assertFalse(os.path.exists(state_dir))
+        self.assertEqual(self.UUT.processes, {})
+
+
+class TestListenerHttpServer(unittest.TestCase):
+
+    def setUp(self):
+        self.listener = mock.MagicMock(name="listener")
+        self.listener.getsockname.return_value = ("0.0.0.0", 8870)
+        self.api_class = mock.MagicMock(name="api_class")
+        self.UUT = ListenerHttpServer(self.api_class, self.listener, api_args=["logger"], api_kwargs={"a": 1})
+
+    @mock.patch('nmosquery.workers.WSGIServer')
+    def test_run(self, WSGIServer):
+        """The API should be served from the listening socket given"""
+        self.UUT.run()
+        self.api_class.assert_called_once_with("logger", a=1)
+        api = self.api_class.return_value
+        self.assertEqual(api.port, 8870)
+        WSGIServer.assert_called_once_with(self.listener, api.app, handler_class=workers.WebSocketHandler)
+        self.assertTrue(self.UUT.started.is_set())
+        self.assertIsNone(self.UUT.failed)
+        WSGIServer.return_value.serve_forever.assert_called_once_with()
+
+    @mock.patch('nmosquery.workers.WSGIServer')
+    def test_run_failed(self, WSGIServer):
+        """A failure to start should be recorded, and nothing served"""
+        error = Exception("potato")
+        WSGIServer.return_value.start.side_effect = error
+        self.UUT.run()
+        self.assertTrue(self.UUT.started.is_set())
+        self.assertIs(self.UUT.failed, error)
+        WSGIServer.return_value.serve_forever.assert_not_called()
+
+
+class TestRunWorker(unittest.TestCase):
+
+    def setUp(self):
+        self.server = mock.MagicMock(name="server", failed=None, port=8870)
+        sock = mock.MagicMock(name="sock", subscribers=["ws1", "ws2"])
+        api = mock.MagicMock(name="api")
+        api.query.query_sockets.sockets = [sock]
+        self.server.api.apis.return_value = [api]
+        self.server.api.registry.ready.is_set.return_value = True
+        self.handlers = {}
+
+        patches = [mock.patch('nmosquery.workers.ListenerHttpServer', return_value=self.server),
+                   mock.patch('nmosquery.workers.SubscriptionStore'),
+                   mock.patch('nmosquery.workers.socket.fromfd'),
+                   mock.patch('nmosquery.workers.os.close'),
+                   mock.patch('nmosquery.workers.os.getppid', return_value=1234),
+                   mock.patch('gevent.signal_handler', side_effect=self.handlers.__setitem__)]
+        for patch in patches:
+            patch.start()
+            self.addCleanup(patch.stop)
+
+    def test_run_worker(self):
+        """Workers should report their status until told to stop"""
+        statuses = []
+
+        def write(path, status):
+            statuses.append((path, status))
+            self.handlers[signal.SIGTERM]()
+
+        with mock.patch('nmosquery.workers.write_status', side_effect=write):
+            run_worker(2, 7, "/state")
+
+        workers.socket.fromfd.assert_called_once_with(7, workers.socket.AF_INET, workers.socket.SOCK_STREAM)
+        workers.os.close.assert_called_once_with(7)
+        workers.SubscriptionStore.assert_called_once_with(os.path.join("/state", "subscriptions"), 2)
+        kwargs = workers.ListenerHttpServer.call_args[1]
+        self.assertEqual(kwargs["api_kwargs"], {"subscriptions": workers.SubscriptionStore.return_value,
+                                                "write_snapshots": False})
+
+        self.assertEqual(len(statuses), 1)
+        path, status = statuses[0]
+        self.assertEqual(path, os.path.join("/state", "workers", "2.json"))
+        self.assertEqual((status["pid"], status["subscriptions"], status["subscribers"], status["ready"]),
+                         (os.getpid(), 1, 2, True))
+        self.server.stop.assert_called_once_with()
+        self.server.server.stop.assert_called_once_with(timeout=1)
+
+    def test_supervisor_gone(self):
+        """Workers should stop once their supervisor has gone"""
+        workers.os.getppid.side_effect = [1234, 1]
+        with mock.patch('nmosquery.workers.write_status') as write:
+            run_worker(0, 7, "/state")
+        write.assert_not_called()
+        self.assertTrue(workers.ListenerHttpServer.call_args[1]["api_kwargs"]["write_snapshots"])
+        self.server.stop.assert_called_once_with()
+
+    def test_failed(self):
+        """Workers should fail should their server fail to start"""
+        self.server.failed = Exception("potato")
+        self.assertRaises(Exception, run_worker, 0, 7, "/state")
+        self.server.stop.assert_not_called()
+
+
+class TestMain(unittest.TestCase):
+
+    @mock.patch('nmosquery.workers.run_worker')
+    def test_main(self, run_worker):
+        """Workers should be run with the arguments given by their supervisor"""
+        from nmosquery.common.query import reg
+        with mock.patch.dict(reg):
+            main(["--worker", "1", "--fd", "5", "--state-dir", "/state", "--registry", "etcd:4001"])
+            self.assertEqual((reg["host"], reg["port"]), ("etcd", 4001))
+        run_worker.assert_called_once_with(1, 5, "/state")
+
+
+class TestWriteStatus(unittest.TestCase):
+
+    def test_write_status(self):
+        """Status should be written whole, so never read part-written"""
+        import tempfile
+        import shutil
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        write_status(os.path.join(path, "0.json"), {"pid": 1})
+        self.assertEqual(os.listdir(path), ["0.json"])
+        with open(os.path.join(path, "0.json")) as f:
+            self.assertEqual(json.load(f), {"pid": 1})